@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compares load time and peak RSS of the dill format and of the memory-mappable container format of DynamicDLModel.
+Every load runs in a fresh process, so that the peak RSS of one run does not affect the others.
+Peak RSS is read from /proc on Linux; on macOS ru_maxrss is used, which may include the parent process (no Windows support).
+
+Usage: python bench_model_container.py [--layers N] [--layer-mb MB] [--repeats N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from dafne_dl import DynamicDLModel
+from dafne_dl.DynamicDLModel import FORMAT_DILL, FORMAT_CONTAINER
+
+
+def init_model_function():
+    # minimal stand-in for a keras model: keeps a reference to the weights, like a model that does not copy them
+    class WeightHolder:
+        def __init__(self):
+            self.weights = []
+
+        def get_weights(self):
+            return self.weights
+
+        def set_weights(self, weights):
+            self.weights = weights
+
+    return WeightHolder()
+
+
+def apply_model_function(model_obj, data):
+    return {}
+
+
+CHILD_CODE = '''
+import resource, sys, time
+import numpy as np
+from dafne_dl import DynamicDLModel
+
+def peak_rss_mb():
+    # VmHWM is reset by execve, while ru_maxrss on Linux keeps the peak of the parent process that forked us
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 / 1024  # macOS: bytes
+
+baseline = peak_rss_mb()
+t = time.perf_counter()
+with open(sys.argv[1], 'rb') as f:
+    model = DynamicDLModel.Load(f)
+load_time = time.perf_counter() - t
+load_rss = peak_rss_mb()
+checksum = sum(float(np.sum(w)) for w in model.get_weights())  # touch all the weights
+touch_time = time.perf_counter() - t
+touch_rss = peak_rss_mb()
+print(load_time, load_rss - baseline, touch_time, touch_rss - baseline)
+'''
+
+
+def run_child(model_file):
+    output = subprocess.run([sys.executable, '-c', CHILD_CODE, model_file], check=True, capture_output=True,
+                            text=True).stdout
+    return [float(v) for v in output.split()[-4:]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layers', type=int, default=20, help='number of weight arrays')
+    parser.add_argument('--layer-mb', type=float, default=10, help='size of every weight array in MB')
+    parser.add_argument('--repeats', type=int, default=3, help='number of loads per format')
+    args = parser.parse_args()
+
+    n_values = int(args.layer_mb * 1024 * 1024 / 4)
+    weights = [np.random.rand(n_values).astype(np.float32) for _ in range(args.layers)]
+    model = DynamicDLModel('benchmark', init_model_function, apply_model_function, weights=weights)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print(f'Model with {args.layers} arrays of {args.layer_mb} MB')
+        print(f'{"format":>10} {"size MB":>8} {"load s":>8} {"load MB":>8} {"touch s":>8} {"touch MB":>8}')
+        for file_format in [FORMAT_DILL, FORMAT_CONTAINER]:
+            model_file = os.path.join(temp_dir, f'model.{file_format}')
+            with open(model_file, 'wb') as f:
+                model.dump(f, file_format)
+            size = os.path.getsize(model_file) / 1024 / 1024
+            results = np.array([run_child(model_file) for _ in range(args.repeats)])
+            load_time, load_rss, touch_time, touch_rss = np.median(results, axis=0)
+            print(f'{file_format:>10} {size:8.1f} {load_time:8.3f} {load_rss:8.1f} {touch_time:8.3f} {touch_rss:8.1f}')
+
+
+if __name__ == '__main__':
+    main()
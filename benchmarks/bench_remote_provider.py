@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compares the request latency of RemoteModelProvider with pooled keep-alive connections against one new connection per
+request (plain requests.post, the previous behaviour), using a local stand-in for the model server.
+The server counts the connections it accepts and the requests per endpoint. --handshake-ms adds a delay to every new
+connection, to emulate the TCP/TLS handshake of a remote server.
+
+Usage: python bench_remote_provider.py [--calls N] [--threads N] [--handshake-ms MS]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+from dafne_dl import DynamicDLModel
+from dafne_dl.RemoteModelProvider import RemoteModelProvider, ConnectionPool
+from dafne_dl.misc import calculate_stream_hash
+
+
+def init_model_function():
+    class WeightHolder:
+        def __init__(self):
+            self.weights = []
+
+        def get_weights(self):
+            return self.weights
+
+        def set_weights(self, weights):
+            self.weights = weights
+
+    return WeightHolder()
+
+
+def apply_model_function(model_obj, data):
+    return {}
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, model_bytes, handshake_delay):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.model_bytes = model_bytes
+        self.model_hash = calculate_stream_hash(io.BytesIO(model_bytes))
+        self.handshake_delay = handshake_delay
+        self.counter_lock = threading.Lock()
+        self.connections = 0
+        self.requests = Counter()
+
+    def reset_counters(self):
+        with self.counter_lock:
+            self.connections = 0
+            self.requests = Counter()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def setup(self):
+        super().setup()
+        with self.server.counter_lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: bytes, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        endpoint = self.path.strip('/')
+        with self.server.counter_lock:
+            self.server.requests[endpoint] += 1
+        if endpoint == 'info_model':
+            self._send(json.dumps({'latest_timestamp': 1, 'timestamps': [1], 'hash': self.server.model_hash,
+                                   'hashes': {'1': self.server.model_hash}}).encode())
+        elif endpoint == 'get_model':
+            self._send(self.server.model_bytes, 'application/octet-stream')
+        elif endpoint == 'get_available_models':
+            self._send(json.dumps({'models': ['benchmark']}).encode())
+        else:
+            self._send(json.dumps({'message': 'ok'}).encode())
+
+
+def time_calls(function, n_calls, n_threads):
+    latencies = []
+
+    def timed_call(_):
+        t = time.perf_counter()
+        function()
+        return time.perf_counter() - t
+
+    t = time.perf_counter()
+    with ThreadPoolExecutor(n_threads) as executor:
+        latencies.extend(executor.map(timed_call, range(n_calls)))
+    total = time.perf_counter() - t
+    return np.median(latencies) * 1000, np.percentile(latencies, 95) * 1000, n_calls / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200, help='number of requests per test')
+    parser.add_argument('--threads', type=int, default=4, help='number of concurrent client threads')
+    parser.add_argument('--handshake-ms', type=float, default=0, help='delay added to every new connection')
+    args = parser.parse_args()
+
+    model = DynamicDLModel('benchmark', init_model_function, apply_model_function,
+                           weights=[np.random.rand(1024).astype(np.float32)], timestamp_id=1)
+    server = StandInServer(model.dumps(), args.handshake_ms / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_base = f'http://127.0.0.1:{server.server_address[1]}/'
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        provider = RemoteModelProvider(temp_dir, url_base, 'key', temp_dir, cache_max_bytes=0,
+                                       connection_pool=ConnectionPool())
+
+        def unpooled_info():
+            requests.post(url_base + 'info_model', json={'model_type': 'benchmark', 'api_key': 'key'}).json()
+
+        tests = [
+            ('info_model, new connection', unpooled_info),
+            ('info_model, pooled', lambda: provider.model_details('benchmark')),
+            ('load_model (local copy), pooled', lambda: provider.load_model('benchmark')),
+        ]
+
+        print(f'{args.calls} calls, {args.threads} threads, handshake delay {args.handshake_ms} ms')
+        print(f'{"test":>32} {"median ms":>10} {"p95 ms":>8} {"calls/s":>8} {"connections":>12}  requests')
+        for name, function in tests:
+            with contextlib.redirect_stdout(io.StringIO()):  # silence the provider
+                function()  # warm up (and download the model once for load_model)
+                server.reset_counters()
+                median, p95, throughput = time_calls(function, args.calls, args.threads)
+            print(f'{name:>32} {median:10.2f} {p95:8.2f} {throughput:8.0f} {server.connections:12d}  '
+                  f'{dict(server.requests)}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
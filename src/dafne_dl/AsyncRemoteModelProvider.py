@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import IO, Callable, Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+from .interfaces import ModelProvider
+from .DynamicDLModel import DynamicDLModel
+from .RemoteModelProvider import RemoteModelProvider, DownloadCancelledError
+
+MAX_CONCURRENT_DOWNLOADS = 3
+
+
+class AsyncRemoteModelProvider(ModelProvider):
+    """
+    asyncio version of RemoteModelProvider: all the methods of the ModelProvider interface are coroutines.
+
+    The blocking requests of RemoteModelProvider run in a thread pool, so they share its connection pool, model cache,
+    hash index and resumable downloads. At most max_concurrent_downloads downloads run at the same time, and loads
+    of the same model are serialized, because they write the same files.
+    Cancelling a load_model task stops the download at the next received block; the partial file is kept, so a
+    later load resumes from it.
+    """
+
+    def __init__(self, models_path, url_base, api_key, temp_upload_dir, delete_old_models=True, cache_max_bytes=0,
+                 timeout=None, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS, max_workers=None):
+        """
+        Parameters
+        ----------
+        models_path, url_base, api_key, temp_upload_dir, delete_old_models, cache_max_bytes, timeout :
+            See RemoteModelProvider
+        max_concurrent_downloads : int
+            Maximum number of models downloaded at the same time
+        max_workers : int or None
+            Number of threads running the blocking requests. Default: max_concurrent_downloads + 4, so that metadata
+            requests do not wait for the downloads
+        """
+        self.provider = RemoteModelProvider(models_path, url_base, api_key, temp_upload_dir, delete_old_models,
+                                            cache_max_bytes, timeout)
+        self.max_concurrent_downloads = max_concurrent_downloads
+        if max_workers is None:
+            max_workers = max_concurrent_downloads + 4
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.model_locks: Dict[str, asyncio.Lock] = {}
+        self.download_semaphore = None  # created in the event loop by _get_semaphore
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self.download_semaphore is None:
+            self.download_semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+        return self.download_semaphore
+
+    def _get_model_lock(self, model_name: str) -> asyncio.Lock:
+        try:
+            return self.model_locks[model_name]
+        except KeyError:
+            lock = asyncio.Lock()
+            self.model_locks[model_name] = lock
+            return lock
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def load_model(self, model_name: str, progress_callback: Optional[Callable[[int, int], None]] = None,
+                         force_download: bool = False,
+                         timestamp: Optional[Union[int, str]] = None) -> DynamicDLModel:
+        """
+        Loads a model, downloading it if needed. See RemoteModelProvider.load_model
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model to load.
+        progress_callback: Callable[[int, int], None] (optional)
+            Callback function for progress. It is called in the event loop thread
+        force_download: bool
+            Sets the forced redownload of models
+        timestamp: int or None
+            Return a specific model version (default: latest)
+
+        Returns
+        -------
+        The model object, or None if the download failed.
+        """
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+
+        def thread_progress_callback(current_size, total_size):
+            # called in the download thread
+            if cancel_event.is_set():
+                raise DownloadCancelledError(f'Download of {model_name} cancelled')
+            if progress_callback is not None:
+                loop.call_soon_threadsafe(progress_callback, current_size, total_size)
+
+        async with self._get_model_lock(model_name), self._get_semaphore():
+            future = loop.run_in_executor(self.executor, partial(self.provider.load_model, model_name,
+                                                                 thread_progress_callback, force_download, timestamp))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # stop the thread and wait for it, so that the concurrency limit and the model lock stay valid
+                cancel_event.set()
+                try:
+                    await future
+                except Exception:
+                    pass
+                raise
+
+    async def load_models(self, model_names: Iterable[str],
+                          progress_callback: Optional[Callable[[str, int, int], None]] = None,
+                          force_download: bool = False) -> Dict[str, Optional[DynamicDLModel]]:
+        """
+        Loads the latest version of several models concurrently
+
+        Parameters
+        ----------
+        model_names : iterable of str
+            The models to load
+        progress_callback : Callable[[str, int, int], None] (optional)
+            Callback function for progress, receiving the model name, the current size and the total size
+        force_download : bool
+            Sets the forced redownload of models
+
+        Returns
+        -------
+        Dictionary model_name -> model (None if the download failed)
+        """
+        model_names = list(model_names)
+
+        def model_callback(model_name):
+            if progress_callback is None:
+                return None
+            return lambda current_size, total_size: progress_callback(model_name, current_size, total_size)
+
+        models = await asyncio.gather(*[self.load_model(name, model_callback(name), force_download)
+                                        for name in model_names])
+        return dict(zip(model_names, models))
+
+    async def model_details(self, model_name: str) -> dict:
+        return await self._run(self.provider.model_details, model_name)
+
+    async def available_models(self) -> Union[None, List[str]]:
+        return await self._run(self.provider.available_models)
+
+    async def upload_model(self, model_name: str, model: DynamicDLModel, dice_score: float = 0.0):
+        await self._run(self.provider.upload_model, model_name, model, dice_score)
+
+    async def upload_data(self, data: dict) -> None:
+        bytes_io = BytesIO()
+        await self._run(np.savez_compressed, bytes_io, **data)
+        await self._upload_bytes(bytes_io)
+        bytes_io.close()
+
+    async def _upload_bytes(self, data: IO):
+        await self._run(self.provider._upload_bytes, data)
+
+    async def log(self, msg: str):
+        await self._run(self.provider.log, msg)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -23,57 +23,112 @@ Such top level functions should define all the imports within themselves (i.e. d
 from __future__ import annotations
 
 import re
+import hashlib
+import threading
+from collections import OrderedDict
 
 from .interfaces import IncompatibleModelError, DeepLearningClass
+from .model_container import dump_container, load_container, is_container, peekable
+from .sparse_weights import sparsify_weights, densify_weights, has_sparse_layers
+from .quantization import quantize_weights, dequantize_weights
+from .common.tiling import TILE_OVERLAP, TILE_BATCH_SIZE, apply_tiled
 import dill
 from io import BytesIO
 import numpy as np
 import inspect
 import time
 
+FORMAT_DILL = 'dill'
+FORMAT_CONTAINER = 'container'
+
+APPLY_BATCH_SIZE = 8  # default number of images per forward pass of apply_batch
+
+# functions that are only written to the model file when they are defined, so that the file stays readable by versions
+# of the library that do not know them
+OPTIONAL_FUNCTIONS = ['apply_batch_function']
+
+
 def fn_to_source(function):
     """
     Given a function, returns it source. If the source cannot be retrieved, return the object itself
     """
     #print('Converting fn to source')
     if function is None: return None
+    # functions created by source_to_fn or already passed through set_internal_fn carry their source
+    src = getattr(function, 'source', None)
+    if type(src) == str:
+        return src
     try:
         return inspect.getsource(function)
     except OSError:
-        #print('Conversion failed!')
-        try:
-            src = function.source
-            #print('Returning embedded source')
-            return src
-        except:
-            pass
+        pass
     print('Getting source failed - Returning bytecode')
     return function # the source cannot be retrieved, return the object itself
 
 
-def source_to_fn(source, patches: dict = {}):
-    """
-    Given a source, return the (first) defined function. If the source is not a string, return the object itself
-    """
-    if type(source) is not str:
-        print("source to fn: source is not a string")
-        return source
-    #print("source to fn: source is string")
+# process-wide cache of the functions created by source_to_fn: hash of source and patches -> (code object, result)
+FUNCTION_CACHE_SIZE = 256
+_function_cache = OrderedDict()
+_function_cache_lock = threading.Lock()
+
+
+def _function_cache_key(source, patches):
+    hasher = hashlib.sha256(source.encode('utf-8'))
+    for search, replace in patches.items():
+        hasher.update(b'\0' + search.encode('utf-8') + b'\0' + replace.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def clear_function_cache():
+    with _function_cache_lock:
+        _function_cache.clear()
+
+
+def _compile_source(source, patches):
+    # returns (code object, first defined function or the source itself)
     for search, replace in patches.items():
         source = re.sub(search, replace, source)
 
     locs = {}
     globs = {}
     try:
-        exec(source, globs, locs)
+        code = compile(source, '<string>', 'exec')
+        exec(code, globs, locs)
     except:
-        return source # the string was just a string apparently, not valid code
+        return None, source # the string was just a string apparently, not valid code
     for k,v in locs.items():
         if callable(v):
             #print('source_to_fn. Found function', k)
             v.source = source
-            return v
-    return source
+            return code, v
+    return code, source
+
+
+def source_to_fn(source, patches: dict = {}):
+    """
+    Given a source, return the (first) defined function. If the source is not a string, return the object itself.
+    Results are cached, so a source that was already converted with the same patches is not parsed or compiled again
+    and the same function object is returned.
+    """
+    if type(source) is not str:
+        print("source to fn: source is not a string")
+        return source
+    #print("source to fn: source is string")
+    key = _function_cache_key(source, patches)
+    with _function_cache_lock:
+        try:
+            _function_cache.move_to_end(key)
+            return _function_cache[key][1]
+        except KeyError:
+            pass
+
+    code, result = _compile_source(source, patches)
+
+    with _function_cache_lock:
+        _function_cache[key] = (code, result)
+        while len(_function_cache) > FUNCTION_CACHE_SIZE:
+            _function_cache.popitem(last=False)
+    return result
 
 
 def default_keras_weights_to_model_function(modelObj: DynamicDLModel, weights):
@@ -134,11 +189,51 @@ def default_keras_weight_copy_function(weights_in):
     return weights_out
 
 
+def _is_default_function(function, default_function) -> bool:
+    # model functions loaded from a file are new objects, so they are compared by source
+    return function is default_function or fn_to_source(function) == fn_to_source(default_function)
+
+
+def _add_sparse_delta(lhs: DynamicDLModel, rhs: DynamicDLModel, rhs_weights) -> DynamicDLModel:
+    # default_keras_add_weights_function for a delta with sparse layers
+    if lhs.model_id != rhs.model_id: raise IncompatibleModelError
+    lhs_weights = lhs.get_weights()
+    newWeights = []
+    for depth in range(len(lhs_weights)):
+        newWeights.append(lhs_weights[depth] + rhs_weights[depth])
+    outputObj = lhs.get_empty_copy()
+    outputObj.set_weights(newWeights)
+    return outputObj
+
+
+def stack_outputs(outputs, axis=2):
+    """
+    Stacks the outputs of a model applied to several slices: the masks of segmenters are stacked along axis (empty
+    masks are used for the slices where a label is missing), other outputs are returned as a list
+    """
+    outputs = list(outputs)
+    if not outputs or not all(isinstance(output, dict) for output in outputs):
+        return outputs
+    labels = []
+    for output in outputs:
+        labels.extend(label for label in output if label not in labels)
+    stacked = {}
+    for label in labels:
+        reference = next(np.asarray(output[label]) for output in outputs if label in output)
+        stacked[label] = np.stack([np.asarray(output[label]) if label in output else np.zeros_like(reference)
+                                   for output in outputs], axis=axis)
+    return stacked
+
+
 class DynamicDLModel(DeepLearningClass):
 
     """
     Class to represent a deep learning model that can be serialized/deserialized
     """
+
+    # if True, the model is not initialized at construction time (see WeightsOnlyModel)
+    lazy_init = False
+
     def __init__(self, model_id,  # a unique ID to avoid mixing different models
                  init_model_function,  # inits the model. Accepts no parameters and returns the model
                  apply_model_function,  # function that applies the model. Has the object, and image
@@ -149,12 +244,14 @@ class DynamicDLModel(DeepLearningClass):
                  weight_copy_function = default_keras_weight_copy_function,  # create a deep copy of weights
                  factor_multiply_function = default_keras_multiply_function,
                  incremental_learn_function = None,  # function to perform an incremental learning step
+                 apply_batch_function = None,  # function that applies the model to a list of inputs. Has the object, and the list
                  weights = None,  # initial weights
                  timestamp_id = None,
                  is_delta = False):
         self.model = None
         self.model_id = model_id
         self.is_delta = is_delta
+        self.quantization = None  # quantization mode of the file the model was loaded from
 
         # lsit identifying the external functions that need to be saved with source and serialized
         self.function_mappings = [
@@ -167,6 +264,7 @@ class DynamicDLModel(DeepLearningClass):
             'weight_copy_function',
             'factor_multiply_function',
             'incremental_learn_function',
+            'apply_batch_function',
         ]
 
         # the following sets the internal attributes self.fn = fn, with additionally adding the source to the function
@@ -174,7 +272,8 @@ class DynamicDLModel(DeepLearningClass):
             self.set_internal_fn(fn_name, locals()[fn_name])
 
 
-        self.init_model() # initializes the model
+        if not self.lazy_init:
+            self.init_model() # initializes the model
         if timestamp_id is None:
             self.reset_timestamp()
         else:
@@ -184,7 +283,7 @@ class DynamicDLModel(DeepLearningClass):
 
     def set_internal_fn(self, internal_name, obj):
         #print('Setting', internal_name)
-        if callable(obj):
+        if callable(obj) and type(getattr(obj, 'source', None)) != str:
             src = fn_to_source(obj)
             if type(src) == str:
                 obj.source = src
@@ -218,10 +317,35 @@ class DynamicDLModel(DeepLearningClass):
         """
         self.weights_to_model_function(self, weights)
         
-    def get_weights(self):
+    def get_weights(self, sparse=False):
+        """
+        Returns the weights of the model, as returned by the model_to_weights_function
+
+        Parameters
+        ----------
+        sparse : bool
+            Return the layers stored in sparse form (see sparse_weights.py) as SparseLayer objects instead of dense
+            arrays. Only weights-only models loaded from a sparse delta hold such layers
+        """
         return self.model_to_weights_function(self)
         
+    def get_weights_snapshot(self):
+        """
+        Returns a copy of the weights that is not affected by later changes of the model (e.g. training). The default
+        keras model_to_weights_function already returns new arrays, so they are not copied a second time
+        """
+        weights = self.get_weights()
+        if _is_default_function(self.model_to_weights_function, default_keras_model_to_weights_function):
+            return weights
+        return self.weight_copy_function(weights)
+
     def apply_delta(self, other):
+        if isinstance(other, WeightsOnlyModel) and not other.is_initialized() and \
+                _is_default_function(self.apply_delta_function, default_keras_add_weights_function):
+            delta_weights = other.get_weights(sparse=True)
+            if has_sparse_layers(delta_weights):
+                # the default addition, with the sparse layers scatter-added into copies of the dense weights
+                return _add_sparse_delta(self, other, delta_weights)
         return self.apply_delta_function(self, other)
     
     def calc_delta(self, other, threshold=None):
@@ -230,13 +354,88 @@ class DynamicDLModel(DeepLearningClass):
     def apply(self, data):
         return self.apply_model_function(self, data)
 
+    def apply_batch(self, data_list, batch_size=None):
+        """
+        Applies the model to a list of inputs. If the model has an apply_batch_function, it receives up to batch_size
+        inputs at a time, otherwise apply is called on every input.
+
+        Parameters
+        ----------
+        data_list : list of dict
+            Inputs of the model, as for apply
+        batch_size : int or None
+            Maximum number of inputs passed to apply_batch_function at the same time. Default: APPLY_BATCH_SIZE
+
+        Returns
+        -------
+        list
+            The outputs of the model, in the order of the inputs
+        """
+        data_list = list(data_list)
+        if self.apply_batch_function is None:
+            return [self.apply(data) for data in data_list]
+        if batch_size is None:
+            batch_size = APPLY_BATCH_SIZE
+        outputs = []
+        for batch_start in range(0, len(data_list), batch_size):
+            outputs.extend(self.apply_batch_function(self, data_list[batch_start:batch_start + batch_size]))
+        return outputs
+
+    def apply_volume(self, data, batch_size=None, slice_axis=2):
+        """
+        Applies the model to all the slices of a volume
+
+        Parameters
+        ----------
+        data : dict
+            Input of the model, as for apply, where data['image'] is a volume. The other entries are passed unchanged
+            with every slice
+        batch_size : int or None
+            See apply_batch
+        slice_axis : int
+            Axis of data['image'] along which the volume is sliced
+
+        Returns
+        -------
+        For segmenters: dict[str, mask] with the 3D masks of the labels, stacked along slice_axis. Labels missing from
+            the output of some slices are empty in those slices
+        For classifiers: list of str with the label of every slice
+        """
+        volume = np.asarray(data['image'])
+        slice_data = [{**data, 'image': volume_slice} for volume_slice in np.moveaxis(volume, slice_axis, 0)]
+        return stack_outputs(self.apply_batch(slice_data, batch_size), slice_axis)
+
+    def apply_tiled(self, data, tile_size, overlap=TILE_OVERLAP, batch_size=TILE_BATCH_SIZE):
+        """
+        Segments an image larger than the field of view of the model with overlapping tiles, whose masks are blended
+        with a weighting window. See common.tiling.apply_tiled
+
+        Parameters
+        ----------
+        data : dict
+            Input of the model, as for apply
+        tile_size : int or (int, int)
+            Size of the tiles in pixels of data['image']
+        overlap : float
+            Minimum fraction of the tile size shared by neighboring tiles
+        batch_size : int
+            Number of tiles processed at the same time
+
+        Returns
+        -------
+        dict[str, mask]
+            The masks of the labels, with the shape of the image
+        """
+        return apply_tiled(lambda batch_data: self.apply_batch(batch_data, batch_size),
+                           data, tile_size, overlap, batch_size)
+
     def factor_multiply(self, factor: float):
         return self.factor_multiply_function(self, factor)
     
     def incremental_learn(self, trainingData, trainingOutputs, bs=5, minTrainImages=5):
         self.incremental_learn_function(self, trainingData, trainingOutputs, bs, minTrainImages)
         
-    def dump(self, file):
+    def dump(self, file, file_format=FORMAT_DILL, sparse_density_cutoff=None, quantization=None):
         """
         Dumps the current status of the object, including functions and weights
         
@@ -244,28 +443,57 @@ class DynamicDLModel(DeepLearningClass):
         ----------
         file:
             a file descriptor (open in writable mode)
+        file_format:
+            FORMAT_DILL (default): a single dill pickle, readable by all versions of the library.
+            FORMAT_CONTAINER: a metadata header followed by raw weight arrays, which can be memory-mapped on load
+            (see model_container.py).
+        sparse_density_cutoff:
+            None (default): weights are stored as dense arrays.
+            For deltas, layers where the fraction of nonzero elements is below this value (e.g. SPARSE_DENSITY_CUTOFF)
+            are stored in sparse form (see sparse_weights.py). Files with sparse layers can only be read by versions
+            of the library that support them.
+        quantization:
+            None (default): weights are stored with their data type.
+            QUANTIZATION_FLOAT16 or QUANTIZATION_INT8: floating point weights are quantized (see quantization.py) and
+            dequantized on load. Quantized files can only be read by versions of the library that support quantization.
 
         Returns
         -------
         Nothing
 
         """
+        if self.is_delta and sparse_density_cutoff is not None:
+            weights = sparsify_weights(self.get_weights(sparse=True), sparse_density_cutoff)
+        else:
+            weights = self.get_weights()
+        if quantization is not None:
+            weights = quantize_weights(weights, quantization)
+
         outputDict = {
             'model_id': self.model_id,
-            'weights': self.get_weights(),
+            'weights': weights,
             'timestamp_id': self.timestamp_id,
             'is_delta': self.is_delta
             }
+        if quantization is not None:
+            outputDict['quantization'] = quantization
 
         # add the internal functions to the dictionary
         for fn_name in self.function_mappings:
+            if fn_name in OPTIONAL_FUNCTIONS and getattr(self, fn_name) is None:
+                continue
             outputDict[fn_name] = fn_to_source(getattr(self, fn_name))
 
-        dill.dump(outputDict, file)
+        if file_format == FORMAT_DILL:
+            dill.dump(outputDict, file)
+        elif file_format == FORMAT_CONTAINER:
+            dump_container(outputDict, file)
+        else:
+            raise ValueError(f'Unknown file format {file_format}')
     
-    def dumps(self) -> bytes:
+    def dumps(self, file_format=FORMAT_DILL, sparse_density_cutoff=None, quantization=None) -> bytes:
         file = BytesIO()
-        self.dump(file)
+        self.dump(file, file_format, sparse_density_cutoff, quantization)
         return file.getvalue()
     
     def get_empty_copy(self) -> DynamicDLModel:
@@ -278,7 +506,7 @@ class DynamicDLModel(DeepLearningClass):
             Output copy
 
         """
-        new_model = DynamicDLModel(self.model_id, self.init_model_function, self.apply_model_function,
+        new_model = type(self)(self.model_id, self.init_model_function, self.apply_model_function,
                                    weights=None, timestamp_id=self.timestamp_id, is_delta=self.is_delta)
         for fn_name in self.function_mappings:
             new_model.set_internal_fn(fn_name, getattr(self, fn_name))
@@ -299,14 +527,18 @@ class DynamicDLModel(DeepLearningClass):
         return model_out
 
     @staticmethod
-    def Load(file) -> DynamicDLModel:
+    def Load(file, use_mmap=True, weights_only=False) -> DynamicDLModel:
         """
-        Creates an object from a file
+        Creates an object from a file. Both the dill format and the container format are supported.
 
         Parameters
         ----------
         file : file descriptor
-            A file descriptor.
+            A file descriptor. It does not need to be seekable (e.g. a pipe or a response body)
+        use_mmap : bool
+            For files in the container format, memory-map the weights instead of reading them
+        weights_only : bool
+            Return a WeightsOnlyModel, which only initializes the internal model when it is applied
 
         Returns
         -------
@@ -321,17 +553,31 @@ class DynamicDLModel(DeepLearningClass):
             'import dl': 'import dafne_dl'
         }
 
-        inputDict = dill.load(file)
+        file = peekable(file)
+        if is_container(file):
+            inputDict = load_container(file, use_mmap)
+        else:
+            inputDict = dill.load(file)
         for k,v in inputDict.items():
             if '_function' in k:
                 inputDict[k] = source_to_fn(v, patches) # convert the functions from source
 
+        quantization = inputDict.pop('quantization', None)
+        if quantization is not None:
+            inputDict['weights'] = dequantize_weights(inputDict['weights'])
+
         #print(inputDict)
-        outputObj = DynamicDLModel(**inputDict)
+        # sparse deltas are kept as weights-only models, so that apply_delta can use the sparse layers directly.
+        # get_weights returns them as dense arrays
+        if weights_only or has_sparse_layers(inputDict.get('weights')):
+            outputObj = WeightsOnlyModel(**inputDict)
+        else:
+            outputObj = DynamicDLModel(**inputDict)
+        outputObj.quantization = quantization
         return outputObj
         
     @staticmethod
-    def Loads(b: bytes) -> DynamicDLModel:
+    def Loads(b: bytes, weights_only=False) -> DynamicDLModel:
         """
         Creates an object from a binary dump
 
@@ -347,4 +593,77 @@ class DynamicDLModel(DeepLearningClass):
 
         """
         file = BytesIO(b)
-        return DynamicDLModel.Load(file)
+        return DynamicDLModel.Load(file, weights_only=weights_only)
+
+
+class WeightsOnlyModel(DynamicDLModel):
+    """
+    DynamicDLModel that only holds the weights until the model is actually needed.
+    The internal model is created by init_model, which is called automatically by apply and incremental_learn.
+    Until then, weight arithmetic (deltas, sums, factor multiplications, copies) works on the weights alone and
+    never builds a network. Serialization produces the same format as DynamicDLModel.
+    Note: before initialization, get_weights returns the stored weights and not a copy, except for the layers of a
+    sparse delta, which are returned as new dense arrays unless get_weights(sparse=True) is used.
+    """
+
+    lazy_init = True
+
+    def __init__(self, *args, **kwargs):
+        self.weights = None
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def from_model(model: DynamicDLModel, with_weights=True) -> WeightsOnlyModel:
+        """
+        Creates a weights-only model with the functions and (optionally) the weights of another model
+        """
+        new_model = WeightsOnlyModel(model.model_id, model.init_model_function, model.apply_model_function,
+                                     timestamp_id=model.timestamp_id, is_delta=model.is_delta)
+        for fn_name in model.function_mappings:
+            new_model.set_internal_fn(fn_name, getattr(model, fn_name))
+        if with_weights:
+            new_model.set_weights(model.get_weights())
+        return new_model
+
+    def is_initialized(self) -> bool:
+        return self.model is not None
+
+    def init_model(self):
+        super().init_model()
+        if self.weights is not None:
+            self.weights_to_model_function(self, densify_weights(self.weights))
+            self.weights = None
+
+    def set_weights(self, weights):
+        if self.model is None:
+            self.weights = weights
+        else:
+            super().set_weights(weights)
+
+    def get_weights(self, sparse=False):
+        if self.model is None:
+            if sparse or self.weights is None:
+                return self.weights
+            return densify_weights(self.weights)
+        return super().get_weights()
+
+    def get_weights_snapshot(self):
+        if self.model is None:
+            # the stored weights are returned by reference
+            return self.weight_copy_function(self.get_weights())
+        return super().get_weights_snapshot()
+
+    def apply(self, data):
+        if self.model is None:
+            self.init_model()
+        return super().apply(data)
+
+    def apply_batch(self, data_list, batch_size=None):
+        if self.model is None:
+            self.init_model()
+        return super().apply_batch(data_list, batch_size)
+
+    def incremental_learn(self, trainingData, trainingOutputs, bs=5, minTrainImages=5):
+        if self.model is None:
+            self.init_model()
+        super().incremental_learn(trainingData, trainingOutputs, bs, minTrainImages)
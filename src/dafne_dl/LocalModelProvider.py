@@ -16,29 +16,44 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import json
-import re
 from pathlib import Path
 
 from .interfaces import ModelProvider
 from .DynamicDLModel import DynamicDLModel
+from .misc import FileHashIndex
+from .model_cache import ModelCache
+from .model_manifest import ModelManifest
 from typing import Union, IO, List, Optional
 import os
 import datetime
 from typing import Callable
 
 
+HASH_INDEX_FILE = 'hash_index.json'
+
+
 class LocalModelProvider(ModelProvider):
 
-    def __init__(self, models_path, upload_dir):
+    def __init__(self, models_path, upload_dir, cache_max_bytes=0):
+        """
+        Parameters
+        ----------
+        models_path : str or Path
+            Directory containing the model files
+        upload_dir : str
+            Directory where uploaded data is saved
+        cache_max_bytes : int
+            Memory budget of the cache of loaded models (see model_cache.py). 0 (default) disables the cache.
+            Cached models are shared between load_model calls.
+        """
         self.models_path = Path(models_path)
         self.upload_dir = upload_dir
+        self.hash_index = FileHashIndex(self.models_path / HASH_INDEX_FILE)
+        self.model_cache = ModelCache(cache_max_bytes)
+        self.manifest = ModelManifest(self.models_path, self.hash_index)
 
     def get_model_names(self):
-        model_list = self.models_path.glob('*.model')
-        model_names = list(set([os.path.basename(s).split('_')[0] for s in
-                                model_list]))  # get the name of the model, which is the part of the file before the '_'
-        model_names = list(filter(None, model_names))  # remove any empty names
-        return model_names
+        return self.manifest.model_names()
 
     def load_model(self, model_name: str, progress_callback: Optional[Callable[[int, int], None]] = None,
                    force_download: bool = False,
@@ -63,35 +78,44 @@ class LocalModelProvider(ModelProvider):
 
         """
         print(f"Loading model: {model_name}")
-        model_file = sorted(list(self.models_path.glob(f"{model_name}_*.model")))
-        if len(model_file) == 0:
+        entry = self.manifest.get(model_name, timestamp)
+        if entry is None:
             raise FileNotFoundError("Could not find model file.")
+        model_to_load = entry['path']
 
-        model_to_load = None
-        if timestamp is None:
-            model_to_load = model_file[-1]
-        else:
-            for filename in model_file:
-                if str(timestamp) in filename:
-                    model_to_load = filename
-                    break
-
-        if model_to_load is None:
-            raise FileNotFoundError("Could not find model file.")
+        cache_key = (model_name, entry['timestamp'])
+        model = self.model_cache.get(cache_key)
+        if model is not None:
+            print('Using cached model', model_to_load)
+            return model
 
         print('Opening', model_to_load)
-        return DynamicDLModel.Load(open(model_to_load, 'rb'))
+        with open(model_to_load, 'rb') as f:
+            model = DynamicDLModel.Load(f)
+        self.model_cache.put(cache_key, model)
+        return model
 
-    def model_details(self, model_name: str) -> dict:
-        # get model versions
-        model_files = sorted(list(self.models_path.glob(f"{model_name}_*.model")))
-        timestamps = []
-        for filename in model_files:
-            try:
-                timestamps.append(re.match(r".*([0-9]+)\.model", filename).group(1))
-            except:
-                pass
+    def get_model_hash(self, model_name: str, timestamp: Optional[Union[int, str]] = None) -> str:
+        """
+        Returns the sha256 hash of a model file. The hash is only calculated if the file changed since the last call.
 
+        Parameters
+        ----------
+        model_name : str
+            The name of the model.
+        timestamp: int or None
+            The model version (default: latest)
+
+        Returns
+        -------
+        The hash as hex string.
+        """
+        file_hash = self.manifest.get_hash(model_name, timestamp)
+        if file_hash is None:
+            raise FileNotFoundError("Could not find model file.")
+        return file_hash
+
+    def model_details(self, model_name: str) -> dict:
         out_dict = {}
         json_file_name = f'{model_name}.json'
         try:
@@ -100,7 +124,11 @@ class LocalModelProvider(ModelProvider):
         except:
             pass
 
-        out_dict['timestamps'] = timestamps
+        # get model versions
+        out_dict['timestamps'] = self.manifest.timestamps(model_name)
+        latest_timestamp = self.manifest.latest_timestamp(model_name)
+        if latest_timestamp is not None:
+            out_dict['latest_timestamp'] = latest_timestamp
 
         return out_dict
 
@@ -117,6 +145,7 @@ class LocalModelProvider(ModelProvider):
         filename = f'{model_name}_{model.timestamp_id}.model'
         print('Saving', filename)
         model.dump(open(os.path.join(self.models_path, filename), 'wb'))
+        self.model_cache.invalidate((model_name, str(model.timestamp_id)))
 
     def _upload_bytes(self, data: IO):
         print("You are using the LocalModelProvider. Therefore no upload is done!")
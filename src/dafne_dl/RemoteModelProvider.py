@@ -15,85 +15,229 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
 import json
 import os
+import pickle
 from copy import copy
+from io import BytesIO
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 
-from .interfaces import ModelProvider
-from .DynamicDLModel import DynamicDLModel
+from .interfaces import ModelProvider, IncompatibleModelError
+from .DynamicDLModel import DynamicDLModel, WeightsOnlyModel
 from typing import IO, Callable, List, Union, Optional
 import threading
 import time
 import datetime
-from .misc import calculate_file_hash
-
-UPLOAD_RETRIES = 3
-TIME_BETWEEN_RETRIES = 10
-
-
-def upload_model(url_base, filename, model_name, api_key, dice):
-    print('Calculating hash...')
-    file_hash = calculate_file_hash(filename)
-    print(file_hash)
-    for retries in range(UPLOAD_RETRIES):
-        print(f"Sending {filename}")
-        with open(filename, 'rb') as f:
-            files = {'model_binary': f}
-            r = requests.post(url_base + "upload_model",
-                              files=files,
-                              data={"model_type": model_name,
-                                    "api_key": api_key,
-                                    "dice": dice,
-                                    "hash": file_hash})
-        print(f"status code: {r.status_code}")
-        try:
-            print(f"message: {r.json()['message']}")
-        except:
-            pass
+from .misc import calculate_file_hash, FileHashIndex, update_hash_from_stream
+from .model_cache import ModelCache
+from .upload_queue import UploadQueue, UploadError
+from .streaming_upload import stream_model_upload
+from concurrent.futures import ThreadPoolExecutor, wait
+
+HASH_INDEX_FILE = 'hash_index.json'
+
+UPLOAD_WORKERS = 2  # maximum number of concurrent uploads
+UPLOAD_JOURNAL_DIR = 'upload_journal'  # subdirectory of temp_upload_dir with the pending uploads
+UPLOAD_KIND_MODEL = 'model'
+UPLOAD_KIND_DATA = 'data'
+
+CONNECT_TIMEOUT = 10  # seconds to establish a connection
+READ_TIMEOUT = 120  # seconds between bytes received from the server
+POOL_MAXSIZE = 10  # maximum number of kept-alive connections per host
+
+DOWNLOAD_RETRIES = 3  # attempts to complete an interrupted download
+DOWNLOAD_RETRY_DELAY = 2  # seconds before the first retry of an interrupted download, doubled at every retry
+DOWNLOAD_BLOCK_SIZE = 1024*1024  # 1 MB
+PART_SUFFIX = '.part'  # suffix of the files being downloaded
+DELTA_PART_SUFFIX = '.delta.part'  # suffix of the models being rebuilt from a delta
+
+
+class DownloadCancelledError(Exception):
+    """
+    Raised by a progress callback to stop a download. The partial file of a full download is kept, so a later load
+    resumes from it
+    """
+    pass
+
+
+def _parse_content_range(content_range):
+    """
+    Parses a 'bytes start-end/total' Content-Range header. Returns (start, total), where total is None if unknown
+    """
+    try:
+        unit, byte_range = content_range.split(' ', 1)
+        range_part, total = byte_range.split('/', 1)
+        start = int(range_part.split('-', 1)[0])
+        return start, None if total.strip() == '*' else int(total)
+    except ValueError:
+        return None, None
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive connections to the server.
+    requests.Session objects are not guaranteed to be thread-safe, so every thread gets its own session, and all the
+    sessions share the same HTTPAdapter, whose connection pool is thread-safe. Connections are therefore reused across
+    calls and threads, avoiding a new TCP/TLS handshake for every request.
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_maxsize=POOL_MAXSIZE):
+        """
+        Parameters
+        ----------
+        timeout : float or (float, float)
+            Default timeout of the requests, either a single value or a (connect, read) tuple. None: wait forever
+        pool_maxsize : int
+            Maximum number of connections kept alive per host
+        """
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.local = threading.local()
 
-        if r.status_code == 200:
-            print("upload successful") # success
-            break
-        print('Upload error')
-        time.sleep(TIME_BETWEEN_RETRIES)
-    os.remove(filename)
-
-
-def upload_data(url_base, filename, api_key):
-    for retries in range(UPLOAD_RETRIES):
-        print(f"Sending {filename}")
-        with open(filename, 'rb') as f:
-            files = {'data_binary': f}
-            r = requests.post(url_base + "upload_data",
-                              files=files,
-                              data={"api_key": api_key})
-        print(f"status code: {r.status_code}")
+    @property
+    def session(self) -> requests.Session:
         try:
-            print(f"message: {r.json()['message']}")
-        except:
-            pass
-
-        if r.status_code == 200:
-            print("upload successful") # success
-            break
-        print('Upload error')
-        time.sleep(TIME_BETWEEN_RETRIES)
-    os.remove(filename)
+            return self.local.session
+        except AttributeError:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.local.session = session
+            return session
+
+    def post(self, url, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> ConnectionPool:
+    """
+    Returns the connection pool shared by the providers that do not define their own
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+def _print_response(r):
+    print(f"status code: {r.status_code}")
+    try:
+        print(f"message: {r.json()['message']}")
+    except:
+        pass
+
+
+def send_model_file(url_base, filename, model_name, api_key, dice, file_hash, connection_pool=None) -> requests.Response:
+    """
+    Sends a model file to the server (single attempt)
+    """
+    if connection_pool is None:
+        connection_pool = get_default_pool()
+    print(f"Sending {filename}")
+    with open(filename, 'rb') as f:
+        files = {'model_binary': f}
+        r = connection_pool.post(url_base + "upload_model",
+                                 files=files,
+                                 data={"model_type": model_name,
+                                       "api_key": api_key,
+                                       "dice": dice,
+                                       "hash": file_hash})
+    _print_response(r)
+    return r
+
+
+def send_data_file(url_base, filename, api_key, connection_pool=None) -> requests.Response:
+    """
+    Sends a data file to the server (single attempt)
+    """
+    if connection_pool is None:
+        connection_pool = get_default_pool()
+    print(f"Sending {filename}")
+    with open(filename, 'rb') as f:
+        files = {'data_binary': f}
+        r = connection_pool.post(url_base + "upload_data",
+                                 files=files,
+                                 data={"api_key": api_key})
+    _print_response(r)
+    return r
 
 
 class RemoteModelProvider(ModelProvider):
     
-    def __init__(self, models_path, url_base, api_key, temp_upload_dir, delete_old_models = True):
+    def __init__(self, models_path, url_base, api_key, temp_upload_dir, delete_old_models = True, cache_max_bytes = 0,
+                 timeout = None, connection_pool: Optional[ConnectionPool] = None, upload_workers = UPLOAD_WORKERS,
+                 upload_journal_dir = None, streaming_upload = True, delta_download = True):
+        """
+        Parameters
+        ----------
+        models_path : str or Path
+            Directory where the downloaded models are stored
+        url_base : str
+            Base url of the server
+        api_key : str
+            Api key for the server
+        temp_upload_dir : str
+            Directory for temporary files during uploads
+        delete_old_models : bool
+            Delete the older versions of a model after downloading a new one
+        cache_max_bytes : int
+            Memory budget of the cache of loaded models (see model_cache.py). 0 (default) disables the cache.
+            Cached models are shared between load_model calls.
+        timeout : float or (float, float) or None
+            Timeout of the requests, either a single value or a (connect, read) tuple. None: the timeout of the
+            connection pool
+        connection_pool : ConnectionPool or None
+            Pool of keep-alive connections. Default: the pool shared by all providers
+        upload_workers : int
+            Maximum number of concurrent uploads
+        upload_journal_dir : str or None
+            Directory of the journal of pending uploads (see upload_queue.py), which are resumed when a provider is
+            created. Default: temp_upload_dir/upload_journal
+        streaming_upload : bool
+            Send models while they are serialized, without temporary files (see streaming_upload.py). If a streaming
+            upload fails, the model is saved to temp_upload_dir and sent through the upload queue, which retries it
+            and survives restarts. Streaming uploads in progress are not journaled.
+        delta_download : bool
+            When a previous version of a model is available locally, download only the delta from it (endpoint
+            get_model_delta) and apply it. If the server does not provide the delta, or the delta does not fit the
+            local model, the full model is downloaded. Default: True
+        """
         self.models_path = Path(models_path)
         self.url_base = url_base
         self.api_key = api_key
         self.temp_upload_dir = temp_upload_dir
         self.delete_old_models = delete_old_models
         os.makedirs(self.models_path, exist_ok=True)
+        self.hash_index = FileHashIndex(self.models_path / HASH_INDEX_FILE)
+        self.model_cache = ModelCache(cache_max_bytes)
+        self.connection_pool = connection_pool if connection_pool is not None else get_default_pool()
+        self.timeout = timeout if timeout is not None else self.connection_pool.timeout
+        if upload_journal_dir is None:
+            upload_journal_dir = os.path.join(self.temp_upload_dir, UPLOAD_JOURNAL_DIR)
+        self.upload_queue = UploadQueue(upload_journal_dir, self._send_upload, upload_workers)
+        self.streaming_upload = streaming_upload
+        self.delta_download = delta_download
+        self.streaming_executor = ThreadPoolExecutor(upload_workers)
+        self.streaming_futures = set()
+        self.streaming_lock = threading.Lock()
         print(f"Config: {self.url_base}, {self.api_key}")
 
+    def _post(self, url, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.connection_pool.post(url, **kwargs)
+
     def load_model(self, model_name: str, progress_callback: Optional[Callable[[int, int], None]] = None,
                    force_download: bool = False,
                    timestamp: Optional[Union[int,str]] = None) -> DynamicDLModel:
@@ -122,16 +266,18 @@ class RemoteModelProvider(ModelProvider):
         if json_content is None:
             return None
 
-        # Get the name of the latest model
-        r = requests.post(self.url_base + "info_model",
-                          json={"model_type": model_name,
-                                "api_key": self.api_key})
-
         if timestamp is None:
             timestamp = json_content['latest_timestamp']
 
         timestamp = str(timestamp)
 
+        cache_key = (model_name, timestamp)
+        if not force_download:
+            model = self.model_cache.get(cache_key)
+            if model is not None:
+                print('Using cached model')
+                return model
+
         try:
             hash_dict = json_content['hashes']
             file_hash_remote = hash_dict[timestamp]
@@ -142,53 +288,35 @@ class RemoteModelProvider(ModelProvider):
         local_model_path = self.models_path / f"{model_name}_{timestamp}.model"
         if os.path.exists(local_model_path) and not force_download:
             print("Model already downloaded. Checking hash...")
-            file_hash_local = calculate_file_hash(local_model_path)
+            file_hash_local = self.hash_index.get_hash(local_model_path)
             if file_hash_local == file_hash_remote:
                 print('Model exists, skipping download')
                 model = DynamicDLModel.Load(open(local_model_path, 'rb'))
+                self.model_cache.put(cache_key, model)
                 return model
             else:
                 print('Local model is corrupt')
                 os.remove(local_model_path)
 
-        print("Downloading new model...")
+        downloaded = False
+        if self.delta_download and not force_download:
+            downloaded = self._download_delta(model_name, timestamp, local_model_path, file_hash_remote,
+                                              json_content.get('hashes', {}), progress_callback)
 
-        # Receive model
-        r = requests.post(self.url_base + "get_model",
-                          json={"model_type": model_name,
-                                "timestamp": timestamp,
-                                "api_key": self.api_key},
-                          stream=True)
-        success = False
-        if r.ok:
-            success = True
-            total_size_in_bytes = int(r.headers.get('content-length', 0))
-            print("Size to download:", total_size_in_bytes)
-            block_size = 1024*1024  # 1 MB
-            current_size = 0
-            with open(local_model_path, 'wb') as file:
-                for data in r.iter_content(block_size):
-                    current_size += len(data)
-                    #print(current_size)
-                    if progress_callback is not None:
-                        progress_callback(current_size, total_size_in_bytes)
-                    file.write(data)
-
-            print("Downloaded size", current_size)
-            file_hash_local = calculate_file_hash(local_model_path)
+        if not downloaded:
+            print("Downloading new model...")
+            downloaded = self._download_model(model_name, timestamp, local_model_path, file_hash_remote,
+                                              progress_callback, force_download)
 
-            if current_size != total_size_in_bytes or file_hash_local != file_hash_remote:
-                print("Download failed!")
-                os.remove(local_model_path)
-                success = False
-
-        if success:
+        if downloaded:
             print('Model check OK')
             model = DynamicDLModel.Load(open(local_model_path, "rb"))
+            self.model_cache.put(cache_key, model)
 
             if self.delete_old_models:
-                # Deleting older models
-                old_models = self.models_path.glob(f"{model_name}_*.model")
+                # Deleting older models and their interrupted downloads
+                old_models = list(self.models_path.glob(f"{model_name}_*.model")) + \
+                             list(self.models_path.glob(f"{model_name}_*.model.part"))
                 print("Deleting old models: ")
                 for old_model in old_models:
                     if old_model != local_model_path:
@@ -196,20 +324,228 @@ class RemoteModelProvider(ModelProvider):
                         os.remove(old_model)
             return model
         else:
-            print("ERROR: Request to server failed")
-            print(f"status code: {r.status_code}")
-            try:
-                print(f"message: {r.json()['message']}")
-            except:
-                pass
             return None
 
+    def _find_delta_base(self, model_name: str, timestamp: str, remote_hashes: dict) -> Optional[str]:
+        """
+        Returns the timestamp of the newest local version of a model older than timestamp, whose hash matches the one
+        of the server (if known), or None
+        """
+        try:
+            target = int(timestamp)
+        except ValueError:
+            return None
+        candidates = []
+        for model_file in self.models_path.glob(f"{model_name}_*.model"):
+            try:
+                local_timestamp = int(model_file.stem[len(model_name) + 1:])
+            except ValueError:
+                continue
+            if local_timestamp < target:
+                candidates.append((local_timestamp, model_file))
+        for local_timestamp, model_file in sorted(candidates, reverse=True):
+            remote_hash = remote_hashes.get(str(local_timestamp))
+            if remote_hash is None or self.hash_index.get_hash(model_file) == remote_hash:
+                return str(local_timestamp)
+        return None
+
+    def _download_delta(self, model_name: str, timestamp: str, local_model_path: Path, file_hash_remote: str,
+                        remote_hashes: dict, progress_callback: Optional[Callable[[int, int], None]] = None) -> bool:
+        """
+        Downloads the delta between a local version of a model and the requested version, applies it and writes the
+        result to local_model_path.
+
+        The rebuilt model is not compared with the hash of the file on the server: base + (new - base) is generally
+        not bit-identical to the new weights in floating point, and the serialized bytes differ as well. Instead, the
+        structure of the delta is validated (delta flag, base version, model id, layer shapes). The rebuilt file is
+        stored in the hash index with file_hash_remote, the hash of the version it represents, so it is recognized as
+        that version by later loads and can be the base of the next delta.
+
+        Returns
+        -------
+        True if the model was obtained from the delta
+        """
+        base_timestamp = self._find_delta_base(model_name, timestamp, remote_hashes)
+        if base_timestamp is None:
+            return False
+
+        print(f"Downloading delta from version {base_timestamp}...")
+        part_path = Path(str(local_model_path) + DELTA_PART_SUFFIX)
+        try:
+            r = self._post(self.url_base + "get_model_delta",
+                           json={"model_type": model_name,
+                                 "timestamp": timestamp,
+                                 "base_timestamp": base_timestamp,
+                                 "api_key": self.api_key},
+                           stream=True)
+            with r:
+                if not r.ok:
+                    print("Delta not available")
+                    _print_response(r)
+                    return False
+                total_size_in_bytes = int(r.headers.get('content-length', 0))
+                delta_data = BytesIO()
+                for data in r.iter_content(DOWNLOAD_BLOCK_SIZE):
+                    delta_data.write(data)
+                    if progress_callback is not None:
+                        progress_callback(delta_data.tell(), total_size_in_bytes)
+            print("Delta size", delta_data.tell())
+
+            delta = DynamicDLModel.Loads(delta_data.getvalue(), weights_only=True)
+            del delta_data
+            if not delta.is_delta or str(delta.timestamp_id) != base_timestamp:
+                print("The delta does not apply to the local model")
+                return False
+
+            base_path = self.models_path / f"{model_name}_{base_timestamp}.model"
+            with open(base_path, 'rb') as f:
+                base_model = DynamicDLModel.Load(f, weights_only=True)
+            base_shapes = [tuple(layer.shape) for layer in base_model.get_weights()]
+            delta_shapes = [tuple(layer.shape) for layer in delta.get_weights(sparse=True)]
+            if delta.model_id != base_model.model_id or delta_shapes != base_shapes:
+                print("The delta does not match the structure of the local model")
+                return False
+            new_model = base_model.apply_delta(delta)
+            new_model.timestamp_id = int(timestamp)
+            del base_model, delta
+
+            with open(part_path, 'wb') as f:
+                new_model.dump(f)
+        except DownloadCancelledError:
+            # the load is cancelled: do not fall back to the full download
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        except (requests.exceptions.RequestException, OSError, ValueError, EOFError, pickle.UnpicklingError,
+                IncompatibleModelError) as e:
+            print("Delta download failed:", e)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return False
+
+        os.replace(part_path, local_model_path)
+        self.hash_index.store(local_model_path, file_hash_remote)
+        print("Model updated from delta")
+        return True
+
+    def _download_model(self, model_name: str, timestamp: str, local_model_path: Path, file_hash_remote: str,
+                        progress_callback: Optional[Callable[[int, int], None]] = None,
+                        force_download: bool = False) -> bool:
+        """
+        Downloads a model into a .part file, resuming a previous interrupted download with a HTTP Range request if the
+        file exists. The data is hashed while it is received, and the file is renamed to local_model_path only after
+        its size and hash are verified. Interrupted attempts are retried with exponential backoff.
+
+        Note: get_model is a POST endpoint, and many servers (e.g. Flask/Werkzeug send_file) only honour Range
+        headers on GET and HEAD requests. Resuming therefore requires the server to answer the Range header of the
+        get_model request with 206 Partial Content; otherwise it answers 200 and the whole file is downloaded again.
+
+        Returns
+        -------
+        True if the model was downloaded successfully
+        """
+        part_path = Path(str(local_model_path) + PART_SUFFIX)
+        if force_download and os.path.exists(part_path):
+            os.remove(part_path)
+
+        backoff = False
+        for attempt in range(DOWNLOAD_RETRIES):
+            if backoff:
+                delay = DOWNLOAD_RETRY_DELAY * 2 ** (attempt - 1)
+                print(f"Retrying download in {delay} s")
+                time.sleep(delay)
+            backoff = True  # cleared when the next attempt should start immediately
+            hasher = hashlib.sha256()
+            current_size = 0
+            headers = {}
+            if os.path.exists(part_path):
+                with open(part_path, 'rb') as f:
+                    current_size = update_hash_from_stream(hasher, f)
+                if current_size > 0:
+                    print("Resuming download from byte", current_size)
+                    headers['Range'] = f'bytes={current_size}-'
+
+            try:
+                r = self._post(self.url_base + "get_model",
+                               json={"model_type": model_name,
+                                     "timestamp": timestamp,
+                                     "api_key": self.api_key},
+                               headers=headers,
+                               stream=True)
+                with r:
+                    if r.status_code == 416:
+                        # the partial file is not consistent with the model on the server
+                        print("Cannot resume download")
+                        os.remove(part_path)
+                        backoff = False
+                        continue
+
+                    if not r.ok:
+                        print("ERROR: Request to server failed")
+                        print(f"status code: {r.status_code}")
+                        try:
+                            print(f"message: {r.json()['message']}")
+                        except:
+                            pass
+                        return False
+
+                    content_length = int(r.headers.get('content-length', 0))
+                    if r.status_code == 206:
+                        range_start, total_size_in_bytes = _parse_content_range(r.headers.get('content-range', ''))
+                        if range_start != current_size:
+                            print("Unexpected range received")
+                            os.remove(part_path)
+                            backoff = False
+                            continue
+                        if total_size_in_bytes is None:
+                            total_size_in_bytes = current_size + content_length
+                        file_mode = 'ab'
+                    else:
+                        # the server sent the whole file
+                        if current_size > 0:
+                            print("The server does not support resuming downloads. Downloading the whole model")
+                        hasher = hashlib.sha256()
+                        current_size = 0
+                        total_size_in_bytes = content_length
+                        file_mode = 'wb'
+
+                    print("Size to download:", total_size_in_bytes - current_size)
+                    with open(part_path, file_mode) as file:
+                        for data in r.iter_content(DOWNLOAD_BLOCK_SIZE):
+                            file.write(data)
+                            hasher.update(data)
+                            current_size += len(data)
+                            if progress_callback is not None:
+                                progress_callback(current_size, total_size_in_bytes)
+            except requests.exceptions.RequestException as e:
+                # keep the partial file and resume from it
+                print("Download interrupted:", e)
+                continue
+
+            print("Downloaded size", current_size)
+            if current_size < total_size_in_bytes:
+                print("Download incomplete")
+                continue
+
+            file_hash_local = hasher.hexdigest()
+            if current_size != total_size_in_bytes or file_hash_local != file_hash_remote:
+                print("Download failed!")
+                os.remove(part_path)
+                return False
+
+            os.replace(part_path, local_model_path)
+            self.hash_index.store(local_model_path, file_hash_local)
+            return True
+
+        print("ERROR: Download failed after", DOWNLOAD_RETRIES, "attempts")
+        return False
+
     def model_details(self, model_name: str) -> dict:
         # get model versions
         # Get the name of the latest model
-        r = requests.post(self.url_base + "info_model",
-                          json={"model_type": model_name,
-                                "api_key": self.api_key})
+        r = self._post(self.url_base + "info_model",
+                       json={"model_type": model_name,
+                             "api_key": self.api_key})
         if r.ok:
             json_content = r.json()
         else:
@@ -237,8 +573,8 @@ class RemoteModelProvider(ModelProvider):
         return json_content
 
     def available_models(self) -> Union[None, List[str]]:
-        r = requests.post(self.url_base + "get_available_models",
-                          json={"api_key": self.api_key})
+        r = self._post(self.url_base + "get_available_models",
+                       json={"api_key": self.api_key})
         if r.ok:
             models = r.json()['models']
             return models
@@ -261,27 +597,102 @@ class RemoteModelProvider(ModelProvider):
             model: DynamicDLModel
         """
         print("Uploading model...")
+        if not self.streaming_upload:
+            self._queue_model_upload(model_name, model, dice_score)
+            return
+        # snapshot of the weights, as the caller may keep training the model during the upload
+        snapshot = WeightsOnlyModel.from_model(model, with_weights=False)
+        snapshot.set_weights(model.get_weights_snapshot())
+        future = self.streaming_executor.submit(self._stream_model_upload, model_name, snapshot, dice_score)
+        with self.streaming_lock:
+            self.streaming_futures.add(future)
+        future.add_done_callback(self._streaming_done)
+
+    def _streaming_done(self, future):
+        with self.streaming_lock:
+            self.streaming_futures.discard(future)
+
+    def _queue_model_upload(self, model_name: str, model: DynamicDLModel, dice_score: float):
         filename_out = os.path.join(self.temp_upload_dir, f'{model_name}_{model.timestamp_id}.model')
-        model.dump(open(filename_out, 'wb'))
-        upload_thread = threading.Thread(target=upload_model, args=(self.url_base, filename_out, model_name,
-                                                                    self.api_key, dice_score))
-        upload_thread.start()
+        with open(filename_out, 'wb') as f:
+            model.dump(f)
+        self.upload_queue.submit(UPLOAD_KIND_MODEL, filename_out, {'model_name': model_name, 'dice': dice_score})
+
+    def _stream_model_upload(self, model_name: str, model: DynamicDLModel, dice_score: float):
+        print("Streaming model upload")
+        try:
+            r, file_hash = stream_model_upload(self.connection_pool, self.url_base + "upload_model", model,
+                                               'model_binary', f'{model_name}_{model.timestamp_id}.model',
+                                               {"model_type": model_name,
+                                                "api_key": self.api_key,
+                                                "dice": dice_score})
+            _print_response(r)
+            if r.status_code == 200:
+                print("upload successful")
+                return
+            if r.status_code == 401:
+                return  # invalid api key: the fallback would fail as well
+        except Exception as e:
+            print("Streaming upload failed:", e)
+        print("Falling back to upload from file")
+        self._queue_model_upload(model_name, model, dice_score)
 
     def _upload_bytes(self, data: IO):
         # Note: the don't pass data directly to requests because the byte stream is not at the start.
         # Use getbuffer or getvalue instead. See https://github.com/psf/requests/issues/2589
         print("Uploading data")
-        filename = datetime.datetime.now().strftime("data_%Y%m%d_%H%M%S.npz")
+        filename = datetime.datetime.now().strftime("data_%Y%m%d_%H%M%S_%f.npz")
         filename_out = os.path.join(self.temp_upload_dir, filename)
         with open(filename_out, 'wb') as f:
             f.write(data.getbuffer())
-        upload_thread = threading.Thread(target=upload_data, args=(self.url_base, filename_out, self.api_key))
-        upload_thread.start()
+        self.upload_queue.submit(UPLOAD_KIND_DATA, filename_out)
+
+    def _send_upload(self, job: dict):
+        # send function of the upload queue
+        filename = job['filename']
+        if not os.path.exists(filename):
+            raise UploadError('File not found', retryable=False)
+        params = job['params']
+        if job['kind'] == UPLOAD_KIND_MODEL:
+            if 'hash' not in params:
+                print('Calculating hash...')
+                params['hash'] = calculate_file_hash(filename)
+            r = send_model_file(self.url_base, filename, params['model_name'], self.api_key, params['dice'],
+                                params['hash'], self.connection_pool)
+        else:
+            r = send_data_file(self.url_base, filename, self.api_key, self.connection_pool)
+        if r.status_code == 200:
+            print("upload successful")
+            return
+        # client errors (e.g. invalid api key) are not retried, except timeouts and rate limits
+        raise UploadError(f'status code {r.status_code}', retryable=r.status_code >= 500 or r.status_code in (408, 429))
+
+    def flush_uploads(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until all the uploads are completed or failed. Returns False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.streaming_lock:
+            streaming_futures = list(self.streaming_futures)
+        _, not_done = wait(streaming_futures, timeout)
+        if not_done:
+            return False
+        return self.upload_queue.flush(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def get_upload_status(self) -> dict:
+        """
+        Returns the number of pending, in progress, failed and completed uploads, and the list of the uploads that
+        are not completed. See UploadQueue.get_status. 'streaming' is the number of streaming uploads in progress
+        """
+        status = self.upload_queue.get_status()
+        with self.streaming_lock:
+            status['streaming'] = len(self.streaming_futures)
+        return status
 
     def log(self, msg: str):
-        r = requests.post(self.url_base + "log",
-                        json={"api_key": self.api_key,
-                              "message": str(msg)})
+        r = self._post(self.url_base + "log",
+                       json={"api_key": self.api_key,
+                             "message": str(msg)})
 
         if not r.ok:
             if r.status_code == 401:
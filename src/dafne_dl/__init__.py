@@ -35,6 +35,8 @@ if not flexidep.is_frozen():
         dm = flexidep.DependencyManager(config_file=f)
     dm.install_auto()
 
-from .DynamicDLModel import DynamicDLModel
+from .DynamicDLModel import DynamicDLModel, WeightsOnlyModel
 from .LocalModelProvider import LocalModelProvider
-from .RemoteModelProvider import RemoteModelProvider
\ No newline at end of file
+from .RemoteModelProvider import RemoteModelProvider
+from .AsyncRemoteModelProvider import AsyncRemoteModelProvider
+from .inference_server import InferenceServer
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Streaming aggregation of client models (or deltas) for federated learning.
+Models are added one at a time to a running accumulator, so a client model can be released as soon as it has been
+added, and the memory usage does not depend on the number of clients.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable, Union, Tuple
+
+import numpy as np
+
+from .interfaces import IncompatibleModelError
+from .DynamicDLModel import DynamicDLModel, WeightsOnlyModel
+from .flat_weights import FlatWeights, linear_combination
+
+METHOD_MEAN = 'mean'
+METHOD_TRIMMED_MEAN = 'trimmed_mean'
+
+
+class ModelAggregator:
+    """
+    Running weighted aggregation of models.
+
+    Methods:
+        METHOD_MEAN: weighted mean. Memory: the accumulator plus the model being added (about two models).
+        METHOD_TRIMMED_MEAN: weighted mean of every weight element after discarding its `trim` lowest and `trim`
+            highest values among the clients (tied values are ranked in the order the models were added). Memory:
+            additionally 6 * trim models for the extreme values, their weights and the indices of their models.
+    """
+
+    def __init__(self, method=METHOD_MEAN, trim=1):
+        if method not in (METHOD_MEAN, METHOD_TRIMMED_MEAN):
+            raise ValueError(f'Unknown aggregation method {method}')
+        if method == METHOD_TRIMMED_MEAN and trim < 1:
+            raise ValueError('trim must be at least 1 for the trimmed mean')
+        self.method = method
+        self.trim = trim if method == METHOD_TRIMMED_MEAN else 0
+        self.n_models = 0
+        self.total_weight = 0.0
+        self.template = None
+        self.accumulator = None
+        # for the trimmed mean: lowest/highest values of every element, the corresponding weights and the indices of
+        # the models they come from
+        self.low_values = []
+        self.low_weights = []
+        self.low_indices = []
+        self.high_values = []
+        self.high_weights = []
+        self.high_indices = []
+
+    def _check_compatible(self, model: DynamicDLModel):
+        if model.model_id != self.template.model_id:
+            raise IncompatibleModelError('Cannot aggregate models with different IDs')
+        if model.is_delta != self.template.is_delta:
+            raise IncompatibleModelError('Cannot aggregate models and deltas')
+        if model.is_delta and model.timestamp_id != self.template.timestamp_id:
+            raise IncompatibleModelError('Cannot aggregate deltas with different base models')
+
+    def add(self, model: DynamicDLModel, weight: float = 1.0):
+        """
+        Adds a model to the aggregation
+
+        Parameters
+        ----------
+        model : DynamicDLModel
+            A model or a delta. All the added objects must have the same model_id, and either all be full models or
+            all be deltas from the same base
+        weight : float
+            Weight of the model, for example the dice score of the client
+        """
+        if weight < 0:
+            raise ValueError('Weights must be non-negative')
+        if self.template is None:
+            self.template = WeightsOnlyModel.from_model(model, with_weights=False)
+        else:
+            self._check_compatible(model)
+
+        weights = model.get_weights()
+        if self.accumulator is None:
+            self.accumulator = linear_combination([(weight, weights)])
+        else:
+            self.accumulator.axpy(weight, weights)
+
+        if self.trim > 0:
+            self._update_extremes(weights, weight)
+
+        self.total_weight += weight
+        self.n_models += 1
+
+    def _update_extremes(self, weights, weight):
+        values = FlatWeights.copy_of(weights).buffer
+        if not self.low_values:
+            for extremes in (self.low_values, self.high_values):
+                fill_value = np.inf if extremes is self.low_values else -np.inf
+                for _ in range(self.trim):
+                    extremes.append(np.full_like(values, fill_value))
+            for extreme_weights in (self.low_weights, self.high_weights):
+                for _ in range(self.trim):
+                    extreme_weights.append(np.zeros(values.shape, dtype=np.float32))
+            for extreme_indices in (self.low_indices, self.high_indices):
+                fill_index = np.iinfo(np.int32).max if extreme_indices is self.low_indices else -1
+                for _ in range(self.trim):
+                    extreme_indices.append(np.full(values.shape, fill_index, dtype=np.int32))
+
+        for extremes, extreme_weights, extreme_indices, is_low in (
+                (self.low_values, self.low_weights, self.low_indices, True),
+                (self.high_values, self.high_weights, self.high_indices, False)):
+            # insert the new values in the sorted lists of extremes. The element pushed out continues down the list.
+            # Elements are ranked by (value, model index), so ties are broken by insertion order on both sides and a
+            # model never occupies both a low and a high slot of the same element
+            current_values = values.copy() if is_low else values
+            current_weights = np.full(values.shape, weight, dtype=np.float32)
+            current_indices = np.full(values.shape, self.n_models, dtype=np.int32)
+            for rank in range(self.trim):
+                if is_low:
+                    swap = (current_values < extremes[rank]) | \
+                           ((current_values == extremes[rank]) & (current_indices < extreme_indices[rank]))
+                else:
+                    swap = (current_values > extremes[rank]) | \
+                           ((current_values == extremes[rank]) & (current_indices > extreme_indices[rank]))
+                swapped_values = extremes[rank][swap]
+                swapped_weights = extreme_weights[rank][swap]
+                swapped_indices = extreme_indices[rank][swap]
+                extremes[rank][swap] = current_values[swap]
+                extreme_weights[rank][swap] = current_weights[swap]
+                extreme_indices[rank][swap] = current_indices[swap]
+                current_values[swap] = swapped_values
+                current_weights[swap] = swapped_weights
+                current_indices[swap] = swapped_indices
+
+    def add_all(self, models: Iterable[Union[DynamicDLModel, Tuple[DynamicDLModel, float]]]):
+        """
+        Adds models from an iterable of models or (model, weight) tuples
+        """
+        for item in models:
+            if isinstance(item, tuple):
+                self.add(*item)
+            else:
+                self.add(item)
+
+    def result(self) -> DynamicDLModel:
+        """
+        Returns the aggregated model (a WeightsOnlyModel, which is a DynamicDLModel). For deltas, the result is a
+        delta from the same base.
+        """
+        if self.n_models == 0:
+            raise ValueError('No models were added')
+        if self.n_models <= 2 * self.trim:
+            raise ValueError(f'The trimmed mean needs more than {2 * self.trim} models')
+
+        aggregated = self.accumulator.copy()
+        if self.trim == 0:
+            if self.total_weight <= 0:
+                raise ValueError('The sum of the weights must be positive')
+            aggregated.scale(1 / self.total_weight)
+        else:
+            weight_sum = np.full(aggregated.buffer.shape, self.total_weight, dtype=np.float64)
+            for extremes, extreme_weights in ((self.low_values, self.low_weights),
+                                              (self.high_values, self.high_weights)):
+                for values, weights in zip(extremes, extreme_weights):
+                    aggregated.buffer -= weights * values
+                    weight_sum -= weights
+            if np.any(weight_sum <= 0):
+                raise ValueError('The sum of the weights of the models remaining after trimming must be positive')
+            aggregated.buffer /= weight_sum
+
+        output_model = self.template.get_empty_copy()
+        output_model.set_weights(aggregated)
+        if not output_model.is_delta:
+            output_model.reset_timestamp()
+        return output_model
+
+
+def aggregate_models(models: Iterable[Union[DynamicDLModel, Tuple[DynamicDLModel, float]]],
+                     method=METHOD_MEAN, trim=1) -> DynamicDLModel:
+    """
+    Aggregates models or deltas from an iterable (e.g. a generator loading one model at a time)
+
+    Parameters
+    ----------
+    models : iterable of DynamicDLModel or of (DynamicDLModel, weight) tuples
+        The models to aggregate. Models without weight have weight 1
+    method : str
+        METHOD_MEAN or METHOD_TRIMMED_MEAN
+    trim : int
+        For the trimmed mean, number of lowest and highest values discarded for every weight element
+
+    Returns
+    -------
+    DynamicDLModel
+        The aggregated model
+    """
+    aggregator = ModelAggregator(method, trim)
+    aggregator.add_all(models)
+    return aggregator.result()
@@ -18,16 +18,24 @@
 from tensorflow.keras.utils import Sequence
 import numpy as np
 import os
+import threading
+import time
+
+from .sharded_store import ShardedTrainingStore, list_npy_ids
 
-# This is NOT a general implementation! See the number of masks below
 class DataGeneratorDir(Sequence):
-    def __init__(self, path, list_X=list(range(1, 4501)), batch_size=20, dim=(432, 432), shuffle=True):
+    def __init__(self, path, list_X=None, batch_size=20, dim=None, shuffle=True):
         'Initialization'
-        self.dim = dim
+        if list_X is None:
+            list_X = list_npy_ids(path)
         self.batch_size = batch_size
         self.list_X = list_X
         self.path = path
         self.shuffle = shuffle
+        # get the image size and the number of labels from the first sample
+        sample_shape = np.load(os.path.join(path, 'train_' + str(list_X[0]) + '.npy'), mmap_mode='r').shape
+        self.dim = tuple(dim) if dim is not None else sample_shape[:2]
+        self.n_labels = sample_shape[2] - 2
         self.on_epoch_end()
 
     def __len__(self):
@@ -57,7 +65,7 @@ class DataGeneratorDir(Sequence):
         'Generates data containing batch_size samples'
         # Initialization
         X = np.empty((self.batch_size, *self.dim, 2))
-        y = np.empty((self.batch_size, *self.dim, 13)) # chenge this to be generic!
+        y = np.empty((self.batch_size, *self.dim, self.n_labels))
 
         # Generate data
         for i, j in enumerate(list_X_temp):
@@ -71,17 +79,106 @@ class DataGeneratorDir(Sequence):
 
         return X, y
 
+
+class DataGeneratorShards(Sequence):
+    """
+    Data generator reading from a sharded store (see sharded_store.py). Batches are read by fancy-indexing the
+    memory-mapped shards, without opening a file per sample.
+    """
+    def __init__(self, store, list_X=None, batch_size=20, shuffle=True):
+        'Initialization'
+        if not isinstance(store, ShardedTrainingStore):
+            store = ShardedTrainingStore(store)
+        self.store = store
+        self.list_X = list_X if list_X is not None else list(store.ids)
+        self.batch_size = batch_size
+        self.dim = store.sample_shape[:2]
+        self.n_labels = store.n_labels
+        self.shuffle = shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        'Denotes the number of batches per epoch'
+        return int(np.floor(len(self.list_X) / self.batch_size))
+
+    def __getitem__(self, index):
+        'Generate one batch of data'
+        indexes = self.indexes[index * self.batch_size:(index + 1) * self.batch_size]
+        list_X_temp = [self.list_X[k] for k in indexes]
+        batch = self.store.gather(list_X_temp)
+        X = batch[..., [0, -1]]
+        y = batch[..., 1:-1]
+        return X, y
+
+    def on_epoch_end(self):
+        'Updates indexes after each epoch'
+        self.indexes = np.arange(len(self.list_X))
+        if self.shuffle == True:
+            np.random.shuffle(self.indexes)
+
+
+# number of batch buffers that DataGeneratorMem recycles (0: a new batch is allocated every time). A buffer is
+# overwritten n_buffers batches after it was returned, so recycling is only safe if the consumer keeps fewer than
+# n_buffers batches in flight (a Keras enqueuer with workers may keep many)
+DEFAULT_BATCH_BUFFERS = 0
+
+
 class DataGeneratorMem(Sequence):
-    def __init__(self, training_data_list, list_X=list(range(1, 4501)), batch_size=20, dim=(432, 432), shuffle=True):
+    def __init__(self, training_data_list, list_X=list(range(1, 4501)), batch_size=20, dim=(432, 432), shuffle=True,
+                 dtype=np.float32, stack=False, n_buffers=DEFAULT_BATCH_BUFFERS):
+        """
+        Data generator from a list of training arrays in memory
+
+        Parameters
+        ----------
+        training_data_list : list of np.ndarray
+            Arrays of shape (H, W, C) as returned by input_creation_mem
+        list_X : list of int
+            Indices of the arrays of training_data_list to use
+        batch_size : int
+            Number of samples in a batch
+        dim : tuple
+            Size of the images
+        shuffle : bool
+            Shuffle the samples at the end of every epoch
+        dtype :
+            Data type of the batches
+        stack : bool
+            Copy the training data into contiguous stacked arrays once. Batches are then single gathers, or views if
+            the samples of the batch are consecutive
+        n_buffers : int
+            Number of preallocated batch buffers that are recycled. 0 (default) allocates new arrays for every batch.
+            A returned batch is overwritten n_buffers batches later, so use this only with consumers that do not keep
+            more than n_buffers - 1 batches in flight
+        """
         print('Data Generator Initialization. Data list len:', len(training_data_list))
-        print('list_X', list_X)
         self.dim = dim
         self.batch_size = batch_size
         self.list_X = list_X
         self.training_data_list = training_data_list
         self.shuffle = shuffle
-        self.on_epoch_end()
+        self.dtype = np.dtype(dtype)
         self.n_labels = training_data_list[0].shape[2]-2
+        self.on_epoch_end()
+
+        self.stacked_X = None
+        self.stacked_y = None
+        if stack:
+            # the stacked batches are gathered without bound checks, so the ids are checked once here
+            ids = np.asarray(list_X)
+            invalid = ids[(ids < 0) | (ids >= len(training_data_list))]
+            if invalid.size > 0:
+                raise IndexError(f'{invalid.size} sample ids are outside the training data (0 to '
+                                 f'{len(training_data_list) - 1}), e.g. {invalid[0]}')
+            self.stacked_X = np.empty((len(training_data_list), *self.dim, 2), dtype=self.dtype)
+            self.stacked_y = np.empty((len(training_data_list), *self.dim, self.n_labels), dtype=self.dtype)
+            for i, arr in enumerate(training_data_list):
+                self._copy_sample(arr, self.stacked_X[i], self.stacked_y[i])
+
+        self.n_buffers = n_buffers
+        self.buffers = [self._allocate_batch() for _ in range(n_buffers)]
+        self.next_buffer = 0
+        self.buffer_lock = threading.Lock()
 
     def __len__(self):
         'Denotes the number of batches per epoch'
@@ -94,7 +191,6 @@ class DataGeneratorMem(Sequence):
 
         # Find list of IDs
         list_X_temp = [self.list_X[k] for k in indexes]
-        print("list_X_temp", list_X_temp)
 
         # Generate data
         X, y = self.__data_generation(list_X_temp)
@@ -107,22 +203,201 @@ class DataGeneratorMem(Sequence):
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
+    def _allocate_batch(self):
+        return (np.empty((self.batch_size, *self.dim, 2), dtype=self.dtype),
+                np.empty((self.batch_size, *self.dim, self.n_labels), dtype=self.dtype))
+
+    def _get_batch_buffers(self):
+        if self.n_buffers == 0:
+            return self._allocate_batch()
+        with self.buffer_lock:
+            buffers = self.buffers[self.next_buffer]
+            self.next_buffer = (self.next_buffer + 1) % self.n_buffers
+        return buffers
+
+    @staticmethod
+    def _copy_sample(arr, X, y):
+        X[:, :, 0] = arr[:, :, 0]
+        X[:, :, 1] = arr[:, :, -1]
+        y[:] = arr[:, :, 1:-1]
+
     def __data_generation(self, list_X_temp):
         'Generates data containing batch_size samples'
-        # Initialization
-        X = np.empty((self.batch_size, *self.dim, 2))
-        y = np.empty((self.batch_size, *self.dim, self.n_labels))
+        if self.stacked_X is not None:
+            ids = np.asarray(list_X_temp, dtype=np.intp)
+            if np.all(np.diff(ids) == 1):
+                # consecutive samples: the batch is a view of the stacked data
+                return self.stacked_X[ids[0]:ids[-1]+1], self.stacked_y[ids[0]:ids[-1]+1]
+            X, y = self._get_batch_buffers()
+            # mode='clip' avoids the internal buffering of np.take. The ids were checked in __init__
+            np.take(self.stacked_X, ids, axis=0, out=X, mode='clip')
+            np.take(self.stacked_y, ids, axis=0, out=y, mode='clip')
+            return X, y
 
-        # Generate data
+        X, y = self._get_batch_buffers()
         for i, j in enumerate(list_X_temp):
-            # Store sample
-            arr = self.training_data_list[j]
+            self._copy_sample(self.training_data_list[j], X[i], y[i])
 
-            #X[i,] = np.stack([arr[:, :, 0], arr[:, :, -1]], axis=-1)
-            X[i, :, :, 0] = arr[:, :, 0]
-            X[i, :, :, 1] = arr[:, :, -1]
+        return X, y
 
-            # Store class
-            y[i,] = arr[:, :, 1:-1]
 
-        return X, y
+PREFETCH_QUEUE_SIZE = 4  # default number of batches prepared in advance
+
+
+class PrefetchingDataGenerator(Sequence):
+    """
+    Wraps a data generator and prepares the next batches in background threads while the model is training.
+    Batches are expected to be requested in order (0, 1, 2...), as Keras does. A request for any other batch is
+    served synchronously and restarts the prefetching from there.
+    """
+    def __init__(self, generator, n_workers=2, queue_size=None):
+        """
+        Parameters
+        ----------
+        generator : Sequence
+            The wrapped data generator. Its __getitem__ must be thread safe
+        n_workers : int
+            Number of worker threads
+        queue_size : int or None
+            Maximum number of batches that are ready or being prepared at any time. Default: PREFETCH_QUEUE_SIZE, or
+            the largest size compatible with the batch buffers recycled by the generator (n_buffers - 2)
+        """
+        n_buffers = getattr(generator, 'n_buffers', 0)
+        if queue_size is None:
+            queue_size = min(PREFETCH_QUEUE_SIZE, n_buffers - 2) if n_buffers else PREFETCH_QUEUE_SIZE
+            queue_size = max(queue_size, 1)
+        if n_buffers and n_buffers <= queue_size + 1:
+            raise ValueError(f'The wrapped generator recycles {n_buffers} batch buffers, which would be overwritten '
+                             f'while queued. Use n_buffers > {queue_size + 1} or n_buffers = 0.')
+        self.generator = generator
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+
+        self.condition = threading.Condition()
+        self.ready = {}  # batch index -> (batch, exception)
+        self.pending = set()  # indices of the current generation that are being prepared
+        self.in_flight = 0
+        self.next_to_submit = 0
+        self.generation = 0  # incremented whenever the queued batches become invalid
+        self.stopped = False
+        self.reset_stats()
+
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __len__(self):
+        return len(self.generator)
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (self.next_to_submit >= len(self.generator) or
+                                            self.in_flight + len(self.ready) >= self.queue_size):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                index = self.next_to_submit
+                generation = self.generation
+                self.next_to_submit += 1
+                self.in_flight += 1
+                self.pending.add(index)
+
+            batch = None
+            exception = None
+            try:
+                batch = self.generator[index]
+            except Exception as e:
+                exception = e
+
+            with self.condition:
+                self.in_flight -= 1
+                if generation == self.generation:
+                    self.pending.discard(index)
+                    self.ready[index] = (batch, exception)
+                self.condition.notify_all()
+
+    def _restart_from(self, index):
+        # must be called with the condition acquired
+        self.generation += 1
+        self.ready.clear()
+        self.pending.clear()
+        self.next_to_submit = index
+        self.condition.notify_all()
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.generator):
+            raise IndexError(f'Batch index {index} out of range')
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError('The prefetching generator has been closed')
+            # batches that were skipped will never be requested and would take up space in the queue
+            for skipped in [k for k in self.ready if k < index]:
+                del self.ready[skipped]
+            self.stats['requests'] += 1
+            self.stats['queue_depth_sum'] += len(self.ready)
+            queued = index in self.ready or index in self.pending or index == self.next_to_submit
+            if queued:
+                if index not in self.ready:
+                    self.stats['starved'] += 1
+                    wait_start = time.perf_counter()
+                    while index not in self.ready:
+                        if self.stopped:
+                            raise RuntimeError('The prefetching generator has been closed')
+                        self.condition.wait()
+                    self.stats['wait_time'] += time.perf_counter() - wait_start
+                batch, exception = self.ready.pop(index)
+                self.condition.notify_all()
+            else:
+                self.stats['out_of_order'] += 1
+                self._restart_from(index + 1)
+
+        if not queued:
+            return self.generator[index]
+        if exception is not None:
+            raise exception
+        return batch
+
+    def on_epoch_end(self):
+        with self.condition:
+            # stop submitting batches of the old epoch until the wrapped generator has reshuffled
+            self._restart_from(len(self.generator))
+        self.generator.on_epoch_end()
+        with self.condition:
+            self._restart_from(0)
+
+    def reset_stats(self):
+        self.stats = {
+            'requests': 0,  # number of batches requested
+            'starved': 0,  # number of requests where the batch was not ready yet
+            'wait_time': 0.0,  # total time spent waiting for batches, in seconds
+            'out_of_order': 0,  # number of requests that could not be served by the prefetching
+            'queue_depth_sum': 0  # sum of the number of ready batches at every request
+        }
+
+    def get_stats(self):
+        """
+        Returns the queue starvation statistics since the creation or the last reset_stats
+        """
+        stats = dict(self.stats)
+        requests = max(stats['requests'], 1)
+        stats['starved_fraction'] = stats['starved'] / requests
+        stats['mean_wait_time'] = stats['wait_time'] / requests
+        stats['mean_queue_depth'] = stats.pop('queue_depth_sum') / requests
+        return stats
+
+    def close(self):
+        """
+        Stops the worker threads. Requests waiting for a batch raise RuntimeError
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
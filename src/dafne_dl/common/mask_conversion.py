@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Conversions between stacks of binary masks (one-hot, channels last) and label maps.
+# All the functions work on single images (H, W, C) as well as on batches (N, H, W, C), and images need not be square.
+
+import numpy as np
+
+
+def onehot_to_labels(onehot, first_channel=0, n_channels=None, dtype=np.intp):
+    """
+    Converts a one-hot stack into a label map with a single argmax over the last axis
+
+    Parameters
+    ----------
+    onehot : np.ndarray
+        Array of shape (..., C)
+    first_channel : int
+        First channel belonging to the masks (e.g. 1 if channel 0 contains the image)
+    n_channels : int or None
+        Number of mask channels to consider. Default: all the channels after first_channel
+    dtype :
+        Data type of the output
+
+    Returns
+    -------
+    np.ndarray
+        Label map of shape onehot.shape[:-1], where the value is the index of the channel relative to first_channel
+    """
+    last_channel = None if n_channels is None else first_channel + n_channels
+    return np.argmax(onehot[..., first_channel:last_channel], axis=-1).astype(dtype, copy=False)
+
+
+def labels_to_onehot(labels, n_channels, dtype=np.uint8):
+    """
+    Converts a label map into a one-hot stack
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Label map of any shape. Values are rounded to the nearest integer and must be in [0, n_channels)
+    n_channels : int
+        Number of channels of the output
+    dtype :
+        Data type of the output
+
+    Returns
+    -------
+    np.ndarray
+        One-hot array of shape labels.shape + (n_channels,)
+    """
+    labels = np.rint(labels).astype(np.intp) if np.issubdtype(np.asarray(labels).dtype, np.floating) \
+        else np.asarray(labels, dtype=np.intp)
+    if labels.size > 0 and (labels.min() < 0 or labels.max() >= n_channels):
+        raise ValueError(f'Labels must be in the range [0, {n_channels})')
+    onehot = np.zeros(labels.shape + (n_channels,), dtype=dtype)
+    np.put_along_axis(onehot, labels[..., np.newaxis], 1, axis=-1)
+    return onehot
+
+
+def count_labels(labels, n_labels):
+    """
+    Counts the number of pixels of each label in every image of a batch
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Label map of shape (H, W) or batch of label maps of shape (N, H, W). Values outside [0, n_labels) are ignored
+    n_labels : int
+        Number of labels to count
+
+    Returns
+    -------
+    np.ndarray
+        Array of counts of shape (n_labels,) for a single image, or (N, n_labels) for a batch
+    """
+    labels = np.asarray(labels)
+    single = labels.ndim == 2
+    if single:
+        labels = labels[np.newaxis]
+    labels = np.rint(labels).astype(np.intp).reshape(labels.shape[0], -1)
+    valid = (labels >= 0) & (labels < n_labels)
+    # offset the labels of each image so that a single bincount counts all the images at once
+    offsets = np.arange(labels.shape[0])[:, np.newaxis] * n_labels
+    counts = np.bincount((labels + offsets)[valid], minlength=labels.shape[0] * n_labels)
+    counts = counts.reshape(labels.shape[0], n_labels)
+    return counts[0] if single else counts
@@ -20,21 +20,26 @@ import os
 import skimage
 from skimage.morphology import square
 from .padorcut import padorcut
+from .mask_conversion import onehot_to_labels, labels_to_onehot, count_labels
 from . import biascorrection
-from scipy.ndimage import zoom
+from scipy.ndimage import zoom, distance_transform_edt
 import math
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from typing import Optional
 from skimage.filters import threshold_otsu
 import tensorflow as tf
 from tensorflow.keras import backend as K
 
 
 #convert an array of masks into a single numbered mask
-def to_mask(categorical_mask,dim,ch):  ##ch: number of labels. ch = 13 for thigh, 7 for leg
-    segmentation_mask=np.zeros((dim,dim))
-    for i in range(categorical_mask.shape[1]):
-        for j in range(categorical_mask.shape[1]):
-            segmentation_mask[i,j]=categorical_mask[i,j,1:ch+1].argmax()
-    return segmentation_mask
+def to_mask(categorical_mask,dim=None,ch=None):  ##ch: number of labels. ch = 13 for thigh, 7 for leg
+    """
+    Converts an array whose channel 0 is the image and channels 1..ch are the masks into a label map.
+    Works on single images (H, W, C) and batches (N, H, W, C). dim is unused and only kept for compatibility.
+    """
+    return onehot_to_labels(categorical_mask, first_channel=1, n_channels=ch, dtype=np.float64)
 
 
 def split_mirror(image):
@@ -110,23 +115,25 @@ def split_mirror(image):
 
 # returns arrays with number of pixels corresponding to a class and total number of pixels of the images containing that class
 def compute_class_frequencies(path,dim,card,ch):
-    classes=[0]*ch
-    images_containing_class=[0]*ch
+    classes=np.zeros(ch, dtype=np.int64)
+    images_containing_class=np.zeros(ch, dtype=np.int64)
     for j in range(1,card+1):
         arr=np.load(os.path.join(path,'train_'+str(j)+'.npy'))
         if arr.shape[2]==2:
             seg=arr[:,:,1] 
         else:
             seg=to_mask(arr,dim,ch)
-        for class_ in range(ch):
-            n_pixels=(seg==float(class_)).sum()
-            if n_pixels>0:
-                classes[class_]+=n_pixels
-                images_containing_class[class_]+=dim**2
-    return classes,images_containing_class
+        n_pixels=count_labels(seg,ch)
+        classes+=n_pixels
+        images_containing_class[n_pixels>0]+=seg.size
+    return classes.tolist(),images_containing_class.tolist()
 
 
-def calc_weight(img, seg, av, freq, dim, band, ch):
+def calc_weight_legacy(img, seg, av, freq, dim, band, ch):
+    '''
+    Reference implementation of the weight map: for every foreground pixel, grow a search radius along the four
+    axial directions until a border with two other ROIs is found. Very slow, kept for comparison.
+    '''
     W = np.zeros((seg.shape[0], seg.shape[1]), dtype='float32')
     global_thresh = threshold_otsu(img)
     binary_global = img > global_thresh  # image to binary mask
@@ -187,7 +194,68 @@ def calc_weight(img, seg, av, freq, dim, band, ch):
     return W
 
 
-def input_creation(path,card,dim,band,ch):
+def calc_weight_edt(img, seg, av, freq, dim, band, ch):
+    '''
+    Vectorized weight map. The distances to the nearest and second-nearest foreign ROI are obtained from one
+    Euclidean distance transform per label instead of a per-pixel search. Distances are Euclidean rather than
+    measured along the four axes, so the result matches calc_weight_legacy within a tolerance, not exactly.
+    '''
+    labels = np.rint(seg).astype(np.intp)
+    global_thresh = threshold_otsu(img)
+    binary_mask = img > global_thresh  # image to binary mask
+    maximum_l = min(3 * np.sqrt(band), max(seg.shape) - 1)
+
+    # running smallest and second smallest distance to a label different from the one of the pixel
+    d1 = np.full(labels.shape, np.inf)
+    d2 = np.full(labels.shape, np.inf)
+    for label in np.unique(labels):
+        if label == 0:
+            continue
+        dist = distance_transform_edt(labels != label)
+        dist[labels == label] = np.inf  # a ROI is not foreign to itself
+        np.minimum(d2, np.maximum(d1, dist), out=d2)
+        np.minimum(d1, dist, out=d1)
+
+    # if no two borders are found within maximum_l, the legacy algorithm sets the distance to the image size
+    found = d2 < maximum_l
+    distance_sum = np.where(found, d1 + d2, max(seg.shape))
+    W = np.where(binary_mask, 10 * np.exp(-(distance_sum ** 2) / (2 * band)), 0)
+    with np.errstate(divide='ignore'):
+        W += av / np.asarray(freq, dtype=np.float64)[labels]
+    return W.astype('float32')
+
+
+WEIGHT_ENGINES = {
+    'legacy': calc_weight_legacy,
+    'edt': calc_weight_edt
+}
+
+# the edt engine matches the legacy one within the tolerances of tests/test_preprocess_train.py. It is the default, so
+# that the incremental learning functions of the models, which call input_creation_mem without an engine, use it
+DEFAULT_WEIGHT_ENGINE = 'edt'
+
+
+def calc_weight(img, seg, av, freq, dim, band, ch, engine=DEFAULT_WEIGHT_ENGINE):
+    '''
+    Calculates the weight map of a slice with the selected engine (see WEIGHT_ENGINES)
+    '''
+    try:
+        weight_function = WEIGHT_ENGINES[engine]
+    except KeyError:
+        raise ValueError(f'Unknown weight engine {engine}. Valid engines: {list(WEIGHT_ENGINES)}')
+    return weight_function(img, seg, av, freq, dim, band, ch)
+
+
+def categorical_and_weight(img, seg, av, freq, dim, band, ch, engine=DEFAULT_WEIGHT_ENGINE):
+    '''
+    Converts a label map to a stack of ch binary masks and appends the weight map as last channel
+    '''
+    categ = labels_to_onehot(seg, ch, dtype=np.float64)
+    weight = calc_weight(img, seg, av, freq, dim, band, ch, engine)
+    return np.concatenate([categ, weight[:, :, np.newaxis]], axis=-1)
+
+
+def input_creation(path,card,dim,band,ch,weight_engine=DEFAULT_WEIGHT_ENGINE):
     '''
     Creates the training data with labels categorization and creation of weights maps.
     '''
@@ -203,8 +271,8 @@ def input_creation(path,card,dim,band,ch):
            seg=arr[:,:,1] 
         else:
            seg=to_mask(arr,dim,ch)
-        categ=categorical_and_weight(img,seg,av,frequencies,dim,band,ch)
-        arr=np.concatenate([np.reshape(img,(dim,dim,1)),categ],axis=-1)
+        categ=categorical_and_weight(img,seg,av,frequencies,dim,band,ch,weight_engine)
+        arr=np.concatenate([img[:,:,np.newaxis],categ],axis=-1)
         np.save(os.path.join(path,'train_'+str(j)+'.npy'),arr)
 
 
@@ -224,7 +292,42 @@ def calc_aggregated_masks_and_remove_overlap(masks):
 
     return aggregated_mask, masks
 
-def input_creation_mem(image_list: list, mask_list: list, band: float):
+def _remove_overlap_and_count_labels(masks):
+    """
+    Per-slice map step of input_creation_mem: removes the overlaps and counts the pixels of every label
+    """
+    aggregated_mask, masks = calc_aggregated_masks_and_remove_overlap(masks)
+    return aggregated_mask, masks, count_labels(aggregated_mask, masks.shape[2])
+
+
+def _slice_training_data(img, seg, masks, av, frequencies, band, weight_engine):
+    """
+    Per-slice map step of input_creation_mem: calculates the weights and assembles the training array
+    """
+    ch = masks.shape[2]
+    weight = calc_weight(img, seg, av, frequencies, masks.shape[0], band, ch, weight_engine)
+    return np.concatenate([img[:, :, np.newaxis], masks, weight[:, :, np.newaxis]], axis=-1)
+
+
+def _class_frequencies(label_counts, pixels_per_slice):
+    """
+    Gather step of input_creation_mem: reduces the per-slice label counts to the class frequencies
+    """
+    label_counts = np.stack(label_counts)
+    classes = label_counts.sum(axis=0)
+    images_containing_class = ((label_counts > 0) * pixels_per_slice).sum(axis=0)
+
+    frequencies = []
+    for cla, ima in zip(classes.tolist(), images_containing_class.tolist()):
+        if cla == 0:
+            frequencies.append(0)
+        else:
+            frequencies.append(cla / ima)
+    return frequencies
+
+
+def input_creation_mem(image_list: list, mask_list: list, band: float, weight_engine: str = DEFAULT_WEIGHT_ENGINE,
+                       max_workers: Optional[int] = 1, chunksize: int = 1, executor: Optional[Executor] = None):
     """
     Creates the training data in memory
 
@@ -232,50 +335,41 @@ def input_creation_mem(image_list: list, mask_list: list, band: float):
         image_list: list of 2D slices (input data)
         mask_list: list of 3D np arrays (stacks of segmented 2D masks). All the masks must have the same number of layers (ROIs)
         band: scalar parameter for the calculation of the weights
+        weight_engine: algorithm for the calculation of the weights (see WEIGHT_ENGINES)
+        max_workers: number of processes used for the per-slice calculations. 1 (default) runs everything in the
+            current process, None uses all the available cores
+        chunksize: number of slices sent to a worker process at once
+        executor: an existing concurrent.futures.Executor to use instead of creating a new process pool
 
     Output:
          list of 3D arrays where: arr[:,:,0] are the base images, arr[:,:,-1] are the weights, and the dimensions in between are the masks
     """
 
-    dim = mask_list[0].shape[0]
     ch = mask_list[0].shape[2]
 
-    aggregated_masks = []
-    mask_list_no_overlap = []
-    for masks in mask_list:
-        agg, new_masks = calc_aggregated_masks_and_remove_overlap(masks)
-        aggregated_masks.append(agg)
-        mask_list_no_overlap.append(new_masks)
+    if executor is None and max_workers != 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as process_pool:
+            return input_creation_mem(image_list, mask_list, band, weight_engine, chunksize=chunksize,
+                                      executor=process_pool)
 
-    # compute class frequencies
-    classes = [0] * ch
-    images_containing_class = [0] * ch
-    for seg in aggregated_masks:
-        for class_ in range(ch):
-            n_pixels = (seg == float(class_)).sum()
-            if n_pixels > 0:
-                classes[class_] += n_pixels
-                images_containing_class[class_] += dim ** 2
+    if executor is None:
+        map_slices = map
+    else:
+        map_slices = partial(executor.map, chunksize=chunksize)
 
-    frequencies = []
-    for cla, ima in zip(classes, images_containing_class):
-        if cla == 0:
-            frequencies.append(0)
-        else:
-            frequencies.append(cla / ima)
+    aggregated_masks, mask_list_no_overlap, label_counts = zip(
+        *map_slices(_remove_overlap_and_count_labels, mask_list))
+
+    # compute class frequencies
+    frequencies = _class_frequencies(label_counts, aggregated_masks[0].size)
 
     print("Frequencies", frequencies)
 
     av = sum(frequencies) / ch
 
-    output_data = []
-
-    for slice_number in range(len(image_list)):
-        img = image_list[slice_number]
-        seg = aggregated_masks[slice_number]
-        weight = calc_weight(img,seg,av,frequencies,dim,band,ch)
-        arr=np.concatenate([np.reshape(img,(dim,dim,1)),mask_list_no_overlap[slice_number], np.reshape(weight, (dim,dim,1))], axis=-1)
-        output_data.append(arr)
+    output_data = list(map_slices(_slice_training_data, image_list, aggregated_masks, mask_list_no_overlap,
+                                  repeat(av, len(image_list)), repeat(frequencies, len(image_list)),
+                                  repeat(band, len(image_list)), repeat(weight_engine, len(image_list))))
 
     return output_data
 
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Training data store made of fixed-shape shards that are opened as memory maps.
+# A store is a directory containing:
+#   index.json: shapes, data type, number of channels, list of shards and list of sample IDs
+#   shard_NNNNN.dat: raw arrays of shape (samples_per_shard, H, W, C) (the last shard can be shorter)
+# The channel layout of the samples is the same as the train_N.npy files created by input_creation:
+# channel 0 is the image, channel -1 is the weight map, and the channels in between are the label masks.
+
+import json
+import os
+import re
+
+import numpy as np
+
+INDEX_FILE_NAME = 'index.json'
+SHARD_FILE_NAME = 'shard_{:05d}.dat'
+STORE_VERSION = 1
+DEFAULT_SAMPLES_PER_SHARD = 256
+
+NPY_FILE_REGEX = re.compile(r'^train_(\d+)\.npy$')
+
+
+def list_npy_ids(path):
+    """
+    Returns the sorted list of IDs of the train_<ID>.npy files contained in a directory
+    """
+    ids = []
+    for file_name in os.listdir(path):
+        match = NPY_FILE_REGEX.match(file_name)
+        if match:
+            ids.append(int(match.group(1)))
+    return sorted(ids)
+
+
+def convert_npy_dir(source_path, store_path, samples_per_shard=DEFAULT_SAMPLES_PER_SHARD, dtype=np.float32,
+                    ids=None):
+    """
+    Converts a directory of train_<ID>.npy files into a sharded store
+
+    Parameters
+    ----------
+    source_path : str
+        Directory containing the train_<ID>.npy files
+    store_path : str
+        Output directory. It is created if needed
+    samples_per_shard : int
+        Number of samples in every shard
+    dtype :
+        Data type of the stored samples
+    ids : list of int or None
+        IDs to convert. Default: all the files in source_path
+
+    Returns
+    -------
+    ShardedTrainingStore
+        The newly created store
+    """
+    if ids is None:
+        ids = list_npy_ids(source_path)
+    if len(ids) == 0:
+        raise FileNotFoundError(f'No train_*.npy files found in {source_path}')
+
+    os.makedirs(store_path, exist_ok=True)
+    dtype = np.dtype(dtype)
+    sample_shape = None
+    shards = []
+
+    for shard_number, shard_start in enumerate(range(0, len(ids), samples_per_shard)):
+        shard_ids = ids[shard_start:shard_start + samples_per_shard]
+        shard = None
+        for position, sample_id in enumerate(shard_ids):
+            arr = np.load(os.path.join(source_path, f'train_{sample_id}.npy'))
+            if sample_shape is None:
+                sample_shape = arr.shape
+            elif arr.shape != sample_shape:
+                raise ValueError(f'Sample {sample_id} has shape {arr.shape}, expected {sample_shape}')
+            if shard is None:
+                shard_file = SHARD_FILE_NAME.format(shard_number)
+                shard = np.memmap(os.path.join(store_path, shard_file), dtype=dtype, mode='w+',
+                                  shape=(len(shard_ids), *sample_shape))
+            shard[position] = arr
+        shard.flush()
+        del shard
+        shards.append({'file': shard_file, 'n_samples': len(shard_ids)})
+
+    index = {
+        'version': STORE_VERSION,
+        'dtype': dtype.str,
+        'sample_shape': list(sample_shape),
+        'n_channels': sample_shape[-1],
+        'n_labels': sample_shape[-1] - 2,
+        'samples_per_shard': samples_per_shard,
+        'shards': shards,
+        'ids': [int(sample_id) for sample_id in ids]
+    }
+
+    # the index is written last, so an interrupted conversion never leaves a valid-looking store
+    index_file = os.path.join(store_path, INDEX_FILE_NAME)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file + '.tmp', index_file)
+    return ShardedTrainingStore(store_path)
+
+
+class ShardedTrainingStore:
+    """
+    Read-only access to a sharded store. The shards are memory-mapped once, and samples are read by
+    fancy-indexing the memory maps, without opening any file per sample.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, INDEX_FILE_NAME), 'r') as f:
+            index = json.load(f)
+        if index.get('version', 0) > STORE_VERSION:
+            raise ValueError(f'Unsupported store version {index["version"]}')
+
+        self.dtype = np.dtype(index['dtype'])
+        self.sample_shape = tuple(index['sample_shape'])
+        self.n_channels = index['n_channels']
+        self.n_labels = index['n_labels']
+        self.samples_per_shard = index['samples_per_shard']
+        self.ids = index['ids']
+        self.shards = [np.memmap(os.path.join(store_path, shard['file']), dtype=self.dtype, mode='r',
+                                 shape=(shard['n_samples'], *self.sample_shape))
+                       for shard in index['shards']]
+        self.id_to_position = {sample_id: position for position, sample_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, ids):
+        """
+        Converts a sequence of sample IDs into positions in the store
+        """
+        try:
+            return np.array([self.id_to_position[sample_id] for sample_id in ids], dtype=np.intp)
+        except KeyError as e:
+            raise KeyError(f'Sample {e.args[0]} is not in the store') from None
+
+    def gather(self, ids, channels=None, out=None):
+        """
+        Reads a set of samples
+
+        Parameters
+        ----------
+        ids : sequence of int
+            Sample IDs to read
+        channels : slice, sequence of int or None
+            Channels to read. Default: all
+        out : np.ndarray or None
+            Optional output array of shape (len(ids), H, W, n_selected_channels)
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (len(ids), H, W, n_selected_channels)
+        """
+        positions = self.positions(ids)
+        if channels is None:
+            channels = slice(None)
+        if out is None:
+            n_selected = len(np.arange(self.n_channels)[channels])
+            out = np.empty((len(positions), *self.sample_shape[:-1], n_selected), dtype=self.dtype)
+
+        shard_numbers = positions // self.samples_per_shard
+        for shard_number in np.unique(shard_numbers):
+            batch_indices = np.flatnonzero(shard_numbers == shard_number)
+            in_shard = positions[batch_indices] - shard_number * self.samples_per_shard
+            # read the samples of the shard in file order
+            order = np.argsort(in_shard, kind='stable')
+            out[batch_indices[order]] = self.shards[shard_number][in_shard[order]][..., channels]
+        return out
@@ -0,0 +1,160 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Sliding-window (tiled) inference for images whose field of view is larger than the one of the model.
+
+The image is cut into overlapping tiles covering it completely (the last tile of every row/column is aligned with the
+border of the image), and every tile is segmented by the apply function of the model, which does its own resampling.
+The masks of the tiles are blended as votes weighted by a window that decreases towards the border of the tile, where
+the network has less context, and every pixel is assigned to the label with the highest vote.
+Only batch_size tiles are in memory at the same time; the accumulators have the size of the image.
+"""
+
+import math
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from .padorcut import padorcut
+
+TILE_OVERLAP = 0.25  # fraction of the tile size shared by neighboring tiles
+TILE_BATCH_SIZE = 4
+WINDOW_SIGMA_SCALE = 1/8  # standard deviation of the gaussian window, relative to the tile size
+WINDOW_MIN_WEIGHT = 1e-3  # the window is never zero, so the border of the image always gets a vote
+
+
+def tile_size_from_fov(field_of_view, resolution):
+    """
+    Returns the tile size in pixels corresponding to a field of view (e.g. MODEL_SIZE * MODEL_RESOLUTION of a model)
+
+    Parameters
+    ----------
+    field_of_view : float or sequence of 2 floats
+        Size of the field of view in mm
+    resolution : sequence of floats
+        Resolution of the image in mm/pixel (only the first two values are used)
+    """
+    field_of_view = np.broadcast_to(field_of_view, (2,))
+    return tuple(max(1, int(math.floor(fov / res))) for fov, res in zip(field_of_view, resolution[:2]))
+
+
+def tile_starts(length: int, tile_size: int, overlap: float = TILE_OVERLAP) -> List[int]:
+    """
+    Start positions of the tiles along an axis. The tiles are evenly spaced, with an overlap of at least the requested
+    fraction, and the last one ends at the end of the axis
+    """
+    if length <= tile_size:
+        return [0]
+    step = max(1, int(math.floor(tile_size * (1 - overlap))))
+    n_tiles = int(math.ceil((length - tile_size) / step)) + 1
+    return [int(start) for start in np.round(np.linspace(0, length - tile_size, n_tiles))]
+
+
+def tile_grid(shape, tile_size, overlap: float = TILE_OVERLAP) -> List[tuple]:
+    """
+    Returns the slices (one per axis) of the tiles covering the first two axes of an array of the given shape.
+    Tiles larger than the image are reduced to the size of the image
+    """
+    tile_size = np.broadcast_to(tile_size, (2,))
+    tiles = []
+    for start_0 in tile_starts(shape[0], tile_size[0], overlap):
+        for start_1 in tile_starts(shape[1], tile_size[1], overlap):
+            tiles.append((slice(start_0, min(start_0 + tile_size[0], shape[0])),
+                          slice(start_1, min(start_1 + tile_size[1], shape[1]))))
+    return tiles
+
+
+def blending_window(shape, sigma_scale=WINDOW_SIGMA_SCALE, min_weight=WINDOW_MIN_WEIGHT) -> np.ndarray:
+    """
+    Gaussian weighting window of the given 2D shape, with maximum 1 at the center and minimum min_weight
+    """
+    window = np.ones(shape, dtype=np.float32)
+    for axis, size in enumerate(shape):
+        coords = np.arange(size, dtype=np.float32) - (size - 1) / 2
+        profile = np.exp(-coords ** 2 / (2 * (size * sigma_scale) ** 2))
+        window *= np.expand_dims(profile, 1 - axis)
+    return np.maximum(window, min_weight)
+
+
+def apply_tiled(apply_batch_function: Callable[[List[dict]], List[dict]], data: dict, tile_size,
+                overlap: float = TILE_OVERLAP, batch_size: int = TILE_BATCH_SIZE,
+                window_function: Optional[Callable[[tuple], np.ndarray]] = None) -> Dict[str, np.ndarray]:
+    """
+    Segments an image tile by tile
+
+    Parameters
+    ----------
+    apply_batch_function : Callable[[List[dict]], List[dict]]
+        Function segmenting a list of data dictionaries and returning the list of the corresponding {label: mask}
+        dictionaries
+    data : dict
+        Input of the model. data['image'] is cut into tiles along its first two axes; the other entries (e.g. the
+        resolution) are passed unchanged with every tile
+    tile_size : int or (int, int)
+        Size of the tiles in pixels of the input image. It should correspond to the field of view of the model
+        (see tile_size_from_fov), so that the model does not crop the tiles
+    overlap : float
+        Minimum fraction of the tile size shared by neighboring tiles
+    batch_size : int
+        Number of tiles passed to apply_batch_function at the same time
+    window_function : Callable[[tuple], np.ndarray] or None
+        Returns the weights of a tile given its shape. Default: blending_window
+
+    Returns
+    -------
+    dict[str, mask]
+        The masks of the labels found in the tiles, with the shape of the first two axes of the image
+    """
+    if window_function is None:
+        window_function = blending_window
+    image = data['image']
+    image_shape = image.shape[:2]
+    tiles = tile_grid(image_shape, tile_size, overlap)
+
+    weight_sum = np.zeros(image_shape, dtype=np.float32)
+    votes = {}  # label -> weighted votes
+    windows = {}  # tile shape -> window
+
+    for batch_start in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[batch_start:batch_start + batch_size]
+        batch_data = [{**data, 'image': image[tile]} for tile in batch_tiles]
+        batch_outputs = apply_batch_function(batch_data)
+        for tile, output in zip(batch_tiles, batch_outputs):
+            if not isinstance(output, dict):
+                raise ValueError('Tiled inference is only supported for segmentation models')
+            tile_shape = (tile[0].stop - tile[0].start, tile[1].stop - tile[1].start)
+            if tile_shape not in windows:
+                windows[tile_shape] = window_function(tile_shape)
+            window = windows[tile_shape]
+            weight_sum[tile] += window
+            for label, mask in output.items():
+                mask = np.asarray(mask)
+                if mask.shape != tile_shape:
+                    mask = padorcut(mask, tile_shape)
+                if label not in votes:
+                    votes[label] = np.zeros(image_shape, dtype=np.float32)
+                votes[label][tile] += window * (mask > 0)
+
+    # every pixel goes to the label with most votes, or to the background
+    labels = list(votes)
+    winner = np.zeros(image_shape, dtype=np.int32)
+    best_vote = weight_sum - sum(votes.values())  # background
+    for label_index, label in enumerate(labels):
+        is_better = votes[label] > best_vote
+        winner[is_better] = label_index + 1
+        best_vote = np.where(is_better, votes[label], best_vote)
+
+    return {label: (winner == label_index + 1).astype(np.uint8) for label_index, label in enumerate(labels)}
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Flat representation of model weights: a single contiguous array, exposed as a list of per-layer views.
+Arithmetic on the whole model then runs as a few vectorized passes on one buffer, and the fused in-place operations
+below work in chunks, so their temporary memory is bounded by CHUNK_SIZE elements and not by the model size.
+
+The *_function functions at the end can be passed to DynamicDLModel (e.g. DynamicDLModel(..., **FLAT_WEIGHT_FUNCTIONS))
+to replace the default per-layer keras functions. Like all model functions, they are self-contained.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+CHUNK_SIZE = 1024*1024  # number of elements processed at once by the fused operations
+
+
+def _is_dense(layer):
+    # layers that are not arrays (e.g. SparseLayer) provide shape, dtype and add_to(out, factor)
+    return not hasattr(layer, 'add_to')
+
+
+def _common_dtype(weights):
+    if len(weights) == 0:
+        return np.float32
+    return np.result_type(*[np.asarray(layer).dtype if _is_dense(layer) else layer.dtype for layer in weights])
+
+
+def _assign(view, layer, factor=1):
+    # view[...] = factor * layer
+    if _is_dense(layer):
+        np.multiply(layer, factor, out=view, casting='unsafe')
+    else:
+        view[...] = 0
+        layer.add_to(view, factor)
+
+
+class FlatWeights(list):
+    """
+    List of weight arrays that are views on one contiguous buffer. It can be used wherever a list of weights is
+    expected (e.g. keras set_weights), and is pickled as a plain list, so the serialized format does not change.
+    """
+
+    def __init__(self, buffer: np.ndarray, shapes):
+        self.buffer = buffer
+        self.shapes = [tuple(shape) for shape in shapes]
+        views = []
+        offset = 0
+        for shape in self.shapes:
+            size = int(np.prod(shape))
+            views.append(buffer[offset:offset + size].reshape(shape))
+            offset += size
+        if offset != buffer.size:
+            raise ValueError('The buffer size does not match the layer shapes')
+        super().__init__(views)
+
+    @staticmethod
+    def empty(shapes, dtype=np.float32) -> FlatWeights:
+        size = sum(int(np.prod(shape)) for shape in shapes)
+        return FlatWeights(np.empty(size, dtype=dtype), shapes)
+
+    @staticmethod
+    def from_list(weights, dtype=None) -> FlatWeights:
+        """
+        Converts a list of arrays into flat weights. FlatWeights of the requested dtype are returned as they are.
+
+        Parameters
+        ----------
+        weights : list of np.ndarray
+            The weights of the layers
+        dtype :
+            Data type of the buffer. Default: the common type of all the layers
+        """
+        if isinstance(weights, FlatWeights) and (dtype is None or weights.buffer.dtype == np.dtype(dtype)):
+            return weights
+        if dtype is None:
+            dtype = _common_dtype(weights)
+        flat = FlatWeights.empty([np.shape(layer) if _is_dense(layer) else layer.shape for layer in weights], dtype)
+        for view, layer in zip(flat, weights):
+            _assign(view, layer)
+        return flat
+
+    @staticmethod
+    def copy_of(weights) -> FlatWeights:
+        """
+        Returns flat weights with a new buffer containing a copy of the weights (copied only once)
+        """
+        if isinstance(weights, FlatWeights):
+            return weights.copy()
+        return FlatWeights.from_list(weights)
+
+    def __reduce__(self):
+        # pickle as a plain list of arrays
+        return list, (list(self),)
+
+    def empty_like(self) -> FlatWeights:
+        return FlatWeights(np.empty_like(self.buffer), self.shapes)
+
+    def copy(self) -> FlatWeights:
+        return FlatWeights(self.buffer.copy(), self.shapes)
+
+    def check_compatible(self, other: FlatWeights):
+        if self.shapes != other.shapes:
+            raise ValueError('Incompatible weight shapes')
+
+    def scale(self, factor: float) -> FlatWeights:
+        """
+        In-place multiplication by a factor: self *= factor
+        """
+        self.buffer *= factor
+        return self
+
+    def axpy(self, factor: float, other) -> FlatWeights:
+        """
+        In-place scaled addition: self += factor * other. other can be FlatWeights or a plain list of arrays, which
+        is processed layer by layer without being flattened first.
+        """
+        if not isinstance(other, FlatWeights):
+            if len(other) != len(self.shapes):
+                raise ValueError('Incompatible weight shapes')
+            for view, layer in zip(self, other):
+                if _is_dense(layer):
+                    view += factor * np.asarray(layer)
+                else:
+                    layer.add_to(view, factor)
+            return self
+        self.check_compatible(other)
+        temp = np.empty(min(CHUNK_SIZE, self.buffer.size), dtype=np.result_type(self.buffer, other.buffer))
+        for start in range(0, self.buffer.size, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, self.buffer.size)
+            chunk_temp = temp[:end - start]
+            np.multiply(other.buffer[start:end], factor, out=chunk_temp)
+            np.add(self.buffer[start:end], chunk_temp, out=self.buffer[start:end], casting='unsafe')
+        return self
+
+
+def thresholded_delta(lhs: FlatWeights, rhs: FlatWeights, threshold=None, out: FlatWeights = None) -> FlatWeights:
+    """
+    Calculates lhs - rhs, setting to zero the elements whose absolute value is below threshold, in a single pass
+
+    Parameters
+    ----------
+    lhs, rhs : FlatWeights
+        Operands
+    threshold : float or None
+        Threshold below which differences are set to zero. None: no thresholding
+    out : FlatWeights or None
+        Output weights (can be lhs or rhs). Default: new weights
+    """
+    lhs.check_compatible(rhs)
+    if out is None:
+        out = lhs.empty_like()
+    for start in range(0, lhs.buffer.size, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, lhs.buffer.size)
+        out_chunk = out.buffer[start:end]
+        np.subtract(lhs.buffer[start:end], rhs.buffer[start:end], out=out_chunk, casting='unsafe')
+        if threshold is not None:
+            out_chunk[np.abs(out_chunk) < threshold] = 0
+    return out
+
+
+def linear_combination(terms, out: FlatWeights = None) -> FlatWeights:
+    """
+    Calculates sum(factor * weights) over a sequence of (factor, weights) terms with one pass per term and a single
+    output buffer. For example, a + (b - c) * 0.5 is linear_combination([(1, a), (0.5, b), (-0.5, c)]).
+
+    Parameters
+    ----------
+    terms : iterable of (float, FlatWeights or list of np.ndarray)
+        The terms of the sum. Plain lists are not flattened, so no temporary copy of a whole model is made
+    out : FlatWeights or None
+        Output weights. Default: new weights
+    """
+    first = True
+    for factor, weights in terms:
+        if first:
+            if out is None:
+                out = FlatWeights.empty([np.shape(layer) if _is_dense(layer) else layer.shape for layer in weights],
+                                        _common_dtype(weights))
+            if len(weights) != len(out.shapes):
+                raise ValueError('Incompatible weight shapes')
+            for view, layer in zip(out, weights):
+                _assign(view, layer, factor)
+            first = False
+        else:
+            out.axpy(factor, weights)
+    if first:
+        raise ValueError('No terms to combine')
+    return out
+
+
+def flat_delta_function(lhs, rhs, threshold=None):
+    from dafne_dl.interfaces import IncompatibleModelError
+    from dafne_dl.flat_weights import FlatWeights, thresholded_delta
+    if lhs.model_id != rhs.model_id: raise IncompatibleModelError
+    newWeights = thresholded_delta(FlatWeights.from_list(lhs.get_weights()), FlatWeights.from_list(rhs.get_weights()),
+                                   threshold)
+    outputObj = lhs.get_empty_copy()
+    outputObj.set_weights(newWeights)
+    outputObj.is_delta = True
+    outputObj.timestamp_id = rhs.timestamp_id # set the timestamp of the original model to identify the base
+    return outputObj
+
+
+def flat_add_weights_function(lhs, rhs):
+    from dafne_dl.interfaces import IncompatibleModelError
+    from dafne_dl.flat_weights import FlatWeights
+    if lhs.model_id != rhs.model_id: raise IncompatibleModelError
+    newWeights = FlatWeights.copy_of(lhs.get_weights())
+    newWeights.axpy(1, rhs.get_weights())
+    outputObj = lhs.get_empty_copy()
+    outputObj.set_weights(newWeights)
+    return outputObj
+
+
+def flat_multiply_function(lhs, rhs):
+    from dafne_dl.flat_weights import FlatWeights
+    if not isinstance(rhs, (int, float)):
+        raise NotImplementedError('Incompatible types for multiplication (only multiplication by numeric factor is allowed)')
+    newWeights = FlatWeights.copy_of(lhs.get_weights())
+    newWeights.scale(rhs)
+    outputObj = lhs.get_empty_copy()
+    outputObj.set_weights(newWeights)
+    return outputObj
+
+
+def flat_weight_copy_function(weights_in):
+    from dafne_dl.flat_weights import FlatWeights
+    return FlatWeights.copy_of(weights_in)
+
+
+FLAT_WEIGHT_FUNCTIONS = {
+    'calc_delta_function': flat_delta_function,
+    'apply_delta_function': flat_add_weights_function,
+    'factor_multiply_function': flat_multiply_function,
+    'weight_copy_function': flat_weight_copy_function
+}
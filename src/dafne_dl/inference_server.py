@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Inference server with dynamic batching: it keeps a set of loaded models and a request queue per model. A worker
+thread per model collects the requests that arrive within max_latency of the first waiting one (up to
+max_batch_size) and runs them in a single apply_batch call, so concurrent clients share the forward passes.
+Models are only applied by their own worker, so they do not need to be thread-safe.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+import numpy as np
+
+from .interfaces import ModelProvider
+from .DynamicDLModel import DynamicDLModel
+
+MAX_BATCH_SIZE = 8
+MAX_LATENCY = 0.01  # seconds the first request of a batch waits for other requests
+METRICS_WINDOW = 1000  # number of recent requests used for the latency and throughput metrics
+
+
+class _Request:
+    __slots__ = ('data', 'future', 'submit_time')
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.future = Future()
+        self.submit_time = time.monotonic()
+
+
+class _ModelWorker:
+    """
+    Queue, worker thread and metrics of one model
+    """
+
+    def __init__(self, model_name: str, model: DynamicDLModel, max_batch_size: int, max_latency: float):
+        self.model_name = model_name
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.condition = threading.Condition()
+        self.requests = deque()
+        self.stopped = False
+
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.n_batched_requests = 0
+        self.latencies = deque(maxlen=METRICS_WINDOW)  # (completion time, latency)
+
+        self.thread = threading.Thread(target=self._run, name=f'InferenceServer-{model_name}', daemon=True)
+        self.thread.start()
+
+    def submit(self, data: dict) -> Future:
+        request = _Request(data)
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError(f'The worker of {self.model_name} is stopped')
+            self.requests.append(request)
+            self.n_requests += 1
+            self.condition.notify()
+        return request.future
+
+    def _next_batch(self):
+        # waits for the first request, then for the batch to fill up or for its latency window to expire
+        with self.condition:
+            while not self.requests and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            deadline = self.requests[0].submit_time + self.max_latency
+            while len(self.requests) < self.max_batch_size and not self.stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = []
+            while self.requests and len(batch) < self.max_batch_size:
+                request = self.requests.popleft()
+                if request.future.set_running_or_notify_cancel():
+                    batch.append(request)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            n_errors = 0
+            try:
+                outputs = self.model.apply_batch([request.data for request in batch], self.max_batch_size)
+                if len(outputs) != len(batch):
+                    raise RuntimeError(f'apply_batch returned {len(outputs)} outputs for {len(batch)} inputs')
+            except Exception as e:
+                if len(batch) == 1:
+                    print(f'Inference error in {self.model_name}:', e)
+                    batch[0].future.set_exception(e)
+                    n_errors = 1
+                else:
+                    # a bad request must not fail the others: apply them one by one
+                    print(f'Inference error in a batch of {self.model_name}, applying the requests separately:', e)
+                    n_errors = self._run_separately(batch)
+            else:
+                for request, output in zip(batch, outputs):
+                    request.future.set_result(output)
+
+            now = time.monotonic()
+            with self.condition:
+                self.n_batches += 1
+                self.n_batched_requests += len(batch)
+                self.n_errors += n_errors
+                for request in batch:
+                    self.latencies.append((now, now - request.submit_time))
+
+    def _run_separately(self, batch) -> int:
+        # returns the number of failed requests
+        n_errors = 0
+        for request in batch:
+            try:
+                request.future.set_result(self.model.apply(request.data))
+            except Exception as e:
+                print(f'Inference error in {self.model_name}:', e)
+                request.future.set_exception(e)
+                n_errors += 1
+        return n_errors
+
+    def stop(self, wait=True):
+        with self.condition:
+            self.stopped = True
+            pending = list(self.requests)
+            self.requests.clear()
+            self.condition.notify_all()
+        for request in pending:
+            request.future.cancel()
+        if wait and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def get_metrics(self) -> dict:
+        with self.condition:
+            latencies = list(self.latencies)
+            metrics = {
+                'requests': self.n_requests,
+                'errors': self.n_errors,
+                'batches': self.n_batches,
+                'queue_length': len(self.requests),
+                'mean_batch_size': self.n_batched_requests / self.n_batches if self.n_batches else 0.0,
+            }
+        if latencies:
+            completion_times, latency_values = zip(*latencies)
+            latency_values = np.array(latency_values)
+            metrics['latency_mean'] = float(latency_values.mean())
+            for percentile in [50, 95, 99]:
+                metrics[f'latency_p{percentile}'] = float(np.percentile(latency_values, percentile))
+            # completed requests per second in the time spanned by the recent requests
+            first_start = min(t - latency for t, latency in latencies)
+            elapsed = completion_times[-1] - first_start
+            metrics['throughput'] = len(latencies) / elapsed if elapsed > 0 else 0.0
+        else:
+            for key in ['latency_mean', 'latency_p50', 'latency_p95', 'latency_p99', 'throughput']:
+                metrics[key] = 0.0
+        return metrics
+
+
+class InferenceServer:
+    """
+    Keeps loaded models warm and applies them to queued requests with dynamic batching.
+
+    Requests are submitted with submit(model_name, data), which returns a concurrent.futures.Future resolving to the
+    output of model.apply(data). Requests to the same model that arrive within max_latency seconds of each other are
+    grouped (up to max_batch_size) into one apply_batch call, which is a single forward pass for the models defining
+    an apply_batch_function. If a batch fails, its requests are applied one by one, so that an invalid request only
+    fails its own future.
+    """
+
+    def __init__(self, model_provider: Optional[ModelProvider] = None, max_batch_size=MAX_BATCH_SIZE,
+                 max_latency=MAX_LATENCY):
+        """
+        Parameters
+        ----------
+        model_provider : ModelProvider or None
+            Provider used by add_model to load the models that are not passed explicitly
+        max_batch_size : int
+            Maximum number of requests applied together
+        max_latency : float
+            Maximum time in seconds that a request waits for other requests to fill its batch
+        """
+        self.model_provider = model_provider
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.lock = threading.Lock()
+        self.workers: Dict[str, _ModelWorker] = {}
+
+    def add_model(self, model_name: str, model: Optional[DynamicDLModel] = None):
+        """
+        Adds a model to the server, replacing any model with the same name. Requests already submitted to the replaced
+        model are completed with it
+
+        Parameters
+        ----------
+        model_name : str
+            Name used in the requests
+        model : DynamicDLModel or None
+            The model. If None, the latest version is loaded from the model provider
+        """
+        if model is None:
+            if self.model_provider is None:
+                raise ValueError('No model provider to load the model from')
+            model = self.model_provider.load_model(model_name)
+            if model is None:
+                raise ValueError(f'Model {model_name} could not be loaded')
+        # weights-only models are initialized now, instead of during the first request
+        if hasattr(model, 'is_initialized') and not model.is_initialized():
+            model.init_model()
+        worker = _ModelWorker(model_name, model, self.max_batch_size, self.max_latency)
+        with self.lock:
+            old_worker = self.workers.get(model_name)
+            self.workers[model_name] = worker
+        if old_worker is not None:
+            self._drain(old_worker)
+
+    @staticmethod
+    def _drain(worker: _ModelWorker):
+        # lets the worker complete its queued requests, then stops it
+        with worker.condition:
+            worker.max_latency = 0
+            while worker.requests:
+                worker.condition.wait(MAX_LATENCY)
+        worker.stop()
+
+    def remove_model(self, model_name: str):
+        """
+        Removes a model from the server. Its pending requests are cancelled
+        """
+        with self.lock:
+            worker = self.workers.pop(model_name)
+        worker.stop()
+
+    def model_names(self):
+        with self.lock:
+            return list(self.workers)
+
+    def submit(self, model_name: str, data: dict) -> Future:
+        """
+        Queues a request
+
+        Parameters
+        ----------
+        model_name : str
+            Name of the model to apply
+        data : dict
+            Input of the model, as for DynamicDLModel.apply
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future resolving to the output of the model
+        """
+        with self.lock:
+            try:
+                worker = self.workers[model_name]
+            except KeyError:
+                raise KeyError(f'Model {model_name} is not loaded') from None
+        return worker.submit(data)
+
+    def apply(self, model_name: str, data: dict, timeout: Optional[float] = None):
+        """
+        Queues a request and waits for its output
+        """
+        return self.submit(model_name, data).result(timeout)
+
+    def get_metrics(self) -> dict:
+        """
+        Returns, for every model, the number of requests, errors and batches, the current queue length, the mean batch
+        size, and the mean and 50/95/99th percentile latency (s, from submission to completion) and the throughput
+        (requests/s) of the last METRICS_WINDOW requests
+        """
+        with self.lock:
+            workers = dict(self.workers)
+        return {model_name: worker.get_metrics() for model_name, worker in workers.items()}
+
+    def stop(self, wait=True):
+        """
+        Stops all the workers after their current batch. Pending requests are cancelled
+        """
+        with self.lock:
+            workers = list(self.workers.values())
+            self.workers = {}
+        for worker in workers:
+            worker.stop(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -128,6 +128,25 @@ class DeepLearningClass(ABC):
         """
         pass
 
+    def apply_batch(self, data_list: List[dict], batch_size: Optional[int] = None) -> list:
+        """
+        Applies the deep learning model to a list of images.
+        Note: this defaults to calling apply on every element. Redefine to process the images in batches
+
+        Parameters
+        ----------
+        data_list : list of dictionaries
+            Inputs of the model, as for apply
+        batch_size : int or None
+            Maximum number of images processed at the same time
+
+        Returns
+        -------
+        The list of the outputs of the model, as for apply
+
+        """
+        return [self.apply(data) for data in data_list]
+
     @abstractmethod
     def factor_multiply(self, factor: float):
         """
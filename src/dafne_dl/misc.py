@@ -17,25 +17,87 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import hashlib
+import json
 import os
+import threading
 
 import numpy as np
 
 
+HASH_CHUNK_SIZE = 1024*1024  # 1 MB
+
+
+def update_hash_from_stream(hasher, stream, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Feeds the remaining content of a binary stream to a hashlib hasher in chunks. Returns the number of bytes read
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    n_total = 0
+    while True:
+        n_read = stream.readinto(buffer)
+        if not n_read:
+            break
+        hasher.update(view[:n_read])
+        n_total += n_read
+    return n_total
+
+
+def calculate_stream_hash(stream, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Calculates the sha256 hash of a binary stream reading it in chunks, with constant memory usage
+    """
+    hasher = hashlib.sha256()
+    update_hash_from_stream(hasher, stream, chunk_size)
+    return hasher.hexdigest()
+
+
+class HashingWriter:
+    """
+    Write-only file wrapper that computes the sha256 hash of the data written to the underlying file
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def file_signature(file_path):
+    """
+    Returns the (size, mtime_ns, inode) tuple that identifies the current version of a file
+    """
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
 def calculate_file_hash(file_path, cache_results=False, force_rewrite_cache=False):
+    file_path = str(file_path)
     if not cache_results:
-        return hashlib.sha256(open(file_path, 'rb').read()).hexdigest()
+        with open(file_path, 'rb') as f:
+            return calculate_stream_hash(f)
     
-    # check if the hash exists on disk
+    # check if the hash exists on disk. The hash file contains the hash and the signature of the file it refers to
     hash_file = file_path + '.sha256'
+    signature = ' '.join(str(v) for v in file_signature(file_path))
     if not force_rewrite_cache:
         try:
             with open(hash_file, 'r') as f:
                 output_hash = f.readline().strip()
+                stored_signature = f.readline().strip()
         except OSError:
             print('Error while reading from hash file')
         else:
-            if len(output_hash) == 64:
+            if len(output_hash) == 64 and stored_signature == signature:
                 #print('Using cached hash')
                 return output_hash
             else:
@@ -45,12 +107,99 @@ def calculate_file_hash(file_path, cache_results=False, force_rewrite_cache=Fals
     output_hash = calculate_file_hash(file_path, False)  # fallback to calculating hash
     try:
         with open(hash_file, 'w') as f:
-            f.write(output_hash)
+            f.write(output_hash + '\n' + signature)
     except OSError:
         print('Error writing hash to file')
     return output_hash
 
 
+class FileHashIndex:
+    """
+    Persistent index of file hashes. Entries are keyed by the absolute path and are only valid as long as the size,
+    modification time and inode of the file are unchanged, so an unmodified file is never hashed twice.
+    """
+
+    def __init__(self, index_file=None):
+        """
+        Parameters
+        ----------
+        index_file : str, Path or None
+            json file where the index is stored. If None, the index is only kept in memory
+        """
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        if index_file is not None:
+            try:
+                with open(index_file, 'r') as f:
+                    self.entries = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError):
+                print('Error while reading the hash index. Starting with an empty index')
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.abspath(str(file_path))
+
+    def get_hash(self, file_path, force_recalculate=False):
+        """
+        Returns the hash of a file, calculating it only if the file changed since the last time
+
+        Parameters
+        ----------
+        file_path : str or Path
+            The file to hash
+        force_recalculate : bool
+            Ignore the stored entry
+
+        Returns
+        -------
+        str
+            The sha256 hash as hex string
+        """
+        key = self._key(file_path)
+        signature = list(file_signature(file_path))
+        with self.lock:
+            entry = self.entries.get(key)
+        if not force_recalculate and entry is not None and entry['signature'] == signature:
+            return entry['hash']
+        file_hash = calculate_file_hash(file_path)
+        # the file might have been modified while hashing; in that case, the next call will hash it again
+        self._store(key, signature, file_hash)
+        return file_hash
+
+    def store(self, file_path, file_hash):
+        """
+        Records the hash of a file that is known from elsewhere (e.g. calculated while the file was written)
+        """
+        self._store(self._key(file_path), list(file_signature(file_path)), file_hash)
+
+    def invalidate(self, file_path):
+        with self.lock:
+            if self.entries.pop(self._key(file_path), None) is not None:
+                self._save()
+
+    def _store(self, key, signature, file_hash):
+        with self.lock:
+            self.entries[key] = {'signature': signature, 'hash': file_hash}
+            self._save()
+
+    def _save(self):
+        # must be called with the lock acquired
+        if self.index_file is None:
+            return
+        # remove the entries of deleted files
+        self.entries = {k: v for k, v in self.entries.items() if os.path.exists(k)}
+        temp_file = str(self.index_file) + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_file, self.index_file)
+        except OSError:
+            print('Error writing the hash index')
+
+
 def calc_dice_score(y_true, y_pred):
     """
     Binary f1. Same results as sklearn f1 binary.
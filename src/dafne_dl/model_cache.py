@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+In-memory LRU cache of loaded models, used by the model providers to avoid deserializing the same model at every
+load_model call.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import numpy as np
+
+
+def _variables_size(variables) -> int:
+    # size of framework variables (e.g. keras weights) from their shape and dtype, without copying their values
+    size = 0
+    for variable in variables:
+        dtype = getattr(variable.dtype, 'as_numpy_dtype', variable.dtype)
+        size += int(np.prod(tuple(variable.shape))) * np.dtype(dtype).itemsize
+    return size
+
+
+def estimate_model_size(model) -> int:
+    """
+    Estimates the memory footprint of a model in bytes as the size of its weights.
+    For keras models, the size is computed from the variables of model.model; get_weights is only used for other
+    models, because it copies all the weights
+    """
+    variables = getattr(getattr(model, 'model', None), 'weights', None)
+    if variables is not None and not callable(variables):
+        try:
+            return _variables_size(variables)
+        except (AttributeError, TypeError, ValueError):
+            pass
+    try:
+        weights = model.get_weights()
+    except Exception:
+        return 0
+    if weights is None:
+        return 0
+    size = 0
+    for layer in weights:
+        try:
+            size += int(layer.nbytes)
+        except AttributeError:
+            size += int(np.asarray(layer).nbytes)
+    return size
+
+
+class ModelCache:
+    """
+    Thread-safe least-recently-used cache of models with a byte budget.
+
+    Cached models are shared: the same object is returned at every hit, so a model that is going to be modified
+    (e.g. by incremental learning) should be copied first.
+    """
+
+    def __init__(self, max_bytes: int, size_function: Callable = estimate_model_size):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum total estimated size of the cached models. 0 disables the cache
+        size_function : Callable
+            Function returning the estimated size of a model in bytes
+        """
+        self.max_bytes = max_bytes
+        self.size_function = size_function
+        self.entries = OrderedDict()  # key -> (model, size)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        """
+        Returns the cached model for the key, or None. Updates the hit/miss counters.
+        """
+        with self.lock:
+            try:
+                model, _ = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return model
+
+    def put(self, key: Hashable, model):
+        """
+        Adds a model to the cache, evicting the least recently used models if the budget is exceeded.
+        Models larger than the whole budget are not cached.
+        """
+        if model is None or self.max_bytes <= 0:
+            return
+        size = self.size_function(model)
+        with self.lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (model, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, _ = next(iter(self.entries.items()))
+                self._remove(old_key)
+                self.evictions += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], object]):
+        """
+        Returns the cached model for the key, or calls loader() and caches its result
+        """
+        model = self.get(key)
+        if model is None:
+            model = loader()
+            self.put(key, model)
+        return model
+
+    def _remove(self, key):
+        try:
+            _, size = self.entries.pop(key)
+        except KeyError:
+            return
+        self.current_bytes -= size
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self._remove(key)
+
+    def invalidate_model(self, model_name: str):
+        """
+        Removes all the versions of a model, for caches keyed by (model_name, timestamp)
+        """
+        with self.lock:
+            for key in [k for k in self.entries if isinstance(k, tuple) and k[0] == model_name]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+                'evictions': self.evictions,
+                'n_models': len(self.entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Memory-mappable container for serialized models.
+
+Layout of a container file:
+    MAGIC (8 bytes)
+    header length (uint64, little endian)
+    header: dill pickle of {'version', 'alignment', 'blobs', 'payload'}
+        blobs: offset table, list of (offset, dtype, shape) of the raw arrays, relative to the start of the data
+        payload: dill pickle of the model dictionary (function sources, model_id, timestamp_id...) where every numpy
+                 array is replaced by a reference to the offset table
+    zero padding up to a multiple of the alignment
+    data: raw array bytes, each array starting at an aligned offset
+
+When loading from a real file, the data section is memory-mapped (copy-on-write) and the arrays are views on it, so
+the weights are neither deserialized nor copied until they are used.
+"""
+
+import io
+import struct
+from io import BytesIO
+
+import dill
+import numpy as np
+
+MAGIC = b'DAFNEMMC'
+CONTAINER_VERSION = 1
+ALIGNMENT = 64
+_HEADER_LENGTH_FORMAT = '<Q'
+_PREAMBLE_SIZE = len(MAGIC) + struct.calcsize(_HEADER_LENGTH_FORMAT)
+
+
+def _align(offset, alignment=ALIGNMENT):
+    return -(-offset // alignment) * alignment
+
+
+class _ArrayExtractingPickler(dill.Pickler):
+    """
+    Pickler that replaces numpy arrays with references to a list of blobs
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrays = []
+        self.array_ids = {}
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray and not isinstance(obj, np.memmap):
+            return None
+        if obj.dtype.hasobject:
+            return None  # object arrays cannot be stored as raw bytes
+        try:
+            return self.array_ids[id(obj)]
+        except KeyError:
+            pass
+        self.arrays.append(obj)
+        self.array_ids[id(obj)] = len(self.arrays) - 1
+        return len(self.arrays) - 1
+
+
+class _ArrayRestoringUnpickler(dill.Unpickler):
+    """
+    Unpickler that resolves the blob references created by _ArrayExtractingPickler
+    """
+    def __init__(self, file, arrays):
+        super().__init__(file)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        return self.arrays[pid]
+
+
+def _is_seekable(file) -> bool:
+    try:
+        return file.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def peekable(file):
+    """
+    Returns a file object on which is_container works: the file itself if it is seekable or supports peek, a
+    BufferedReader for other raw streams (e.g. pipes)
+    """
+    if not _is_seekable(file) and not hasattr(file, 'peek') and isinstance(file, io.RawIOBase):
+        return io.BufferedReader(file)
+    return file
+
+
+def is_container(file) -> bool:
+    """
+    Checks whether a file open in binary mode contains a container. The file position is not changed.
+    Non-seekable streams are checked with peek; streams supporting neither are assumed not to be containers.
+    """
+    if _is_seekable(file):
+        start = file.tell()
+        magic = file.read(len(MAGIC))
+        file.seek(start)
+        return magic == MAGIC
+    try:
+        return file.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    except AttributeError:
+        return False
+
+
+def dump_container(obj, file):
+    """
+    Writes an object (typically the dictionary representing a model) as a container
+
+    Parameters
+    ----------
+    obj :
+        Any object that can be serialized with dill
+    file :
+        File descriptor open in binary writable mode
+    """
+    payload_io = BytesIO()
+    pickler = _ArrayExtractingPickler(payload_io)
+    pickler.dump(obj)
+
+    arrays = [np.ascontiguousarray(arr) for arr in pickler.arrays]
+    blobs = []
+    offset = 0
+    for arr in arrays:
+        offset = _align(offset)
+        blobs.append((offset, arr.dtype.str, arr.shape))
+        offset += arr.nbytes
+
+    header = dill.dumps({
+        'version': CONTAINER_VERSION,
+        'alignment': ALIGNMENT,
+        'blobs': blobs,
+        'payload': payload_io.getvalue()
+    })
+
+    file.write(MAGIC)
+    file.write(struct.pack(_HEADER_LENGTH_FORMAT, len(header)))
+    file.write(header)
+    header_end = _PREAMBLE_SIZE + len(header)
+    data_start = _align(header_end)
+    file.write(b'\0' * (data_start - header_end))
+
+    position = 0
+    for arr, (offset, _, _) in zip(arrays, blobs):
+        file.write(b'\0' * (offset - position))
+        file.write(arr.reshape(-1).view(np.uint8))
+        position = offset + arr.nbytes
+
+
+def load_container(file, use_mmap=True):
+    """
+    Reads an object written by dump_container
+
+    Parameters
+    ----------
+    file :
+        File descriptor open in binary mode, positioned at the start of the container. It does not need to be
+        seekable
+    use_mmap : bool
+        Memory-map the data section if the file is a real, seekable file. Otherwise (or if use_mmap is False) the data
+        is read into memory
+
+    Returns
+    -------
+    The stored object. Arrays are writable; with memory mapping, writes are never propagated to the file.
+    """
+    preamble = file.read(_PREAMBLE_SIZE)
+    if preamble[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a model container')
+    header_length, = struct.unpack(_HEADER_LENGTH_FORMAT, preamble[len(MAGIC):])
+    header = dill.loads(file.read(header_length))
+    if header['version'] > CONTAINER_VERSION:
+        raise ValueError(f'Unsupported container version {header["version"]}')
+
+    # offsets relative to the start of the container
+    header_end = _PREAMBLE_SIZE + header_length
+    data_start = _align(header_end, header['alignment'])
+    blobs = header['blobs']
+    data_length = 0
+    if blobs:
+        last_offset, last_dtype, last_shape = blobs[-1]
+        data_length = last_offset + np.dtype(last_dtype).itemsize * int(np.prod(last_shape))
+
+    data = None
+    if data_length > 0 and use_mmap:
+        try:
+            file.fileno()
+            container_start = file.tell() - header_end
+            data = np.memmap(file, dtype=np.uint8, mode='c', offset=container_start + data_start,
+                             shape=(data_length,))
+        except (AttributeError, OSError, ValueError):
+            data = None  # not a real file: fall back to reading
+    if data is None:
+        file.read(data_start - header_end)  # padding
+        data = np.frombuffer(bytearray(file.read(data_length)), dtype=np.uint8)
+
+    arrays = []
+    for offset, dtype, shape in blobs:
+        dtype = np.dtype(dtype)
+        n_bytes = dtype.itemsize * int(np.prod(shape))
+        arrays.append(data[offset:offset + n_bytes].view(dtype).reshape(shape))
+
+    return _ArrayRestoringUnpickler(BytesIO(header['payload']), arrays).load()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+In-memory index of the model files (<name>_<timestamp>.model) of a directory.
+The index is only updated when the modification time of the directory changes (i.e. files were added, removed or
+renamed), and then only the new files are examined, so lookups of the latest version or of a specific version do not
+depend on the number of versions.
+"""
+
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from .misc import FileHashIndex
+
+MODEL_FILE_PATTERN = re.compile(r'^([^_]+)_(.+)\.model$')
+
+# a directory modified less than this time before a scan might be modified again with the same mtime, so the scan is
+# not considered final
+MTIME_GRANULARITY_NS = 2_000_000_000
+
+
+def _timestamp_key(timestamp: str):
+    # numeric timestamps are sorted numerically, and before any non-numeric ones
+    try:
+        return 0, int(timestamp), timestamp
+    except ValueError:
+        return 1, 0, timestamp
+
+
+class ModelManifest:
+
+    def __init__(self, models_path, hash_index: Optional[FileHashIndex] = None):
+        """
+        Parameters
+        ----------
+        models_path : str or Path
+            Directory containing the model files
+        hash_index : FileHashIndex or None
+            Index used to calculate the hashes of the files. Default: a new in-memory index
+        """
+        self.models_path = Path(models_path)
+        self.hash_index = hash_index if hash_index is not None else FileHashIndex()
+        self.lock = threading.Lock()
+        self.models = {}  # name -> {timestamp: {'path', 'size'}}
+        self.latest = {}  # name -> latest timestamp
+        self.dir_mtime = None
+
+    def refresh(self, force=False):
+        """
+        Updates the index if the directory changed since the last update
+        """
+        try:
+            scan_time = time.time_ns()
+            dir_mtime = os.stat(self.models_path).st_mtime_ns
+        except OSError:
+            with self.lock:
+                self.models = {}
+                self.latest = {}
+                self.dir_mtime = None
+            return
+        with self.lock:
+            if not force and dir_mtime == self.dir_mtime:
+                return
+
+            found = set()
+            for dir_entry in os.scandir(self.models_path):
+                match = MODEL_FILE_PATTERN.match(dir_entry.name)
+                if match is None:
+                    continue
+                name, timestamp = match.groups()
+                found.add((name, timestamp))
+                versions = self.models.setdefault(name, {})
+                if timestamp in versions and not force:
+                    continue
+                try:
+                    size = dir_entry.stat().st_size
+                except OSError:
+                    continue
+                versions[timestamp] = {'path': Path(dir_entry.path), 'size': size}
+                if name not in self.latest or _timestamp_key(timestamp) > _timestamp_key(self.latest[name]):
+                    self.latest[name] = timestamp
+
+            # remove the deleted files
+            for name in list(self.models):
+                versions = self.models[name]
+                removed = [timestamp for timestamp in versions if (name, timestamp) not in found]
+                for timestamp in removed:
+                    del versions[timestamp]
+                if not versions:
+                    del self.models[name]
+                    del self.latest[name]
+                elif self.latest[name] in removed:
+                    self.latest[name] = max(versions, key=_timestamp_key)
+
+            # a recently modified directory might be modified again within the mtime resolution
+            self.dir_mtime = dir_mtime if scan_time - dir_mtime > MTIME_GRANULARITY_NS else None
+
+    def model_names(self) -> List[str]:
+        self.refresh()
+        with self.lock:
+            return list(self.models)
+
+    def timestamps(self, model_name: str) -> List[str]:
+        """
+        Returns the available timestamps of a model, sorted from oldest to newest
+        """
+        self.refresh()
+        with self.lock:
+            return sorted(self.models.get(model_name, {}), key=_timestamp_key)
+
+    def latest_timestamp(self, model_name: str) -> Optional[str]:
+        self.refresh()
+        with self.lock:
+            return self.latest.get(model_name)
+
+    def get(self, model_name: str, timestamp=None) -> Optional[dict]:
+        """
+        Returns the entry {'timestamp', 'path', 'size'} of a version of a model (default: the latest), or None
+        """
+        self.refresh()
+        with self.lock:
+            if timestamp is None:
+                timestamp = self.latest.get(model_name)
+            try:
+                entry = self.models[model_name][str(timestamp)]
+            except KeyError:
+                return None
+            return {'timestamp': str(timestamp), **entry}
+
+    def get_hash(self, model_name: str, timestamp=None) -> Optional[str]:
+        """
+        Returns the sha256 hash of a version of a model (default: the latest), or None if it does not exist
+        """
+        entry = self.get(model_name, timestamp)
+        if entry is None:
+            return None
+        return self.hash_index.get_hash(entry['path'])
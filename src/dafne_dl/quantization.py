@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Quantization of the weights of serialized models, to reduce the size of uploads and downloads.
+Modes:
+    QUANTIZATION_FLOAT16: weights are stored as float16
+    QUANTIZATION_INT8: weights are stored as int8 with a per-layer scale and zero point. Zero is represented exactly,
+        so the zeros of thresholded deltas are preserved.
+Weights are dequantized to their original data type when the model is loaded.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+from .sparse_weights import SparseLayer
+
+QUANTIZATION_FLOAT16 = 'float16'
+QUANTIZATION_INT8 = 'int8'
+QUANTIZATION_MODES = [QUANTIZATION_FLOAT16, QUANTIZATION_INT8]
+
+_INT8_MIN = -128
+_INT8_MAX = 127
+
+
+class QuantizedLayer:
+    """
+    Quantized representation of one weight array
+    """
+
+    def __init__(self, data, dtype, mode, scale=1.0, zero_point=0):
+        self.data = data
+        self.dtype = np.dtype(dtype)
+        self.mode = mode
+        self.scale = scale
+        self.zero_point = zero_point
+
+    @staticmethod
+    def quantize(arr, mode) -> QuantizedLayer:
+        arr = np.asarray(arr)
+        if mode == QUANTIZATION_FLOAT16:
+            return QuantizedLayer(arr.astype(np.float16), arr.dtype, mode)
+        elif mode == QUANTIZATION_INT8:
+            # the range always includes zero, so that zero is quantized exactly
+            min_value = min(float(arr.min()), 0.0) if arr.size > 0 else 0.0
+            max_value = max(float(arr.max()), 0.0) if arr.size > 0 else 0.0
+            scale = (max_value - min_value) / (_INT8_MAX - _INT8_MIN)
+            if scale == 0:
+                scale = 1.0
+            zero_point = int(np.clip(np.round(_INT8_MIN - min_value / scale), _INT8_MIN, _INT8_MAX))
+            data = np.clip(np.round(arr / scale) + zero_point, _INT8_MIN, _INT8_MAX).astype(np.int8)
+            return QuantizedLayer(data, arr.dtype, mode, scale, zero_point)
+        raise ValueError(f'Unknown quantization mode {mode}')
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def dequantize(self):
+        if self.mode == QUANTIZATION_INT8:
+            return ((self.data.astype(np.float64) - self.zero_point) * self.scale).astype(self.dtype)
+        return self.data.astype(self.dtype)
+
+
+def _is_quantizable(layer):
+    return isinstance(layer, np.ndarray) and np.issubdtype(layer.dtype, np.floating) and layer.dtype.itemsize > 2
+
+
+def quantize_layer(layer, mode):
+    """
+    Quantizes a layer. Sparse layers have their values quantized. Non-floating point layers are left unchanged.
+    """
+    if isinstance(layer, SparseLayer):
+        if not _is_quantizable(layer.values):
+            return layer
+        return SparseLayer(layer.shape, layer.dtype, QuantizedLayer.quantize(layer.values, mode), layer.indices,
+                           layer.bitmap)
+    if not _is_quantizable(layer):
+        return layer
+    return QuantizedLayer.quantize(layer, mode)
+
+
+def dequantize_layer(layer):
+    if isinstance(layer, QuantizedLayer):
+        return layer.dequantize()
+    if isinstance(layer, SparseLayer) and isinstance(layer.values, QuantizedLayer):
+        return SparseLayer(layer.shape, layer.dtype, layer.values.dequantize(), layer.indices, layer.bitmap)
+    return layer
+
+
+def quantize_weights(weights, mode):
+    return [quantize_layer(layer, mode) for layer in weights]
+
+
+def dequantize_weights(weights):
+    return [dequantize_layer(layer) for layer in weights]
+
+
+def measure_quantization(model, modes=None) -> dict:
+    """
+    Measures the effect of the quantization modes on a model
+
+    Parameters
+    ----------
+    model : DynamicDLModel
+        The model to measure
+    modes : list of str or None
+        Quantization modes to test. Default: all
+
+    Returns
+    -------
+    dict
+        For every mode: {
+            'payload_bytes': size of the serialized model,
+            'size_ratio': payload_bytes divided by the size of the unquantized serialized model,
+            'layers': list of {'shape', 'weight_bytes', 'quantized_bytes', 'max_error', 'mean_error'}
+        }
+        The key None contains the payload size without quantization.
+    """
+    if modes is None:
+        modes = QUANTIZATION_MODES
+    reference_size = len(model.dumps())
+    weights = model.get_weights()
+    report = {None: {'payload_bytes': reference_size, 'size_ratio': 1.0}}
+    for mode in modes:
+        layers = []
+        for layer in weights:
+            quantized = quantize_layer(layer, mode)
+            restored = np.asarray(dequantize_layer(quantized), dtype=np.float64)
+            error = np.abs(restored - np.asarray(layer, dtype=np.float64))
+            layers.append({
+                'shape': tuple(layer.shape),
+                'weight_bytes': layer.nbytes,
+                'quantized_bytes': quantized.nbytes,
+                'max_error': float(error.max()) if error.size > 0 else 0.0,
+                'mean_error': float(error.mean()) if error.size > 0 else 0.0
+            })
+        payload_bytes = len(model.dumps(quantization=mode))
+        report[mode] = {
+            'payload_bytes': payload_bytes,
+            'size_ratio': payload_bytes / reference_size,
+            'layers': layers
+        }
+    return report
+
+
+def print_quantization_report(report: dict):
+    """
+    Prints the output of measure_quantization as a table
+    """
+    reference_size = report[None]['payload_bytes']
+    print(f'Unquantized payload: {reference_size} bytes')
+    for mode, mode_report in report.items():
+        if mode is None:
+            continue
+        print(f'{mode}: {mode_report["payload_bytes"]} bytes ({mode_report["size_ratio"]:.1%} of unquantized)')
+        print(f'    {"layer":>5} {"shape":>20} {"max error":>12} {"mean error":>12}')
+        for i, layer in enumerate(mode_report['layers']):
+            print(f'    {i:5d} {str(layer["shape"]):>20} {layer["max_error"]:12.3g} {layer["mean_error"]:12.3g}')
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Sparse representation of weight layers, used to store thresholded deltas, which are mostly zeros.
+A SparseLayer can be added to a dense array (dense + sparse) without being densified, so the default apply_delta
+functions consume it directly.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+ENCODING_INDEX = 'index'  # flat indices of the nonzero elements + values
+ENCODING_BITMAP = 'bitmap'  # bitmap of the nonzero elements + values
+
+# layers of a delta with a density (fraction of nonzero elements) below this value are stored as sparse
+SPARSE_DENSITY_CUTOFF = 0.5
+
+
+class SparseLayer:
+    """
+    Sparse representation of one weight array
+    """
+
+    # make numpy defer to the operators of this class, instead of converting it to an array (dense + sparse)
+    __array_ufunc__ = None
+
+    def __init__(self, shape, dtype, values, indices=None, bitmap=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.values = values
+        self.indices = indices
+        self.bitmap = bitmap
+
+    @staticmethod
+    def from_dense(arr, encoding=None) -> SparseLayer:
+        """
+        Creates a sparse layer from a dense array
+
+        Parameters
+        ----------
+        arr : np.ndarray
+            The dense array
+        encoding : str or None
+            ENCODING_INDEX or ENCODING_BITMAP. Default: the smaller of the two
+        """
+        arr = np.asarray(arr)
+        flat = arr.reshape(-1)
+        nonzero = flat != 0
+        values = flat[nonzero]
+        if encoding is None:
+            index_bytes = values.size * (4 if flat.size < 2**32 else 8)
+            bitmap_bytes = (flat.size + 7) // 8
+            encoding = ENCODING_INDEX if index_bytes < bitmap_bytes else ENCODING_BITMAP
+        if encoding == ENCODING_INDEX:
+            index_dtype = np.uint32 if flat.size < 2**32 else np.uint64
+            return SparseLayer(arr.shape, arr.dtype, values, indices=np.flatnonzero(nonzero).astype(index_dtype))
+        elif encoding == ENCODING_BITMAP:
+            return SparseLayer(arr.shape, arr.dtype, values, bitmap=np.packbits(nonzero))
+        raise ValueError(f'Unknown encoding {encoding}')
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nnz(self):
+        return self.values.size
+
+    @property
+    def density(self):
+        return self.nnz / max(self.size, 1)
+
+    @property
+    def nbytes(self):
+        encoding_bytes = self.indices.nbytes if self.indices is not None else self.bitmap.nbytes
+        return self.values.nbytes + encoding_bytes
+
+    def flat_indices(self):
+        if self.indices is not None:
+            return self.indices.astype(np.intp, copy=False)
+        return np.flatnonzero(np.unpackbits(self.bitmap, count=self.size))
+
+    def to_dense(self, dtype=None):
+        out = np.zeros(self.size, dtype=dtype or self.dtype)
+        out[self.flat_indices()] = self.values
+        return out.reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype)
+
+    def add_to(self, out, factor=1):
+        """
+        In-place scatter-add into a dense array: out += factor * self
+        """
+        if tuple(out.shape) != self.shape:
+            raise ValueError('Incompatible shapes')
+        flat = out.reshape(-1)
+        if not np.shares_memory(flat, out):
+            raise ValueError('The output array must be contiguous')
+        values = self.values if factor == 1 else self.values * factor
+        flat[self.flat_indices()] += values
+        return out
+
+    def copy(self) -> SparseLayer:
+        return SparseLayer(self.shape, self.dtype, self.values.copy(),
+                           None if self.indices is None else self.indices.copy(),
+                           None if self.bitmap is None else self.bitmap.copy())
+
+    def _with_values(self, values):
+        return SparseLayer(self.shape, np.result_type(self.dtype, values.dtype), values, self.indices, self.bitmap)
+
+    def __add__(self, other):
+        if isinstance(other, SparseLayer):
+            return self.to_dense() + other
+        other = np.asarray(other)
+        out = np.array(np.broadcast_to(other, self.shape), dtype=np.result_type(other, self.dtype))
+        return self.add_to(out)
+
+    __radd__ = __add__
+
+    def __rsub__(self, other):
+        # other - self
+        other = np.asarray(other)
+        out = np.array(np.broadcast_to(other, self.shape), dtype=np.result_type(other, self.dtype))
+        return self.add_to(out, -1)
+
+    def __sub__(self, other):
+        if isinstance(other, SparseLayer):
+            return other.__rsub__(self.to_dense())
+        return -(other - self)
+
+    def __neg__(self):
+        return self._with_values(-self.values)
+
+    def __mul__(self, factor):
+        if not np.isscalar(factor):
+            return NotImplemented
+        return self._with_values(self.values * factor)
+
+    __rmul__ = __mul__
+
+
+def sparsify_weights(weights, density_cutoff=SPARSE_DENSITY_CUTOFF):
+    """
+    Converts the layers of a weight list with a density below the cutoff to SparseLayers
+    """
+    output = []
+    for layer in weights:
+        if isinstance(layer, np.ndarray) and layer.size > 0 and np.issubdtype(layer.dtype, np.number) and \
+                np.count_nonzero(layer) < density_cutoff * layer.size:
+            layer = SparseLayer.from_dense(layer)
+        output.append(layer)
+    return output
+
+
+def densify_weights(weights):
+    """
+    Converts the SparseLayers of a weight list to dense arrays
+    """
+    if not any(isinstance(layer, SparseLayer) for layer in weights):
+        return weights
+    return [layer.to_dense() if isinstance(layer, SparseLayer) else layer for layer in weights]
+
+
+def has_sparse_layers(weights) -> bool:
+    try:
+        return any(isinstance(layer, SparseLayer) for layer in weights)
+    except TypeError:
+        return False
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Streaming upload of a model: a serializer thread dumps the model into a bounded queue of chunks, which is sent as
+a chunked multipart/form-data request body while the sha256 of the model is computed. The hash is only known at the
+end, so it is sent as the last field of the form, after the model file. Memory use is bounded by
+UPLOAD_QUEUE_SIZE * UPLOAD_CHUNK_SIZE and nothing is written to disk.
+"""
+
+import hashlib
+import queue
+import threading
+import uuid
+
+UPLOAD_CHUNK_SIZE = 1024*1024  # 1 MB
+UPLOAD_QUEUE_SIZE = 4  # chunks buffered between the serializer and the connection
+QUEUE_POLL_TIME = 0.5  # seconds between checks for an aborted upload
+
+
+class _UploadAborted(Exception):
+    pass
+
+
+class _ChunkWriter:
+    """
+    Write-only file object that splits the written data into chunks, puts them into a queue and hashes them
+    """
+
+    def __init__(self, chunk_queue: queue.Queue, abort_event: threading.Event, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.chunk_queue = chunk_queue
+        self.abort_event = abort_event
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def _put(self, item):
+        while True:
+            if self.abort_event.is_set():
+                raise _UploadAborted()
+            try:
+                self.chunk_queue.put(item, timeout=QUEUE_POLL_TIME)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.hasher.update(data)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+def _form_field(boundary: str, name: str, value) -> bytes:
+    return (f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n').encode('utf-8')
+
+
+def stream_model_upload(connection_pool, url, model, file_field: str, file_name: str, fields: dict,
+                        hash_field='hash', chunk_size=UPLOAD_CHUNK_SIZE, queue_size=UPLOAD_QUEUE_SIZE):
+    """
+    Uploads a model as a multipart/form-data POST request with chunked transfer encoding, serializing it on the fly
+
+    Parameters
+    ----------
+    connection_pool : ConnectionPool
+        Pool used to send the request
+    url : str
+        The endpoint
+    model : DynamicDLModel
+        The model to upload. It must not be modified during the upload
+    file_field : str
+        Name of the form field containing the model
+    file_name : str
+        File name reported for the model
+    fields : dict
+        Other form fields, sent before the model
+    hash_field : str
+        Name of the form field containing the sha256 hash of the serialized model, sent after the model
+    chunk_size, queue_size :
+        Size of the chunks and maximum number of chunks waiting to be sent
+
+    Returns
+    -------
+    (requests.Response, str)
+        The response and the hash of the serialized model
+    """
+    boundary = uuid.uuid4().hex
+    chunk_queue = queue.Queue(queue_size)
+    abort_event = threading.Event()
+    writer = _ChunkWriter(chunk_queue, abort_event, chunk_size)
+    end_marker = object()
+
+    def serialize():
+        try:
+            model.dump(writer)
+            writer.finish()
+            writer._put(end_marker)
+        except _UploadAborted:
+            pass
+        except BaseException as e:
+            try:
+                writer._put(e)
+            except _UploadAborted:
+                pass
+
+    def body():
+        for name, value in fields.items():
+            yield _form_field(boundary, name, value)
+        yield (f'--{boundary}\r\n'
+               f'Content-Disposition: form-data; name="{file_field}"; filename="{file_name}"\r\n'
+               f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+        while True:
+            item = chunk_queue.get()
+            if item is end_marker:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        yield b'\r\n' + _form_field(boundary, hash_field, writer.hasher.hexdigest()) + f'--{boundary}--\r\n'.encode()
+
+    serializer_thread = threading.Thread(target=serialize, daemon=True)
+    serializer_thread.start()
+    try:
+        r = connection_pool.post(url, data=body(),
+                                 headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    finally:
+        abort_event.set()
+        serializer_thread.join()
+    return r, writer.hasher.hexdigest()
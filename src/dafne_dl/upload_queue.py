@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent queue of uploads, processed by a fixed number of worker threads.
+
+Every job is journaled as a json file in the journal directory until it is completed, so the uploads that are pending
+when the process exits are resumed by the next UploadQueue created on the same directory. Only the queue holding the
+lock file of the directory resumes the journal, so two processes sharing it do not upload the same files twice.
+Failed attempts are retried with exponential backoff and jitter. Jobs that failed permanently are kept (see
+retry_failed) until they expire, then they are deleted together with their file.
+"""
+
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+STATUS_PENDING = 'pending'
+STATUS_IN_PROGRESS = 'in_progress'
+STATUS_FAILED = 'failed'
+
+MAX_ATTEMPTS = 8
+BASE_DELAY = 2  # seconds before the first retry
+MAX_DELAY = 300  # maximum seconds between retries
+
+FAILED_JOB_EXPIRY = 7*24*3600  # seconds after which a failed job and its file are deleted
+
+JOURNAL_SUFFIX = '.job.json'
+LOCK_FILE = 'journal.lock'
+
+
+class UploadError(Exception):
+    """
+    Raised by the send function of an UploadQueue when an attempt fails.
+    If retryable is False, the job fails immediately (e.g. invalid api key)
+    """
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class UploadQueue:
+
+    def __init__(self, journal_dir, send_function: Callable[[dict], None], max_workers=2,
+                 max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 failed_job_expiry=FAILED_JOB_EXPIRY):
+        """
+        Parameters
+        ----------
+        journal_dir : str or Path
+            Directory where the pending jobs are stored
+        send_function : Callable[[dict], None]
+            Performs one attempt of a job, receiving the job dictionary ('id', 'kind', 'filename', 'params',
+            'attempts'). It raises UploadError (or any other exception, which is treated as retryable) on failure.
+            It can store values in job['params'] (e.g. a hash) that are journaled for the next attempts
+        max_workers : int
+            Maximum number of uploads running at the same time
+        max_attempts : int
+            Attempts before a job is marked as failed
+        base_delay, max_delay : float
+            The delay before retry n is min(max_delay, base_delay * 2**(n-1)), randomized between half and full value
+        failed_job_expiry : float or None
+            Seconds after which a failed job is removed from the journal and its file deleted. None: never
+        """
+        self.journal_dir = str(journal_dir)
+        self.send_function = send_function
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failed_job_expiry = failed_job_expiry
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+        self.condition = threading.Condition()
+        self.jobs = {}  # id -> job, for all the jobs that are not completed
+        self.schedule = []  # heap of (due time, sequence number, job id)
+        self.sequence = 0
+        self.n_in_progress = 0
+        self.n_completed = 0
+        self.stopped = False
+
+        self.lock_file = self._acquire_lock()
+        if self.lock_file is not None:
+            self._load_journal()
+        else:
+            print('The upload journal is in use by another process. Pending uploads are not resumed')
+
+        self.workers = []
+        for _ in range(max_workers):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _acquire_lock(self):
+        # returns the open lock file, or None if another queue holds the lock
+        lock_file = open(os.path.join(self.journal_dir, LOCK_FILE), 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _release_lock(self):
+        if self.lock_file is not None:
+            self.lock_file.close()  # closing the file releases the lock
+            self.lock_file = None
+
+    def _journal_path(self, job_id):
+        return os.path.join(self.journal_dir, job_id + JOURNAL_SUFFIX)
+
+    def _write_journal(self, job):
+        temp_file = self._journal_path(job['id']) + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(job, f)
+            os.replace(temp_file, self._journal_path(job['id']))
+        except OSError:
+            print('Error writing the upload journal')
+
+    def _remove_journal(self, job_id):
+        try:
+            os.remove(self._journal_path(job_id))
+        except OSError:
+            pass
+
+    def _load_journal(self):
+        for file_name in sorted(os.listdir(self.journal_dir)):
+            if not file_name.endswith(JOURNAL_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.journal_dir, file_name), 'r') as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                print('Invalid upload journal entry', file_name)
+                continue
+            if not os.path.exists(job['filename']):
+                print('File of pending upload not found', job['filename'])
+                self._remove_journal(job['id'])
+                continue
+            with self.condition:
+                self.jobs[job['id']] = job
+                if job['status'] != STATUS_FAILED:
+                    print('Resuming upload of', job['filename'])
+                    job['status'] = STATUS_PENDING
+                    self._schedule(job, 0)
+        with self.condition:
+            self._remove_expired()
+
+    def _schedule(self, job, delay):
+        # must be called with the condition acquired
+        self.sequence += 1
+        heapq.heappush(self.schedule, (time.monotonic() + delay, self.sequence, job['id']))
+        self.condition.notify()
+
+    def submit(self, kind: str, filename: str, params: Optional[dict] = None) -> str:
+        """
+        Adds an upload to the queue
+
+        Parameters
+        ----------
+        kind : str
+            Type of upload, interpreted by the send function
+        filename : str
+            File to upload. It is deleted when the upload succeeds
+        params : dict or None
+            Additional json-serializable parameters for the send function
+
+        Returns
+        -------
+        The job id
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'filename': os.path.abspath(str(filename)),
+            'params': params or {},
+            'attempts': 0,
+            'status': STATUS_PENDING,
+            'created': time.time(),
+            'last_error': None
+        }
+        self._write_journal(job)
+        with self.condition:
+            self.jobs[job['id']] = job
+            self._schedule(job, 0)
+        return job['id']
+
+    def _retry_delay(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    now = time.monotonic()
+                    if self.schedule and self.schedule[0][0] <= now:
+                        _, _, job_id = heapq.heappop(self.schedule)
+                        break
+                    self.condition.wait(self.schedule[0][0] - now if self.schedule else None)
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                job['status'] = STATUS_IN_PROGRESS
+                job['attempts'] += 1
+                self.n_in_progress += 1
+
+            error = None
+            try:
+                self.send_function(job)
+            except UploadError as e:
+                error = e
+            except Exception as e:
+                error = UploadError(str(e))
+
+            with self.condition:
+                self.n_in_progress -= 1
+                if error is None:
+                    self._delete_job(job)
+                    self.n_completed += 1
+                else:
+                    job['last_error'] = str(error)
+                    if error.retryable and job['attempts'] < self.max_attempts:
+                        delay = self._retry_delay(job['attempts'])
+                        print(f'Upload of {job["filename"]} failed ({error}). Retrying in {delay:.0f} s')
+                        job['status'] = STATUS_PENDING
+                        self._schedule(job, delay)
+                    else:
+                        print(f'Upload of {job["filename"]} failed ({error})')
+                        job['status'] = STATUS_FAILED
+                        job['failed_time'] = time.time()
+                    self._write_journal(job)
+                    self._remove_expired()
+                self.condition.notify_all()
+
+    def _delete_job(self, job):
+        # must be called with the condition acquired
+        del self.jobs[job['id']]
+        self._remove_journal(job['id'])
+        try:
+            os.remove(job['filename'])
+        except OSError:
+            pass
+
+    def _remove_expired(self):
+        # must be called with the condition acquired
+        if self.failed_job_expiry is None:
+            return
+        self.remove_failed(self.failed_job_expiry)
+
+    def remove_failed(self, min_age: float = 0):
+        """
+        Deletes the failed jobs, and their files, that failed at least min_age seconds ago
+        """
+        now = time.time()
+        with self.condition:
+            for job in list(self.jobs.values()):
+                if job['status'] == STATUS_FAILED and now - job.get('failed_time', job['created']) >= min_age:
+                    print('Removing failed upload', job['filename'])
+                    self._delete_job(job)
+
+    def retry_failed(self):
+        """
+        Schedules the failed jobs again
+        """
+        with self.condition:
+            for job in self.jobs.values():
+                if job['status'] == STATUS_FAILED:
+                    job['status'] = STATUS_PENDING
+                    job['attempts'] = 0
+                    job.pop('failed_time', None)
+                    self._write_journal(job)
+                    self._schedule(job, 0)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until all the jobs are completed or failed
+
+        Parameters
+        ----------
+        timeout : float or None
+            Maximum time to wait in seconds. None: no limit
+
+        Returns
+        -------
+        True if no jobs are pending or in progress
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while any(job['status'] != STATUS_FAILED for job in self.jobs.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def get_status(self) -> dict:
+        """
+        Returns the number of pending, in progress, failed and completed (since start) jobs, and a copy of the jobs
+        that are not completed
+        """
+        with self.condition:
+            jobs = [dict(job) for job in self.jobs.values()]
+            return {
+                STATUS_PENDING: sum(1 for job in jobs if job['status'] == STATUS_PENDING),
+                STATUS_IN_PROGRESS: self.n_in_progress,
+                STATUS_FAILED: sum(1 for job in jobs if job['status'] == STATUS_FAILED),
+                'completed': self.n_completed,
+                'jobs': jobs
+            }
+
+    def stop(self):
+        """
+        Stops the workers after their current attempt and releases the journal. Pending jobs stay in the journal
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            self._release_lock()
@@ -0,0 +1,55 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Small self-contained models for the tests. The internal model only holds a list of weights, so no deep learning
+framework is needed.
+"""
+
+import numpy as np
+
+from dafne_dl.DynamicDLModel import DynamicDLModel
+
+
+def init_model_function():
+    # stand-in for a keras model: get_weights returns new arrays
+    class WeightHolder:
+        def __init__(self):
+            self.weights = []
+
+        def get_weights(self):
+            return [layer.copy() for layer in self.weights]
+
+        def set_weights(self, weights):
+            self.weights = [layer.copy() for layer in weights]
+
+    return WeightHolder()
+
+
+def threshold_apply_function(modelObj, data):
+    # segments the pixels above 0.5 of the image
+    import numpy as np
+    return {'bright': (np.asarray(data['image']) > 0.5).astype(np.uint8)}
+
+
+def make_model(weights, model_id='test', timestamp_id=1, is_delta=False, **kwargs) -> DynamicDLModel:
+    return DynamicDLModel(model_id, init_model_function, threshold_apply_function,
+                          weights=[np.asarray(layer) for layer in weights], timestamp_id=timestamp_id,
+                          is_delta=is_delta, **kwargs)
+
+
+def dumped_model(model_id='test', size=100_000, seed=0) -> bytes:
+    weights = [np.random.default_rng(seed).random(size).astype(np.float32)]
+    return make_model(weights, model_id=model_id).dumps()
@@ -0,0 +1,180 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local stand-in for the model server, used to test the remote providers. It serves the models given at construction
+(name -> dumped model) through info_model, get_model (with optional Range support, throttling and interrupted
+transfers), get_model_delta and get_available_models, and counts the requests and the concurrent downloads.
+Models sent to upload_model (multipart/form-data, with or without chunked transfer encoding) are recorded in
+uploads.
+"""
+
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TIMESTAMP = 1
+
+
+class StandInModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, models: dict, support_range=True, chunk_size=64 * 1024, chunk_delay=0.0, deltas=None,
+                 timestamp=TIMESTAMP, accept_chunked_uploads=True):
+        super().__init__(('127.0.0.1', 0), _StandInHandler)
+        self.models = models
+        self.deltas = deltas or {}  # name -> delta from the previous version
+        self.timestamp = timestamp
+        self.hashes = {name: hashlib.sha256(data).hexdigest() for name, data in models.items()}
+        self.support_range = support_range
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.interrupt_next = 0  # number of next get_model responses that are cut in the middle
+        self.accept_chunked_uploads = accept_chunked_uploads  # if False, chunked uploads are answered with 411
+        self.uploads = []  # {'fields': {name: bytes}, 'chunked': bool} for every accepted upload
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.ranges = []
+        self.active_downloads = 0
+        self.peak_downloads = 0
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # clients closing their connections (e.g. cancelled downloads) are expected
+        if not isinstance(sys.exc_info()[1], OSError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = bytearray()
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return bytes(body)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _receive_upload(self, body: bytes):
+        server = self.server
+        chunked = self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        if chunked and not server.accept_chunked_uploads:
+            self._send_json({'message': 'Length required'}, 411)
+            return
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        fields = {}
+        for part in body.split(b'--' + boundary)[1:-1]:
+            headers, content = part[2:-2].split(b'\r\n\r\n', 1)
+            name = headers.split(b'name="')[1].split(b'"')[0].decode()
+            fields[name] = content
+        with server.lock:
+            server.uploads.append({'fields': fields, 'chunked': chunked})
+        self._send_json({'message': 'ok'})
+
+    def do_POST(self):
+        body = self._read_body()
+        endpoint = self.path.strip('/')
+        server = self.server
+        with server.lock:
+            server.requests[endpoint] += 1
+        if endpoint == 'upload_model':
+            self._receive_upload(body)
+            return
+        request = json.loads(body or b'{}')
+        if endpoint == 'get_available_models':
+            self._send_json({'models': list(server.models)})
+            return
+        name = request.get('model_type')
+        if name not in server.models or endpoint not in ('info_model', 'get_model', 'get_model_delta') or \
+                (endpoint == 'get_model_delta' and name not in server.deltas):
+            self._send_json({'message': 'not found'}, 404)
+            return
+        if endpoint == 'info_model':
+            self._send_json({'latest_timestamp': server.timestamp, 'timestamps': [server.timestamp],
+                             'hash': server.hashes[name], 'hashes': {str(server.timestamp): server.hashes[name]}})
+            return
+        if endpoint == 'get_model_delta':
+            self._send_model(server.deltas[name])
+            return
+        self._send_model(server.models[name])
+
+    def _send_model(self, data):
+        server = self.server
+        range_header = self.headers.get('Range')
+        with server.lock:
+            server.ranges.append(range_header)
+            interrupt = server.interrupt_next > 0
+            if interrupt:
+                server.interrupt_next -= 1
+        start = 0
+        if range_header and server.support_range:
+            start = int(range_header[len('bytes='):].split('-')[0])
+        body = data[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if interrupt:
+            body = body[:len(body) // 2]
+        with server.lock:
+            server.active_downloads += 1
+            server.peak_downloads = max(server.peak_downloads, server.active_downloads)
+        try:
+            for position in range(0, len(body), server.chunk_size):
+                if server.chunk_delay:
+                    time.sleep(server.chunk_delay)
+                self.wfile.write(body[position:position + server.chunk_size])
+        except OSError:
+            pass  # the client closed the connection
+        finally:
+            with server.lock:
+                server.active_downloads -= 1
+        if interrupt:
+            self.close_connection = True
@@ -0,0 +1,116 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from dafne_dl.aggregation import ModelAggregator, aggregate_models, METHOD_MEAN, METHOD_TRIMMED_MEAN
+from dafne_dl.interfaces import IncompatibleModelError
+
+from .helpers import make_model
+
+
+def _weights(model):
+    return [np.asarray(layer) for layer in model.get_weights()]
+
+
+def test_weighted_mean():
+    models = [(make_model([[0., 2.], [[1.]]]), 1.0), (make_model([[4., 2.], [[3.]]]), 3.0)]
+    result = _weights(aggregate_models(models, METHOD_MEAN))
+    np.testing.assert_allclose(result[0], [3., 2.])
+    np.testing.assert_allclose(result[1], [[2.5]])
+
+
+def test_trimmed_mean_matches_reference():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(7, 50)).astype(np.float32)
+    client_weights = rng.uniform(0.5, 2, size=7)
+    result = aggregate_models([(make_model([v]), w) for v, w in zip(values, client_weights)],
+                              METHOD_TRIMMED_MEAN, trim=2)
+
+    np.testing.assert_allclose(_weights(result)[0], _sorted_trimmed_mean(values, client_weights, 2), rtol=1e-5)
+
+
+def test_trimmed_mean_tied_values_with_unequal_weights():
+    # the tied elements (e.g. frozen layers) must keep their value, even if the first model has most of the weight
+    models = [(make_model([[0., 1., 2.]]), 2.0),
+              (make_model([[5., 1., 2.]]), 1.0),
+              (make_model([[9., 1., 2.]]), 1.0)]
+    result = aggregate_models(models, METHOD_TRIMMED_MEAN, trim=1)
+    np.testing.assert_allclose(_weights(result)[0], [5., 1., 2.])
+
+
+def test_trimmed_mean_all_tied_trim_2():
+    models = [(make_model([[3., -1.]]), w) for w in (5., 1., 1., 1., 1.)]
+    result = aggregate_models(models, METHOD_TRIMMED_MEAN, trim=2)
+    np.testing.assert_allclose(_weights(result)[0], [3., -1.])
+
+
+def _sorted_trimmed_mean(values, client_weights, trim):
+    # reference: stable sort of every element, so that ties are ranked in insertion order
+    expected = np.empty(values.shape[1])
+    for element in range(values.shape[1]):
+        kept = np.argsort(values[:, element], kind='stable')[trim:len(values) - trim]
+        expected[element] = np.average(values[kept, element], weights=client_weights[kept])
+    return expected
+
+
+def test_trimmed_mean_ties_with_trim_3():
+    values = np.array([[1.], [1.], [1.], [0.], [0.], [1.], [1.]], dtype=np.float32)
+    client_weights = np.array([3., 1., 4., 1., 1., 4., 4.])
+    result = aggregate_models([(make_model([v]), w) for v, w in zip(values, client_weights)],
+                              METHOD_TRIMMED_MEAN, trim=3)
+    np.testing.assert_allclose(_weights(result)[0], _sorted_trimmed_mean(values, client_weights, 3))
+
+
+@pytest.mark.parametrize('trim', [2, 3])
+def test_trimmed_mean_ties_match_sorted_reference(trim):
+    rng = np.random.default_rng(trim)
+    values = rng.integers(0, 3, size=(9, 200)).astype(np.float32)
+    client_weights = rng.integers(1, 6, size=9).astype(np.float64)
+    result = aggregate_models([(make_model([v]), w) for v, w in zip(values, client_weights)],
+                              METHOD_TRIMMED_MEAN, trim=trim)
+    np.testing.assert_allclose(_weights(result)[0], _sorted_trimmed_mean(values, client_weights, trim), rtol=1e-5)
+
+
+def test_trimmed_mean_needs_enough_models():
+    aggregator = ModelAggregator(METHOD_TRIMMED_MEAN, trim=1)
+    aggregator.add(make_model([[1.]]))
+    aggregator.add(make_model([[2.]]))
+    with pytest.raises(ValueError):
+        aggregator.result()
+
+
+def test_trimmed_mean_zero_remaining_weight_raises():
+    models = [(make_model([[0.]]), 1.0), (make_model([[1.]]), 0.0), (make_model([[2.]]), 1.0)]
+    with pytest.raises(ValueError):
+        aggregate_models(models, METHOD_TRIMMED_MEAN, trim=1)
+
+
+def test_incompatible_models():
+    aggregator = ModelAggregator()
+    aggregator.add(make_model([[1.]]))
+    with pytest.raises(IncompatibleModelError):
+        aggregator.add(make_model([[1.]], model_id='other'))
+    with pytest.raises(IncompatibleModelError):
+        aggregator.add(make_model([[1.]], is_delta=True))
+
+
+def test_delta_result_keeps_base_timestamp():
+    deltas = [make_model([[1.]], timestamp_id=42, is_delta=True), make_model([[3.]], timestamp_id=42, is_delta=True)]
+    result = aggregate_models(deltas)
+    assert result.is_delta
+    assert result.timestamp_id == 42
+    np.testing.assert_allclose(_weights(result)[0], [2.])
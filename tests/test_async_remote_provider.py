@@ -0,0 +1,84 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+from dafne_dl.AsyncRemoteModelProvider import AsyncRemoteModelProvider
+from dafne_dl.DynamicDLModel import DynamicDLModel
+from dafne_dl.RemoteModelProvider import PART_SUFFIX
+
+from .helpers import dumped_model
+from .model_server import StandInModelServer
+
+remote_module = sys.modules['dafne_dl.RemoteModelProvider']
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(remote_module, 'DOWNLOAD_BLOCK_SIZE', 16 * 1024)
+
+
+def _provider(tmp_path, server, **kwargs):
+    return AsyncRemoteModelProvider(tmp_path / 'models', server.url, 'key', str(tmp_path / 'upload'), timeout=(5, 5),
+                                    **kwargs)
+
+
+def test_concurrent_downloads_are_limited(tmp_path):
+    models = {name: dumped_model(name, seed=seed) for seed, name in enumerate('abcd')}
+
+    async def load_all(server):
+        async with _provider(tmp_path, server, max_concurrent_downloads=2) as provider:
+            names = await provider.available_models()
+            progress = {}
+            models = await provider.load_models(names, lambda name, current, total: progress.update({name: (current, total)}))
+            provider.provider.upload_queue.stop()
+            return models, progress
+
+    with StandInModelServer(models, chunk_size=16 * 1024, chunk_delay=0.01) as server:
+        loaded, progress = asyncio.run(load_all(server))
+    assert sorted(loaded) == sorted(models)
+    assert all(isinstance(model, DynamicDLModel) for model in loaded.values())
+    assert all(current == total == len(models[name]) for name, (current, total) in progress.items())
+    assert server.peak_downloads == 2
+
+
+def test_cancelled_download_is_resumed(tmp_path):
+    data = dumped_model()
+
+    async def cancel_then_load(server):
+        async with _provider(tmp_path, server) as provider:
+            task = asyncio.create_task(provider.load_model('test'))
+            while not os.path.exists(tmp_path / 'models' / f'test_1.model{PART_SUFFIX}'):
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # the download thread is stopped before the task completes
+            part_size = os.path.getsize(tmp_path / 'models' / f'test_1.model{PART_SUFFIX}')
+            model = await provider.load_model('test')
+            provider.provider.upload_queue.stop()
+            return part_size, model
+
+    with StandInModelServer({'test': data}, chunk_size=16 * 1024, chunk_delay=0.01) as server:
+        part_size, model = asyncio.run(cancel_then_load(server))
+    assert 0 < part_size < len(data)
+    assert isinstance(model, DynamicDLModel)
+    assert server.requests['get_model'] == 2
+    assert server.ranges[1] == f'bytes={part_size}-'
+    assert not any(name.endswith(PART_SUFFIX) for name in os.listdir(tmp_path / 'models'))
@@ -0,0 +1,120 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from dafne_dl.common.DataGenerators import DataGeneratorMem, PrefetchingDataGenerator
+
+
+def _training_data(n_samples=10, dim=(8, 6), n_labels=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((*dim, n_labels + 2)).astype(np.float32) for _ in range(n_samples)]
+
+
+@pytest.mark.parametrize('stack', [False, True])
+def test_batches_match_samples(stack):
+    data = _training_data()
+    generator = DataGeneratorMem(data, list_X=list(range(10)), batch_size=4, dim=(8, 6), shuffle=True, stack=stack)
+    for index in range(len(generator)):
+        X, y = generator[index]
+        ids = [generator.list_X[k] for k in generator.indexes[index * 4:(index + 1) * 4]]
+        for i, sample_id in enumerate(ids):
+            np.testing.assert_array_equal(X[i, :, :, 0], data[sample_id][:, :, 0])
+            np.testing.assert_array_equal(X[i, :, :, 1], data[sample_id][:, :, -1])
+            np.testing.assert_array_equal(y[i], data[sample_id][:, :, 1:-1])
+
+
+def test_stacked_ids_are_validated():
+    data = _training_data()
+    with pytest.raises(IndexError):
+        DataGeneratorMem(data, list_X=list(range(1, 12)), batch_size=4, dim=(8, 6), stack=True)
+    with pytest.raises(IndexError):
+        DataGeneratorMem(data, list_X=[-1, 0, 1, 2], batch_size=4, dim=(8, 6), stack=True)
+
+
+def test_batches_are_not_recycled_by_default():
+    generator = DataGeneratorMem(_training_data(), list_X=list(range(10)), batch_size=2, dim=(8, 6), shuffle=False)
+    batches = [generator[index] for index in range(len(generator))]
+    assert len({id(X) for X, y in batches}) == len(batches)
+
+
+class _SlowGenerator:
+    def __init__(self, n_batches=6, delay=0.0):
+        self.n_batches = n_batches
+        self.delay = delay
+
+    def __len__(self):
+        return self.n_batches
+
+    def __getitem__(self, index):
+        time.sleep(self.delay)
+        return index
+
+    def on_epoch_end(self):
+        pass
+
+
+@pytest.mark.parametrize('n_buffers', [0, 3, 8])
+def test_prefetching_default_queue_size(n_buffers):
+    generator = DataGeneratorMem(_training_data(), list_X=list(range(10)), batch_size=2, dim=(8, 6), shuffle=False,
+                                 n_buffers=n_buffers)
+    prefetching = PrefetchingDataGenerator(generator)
+    try:
+        for index in range(len(prefetching)):
+            X, y = prefetching[index]
+            np.testing.assert_array_equal(y[0], generator.training_data_list[2 * index][:, :, 1:-1])
+    finally:
+        prefetching.close()
+
+
+def test_prefetching_rejects_incompatible_queue_size():
+    generator = DataGeneratorMem(_training_data(), list_X=list(range(10)), batch_size=2, dim=(8, 6), n_buffers=3)
+    with pytest.raises(ValueError):
+        PrefetchingDataGenerator(generator, queue_size=4)
+
+
+def test_prefetching_order_and_out_of_order_requests():
+    prefetching = PrefetchingDataGenerator(_SlowGenerator(delay=0.01))
+    try:
+        assert [prefetching[index] for index in range(3)] == [0, 1, 2]
+        assert prefetching[5] == 5
+        assert prefetching[1] == 1
+        assert prefetching.get_stats()['out_of_order'] >= 1
+    finally:
+        prefetching.close()
+
+
+def test_close_wakes_up_waiting_requests():
+    prefetching = PrefetchingDataGenerator(_SlowGenerator(delay=0.5), n_workers=1)
+    errors = []
+
+    def request():
+        try:
+            prefetching[0]
+            prefetching[1]
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    time.sleep(0.1)
+    prefetching.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(errors) == 1
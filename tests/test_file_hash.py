@@ -0,0 +1,182 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+import pytest
+
+import dafne_dl.misc as misc
+from dafne_dl.misc import FileHashIndex, calculate_file_hash, file_signature
+
+
+@pytest.fixture
+def hash_calls(monkeypatch):
+    calls = []
+    calculate_stream_hash = misc.calculate_stream_hash
+
+    def counting_hash(stream, *args, **kwargs):
+        calls.append(stream.name)
+        return calculate_stream_hash(stream, *args, **kwargs)
+
+    monkeypatch.setattr(misc, 'calculate_stream_hash', counting_hash)
+    return calls
+
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def _set_mtime_ns(path, mtime_ns):
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_file_signature(tmp_path):
+    path = tmp_path / 'data.bin'
+    _write(path, b'12345')
+    st = os.stat(path)
+    assert file_signature(path) == (5, st.st_mtime_ns, st.st_ino)
+
+
+def test_sidecar_hash_is_reused(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'first')
+    assert calculate_file_hash(path, cache_results=True) == _sha256(b'first')
+    assert calculate_file_hash(path, cache_results=True) == _sha256(b'first')
+    assert len(hash_calls) == 1
+    with open(str(path) + '.sha256') as f:
+        assert f.read().split('\n') == [_sha256(b'first'), ' '.join(str(v) for v in file_signature(path))]
+
+
+def test_sidecar_hash_is_recalculated_on_size_change(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'first')
+    mtime_ns = os.stat(path).st_mtime_ns
+    calculate_file_hash(path, cache_results=True)
+    _write(path, b'first, but longer')
+    _set_mtime_ns(path, mtime_ns)  # only the size differs
+    assert calculate_file_hash(path, cache_results=True) == _sha256(b'first, but longer')
+    assert len(hash_calls) == 2
+
+
+def test_sidecar_hash_is_recalculated_on_mtime_change(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'first')
+    _set_mtime_ns(path, 1_000_000_000_000_000_000)
+    calculate_file_hash(path, cache_results=True)
+    _write(path, b'other')  # same size
+    _set_mtime_ns(path, 1_000_000_000_000_000_001)
+    assert calculate_file_hash(path, cache_results=True) == _sha256(b'other')
+    assert len(hash_calls) == 2
+
+
+@pytest.mark.parametrize('legacy_content', ['{hash}', '{hash}\n'])
+def test_legacy_sidecar_is_upgraded(tmp_path, hash_calls, legacy_content):
+    path = tmp_path / 'data.bin'
+    _write(path, b'content')
+    with open(str(path) + '.sha256', 'w') as f:
+        f.write(legacy_content.format(hash=_sha256(b'content')))
+
+    # a sidecar without signature cannot be trusted, so the hash is calculated and the sidecar rewritten
+    assert calculate_file_hash(path, cache_results=True) == _sha256(b'content')
+    assert len(hash_calls) == 1
+    with open(str(path) + '.sha256') as f:
+        assert f.readline().strip() == _sha256(b'content')
+        assert f.readline().strip() == ' '.join(str(v) for v in file_signature(path))
+
+    assert calculate_file_hash(path, cache_results=True) == _sha256(b'content')
+    assert len(hash_calls) == 1
+
+
+def test_force_rewrite_cache(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'content')
+    calculate_file_hash(path, cache_results=True)
+    calculate_file_hash(path, cache_results=True, force_rewrite_cache=True)
+    assert len(hash_calls) == 2
+
+
+def test_hash_index_reuses_unchanged_files(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'content')
+    index = FileHashIndex()
+    assert index.get_hash(path) == _sha256(b'content')
+    assert index.get_hash(str(path)) == _sha256(b'content')
+    assert len(hash_calls) == 1
+    assert index.get_hash(path, force_recalculate=True) == _sha256(b'content')
+    assert len(hash_calls) == 2
+
+
+def test_hash_index_recalculates_changed_files(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'first')
+    _set_mtime_ns(path, 1_000_000_000_000_000_000)
+    index = FileHashIndex()
+    index.get_hash(path)
+
+    _write(path, b'other')  # same size, different mtime
+    _set_mtime_ns(path, 1_000_000_000_000_000_001)
+    assert index.get_hash(path) == _sha256(b'other')
+
+    _write(path, b'other, longer')  # different size, same mtime
+    _set_mtime_ns(path, 1_000_000_000_000_000_001)
+    assert index.get_hash(path) == _sha256(b'other, longer')
+    assert len(hash_calls) == 3
+
+
+def test_hash_index_store_and_invalidate(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    _write(path, b'content')
+    index = FileHashIndex()
+    index.store(path, 'known')
+    assert index.get_hash(path) == 'known'
+    assert hash_calls == []
+    index.invalidate(path)
+    assert index.get_hash(path) == _sha256(b'content')
+    assert len(hash_calls) == 1
+
+
+def test_hash_index_persistence(tmp_path, hash_calls):
+    path = tmp_path / 'data.bin'
+    deleted_path = tmp_path / 'deleted.bin'
+    _write(path, b'content')
+    _write(deleted_path, b'deleted')
+    index_file = tmp_path / 'index.json'
+    index = FileHashIndex(index_file)
+    index.get_hash(path)
+    index.get_hash(deleted_path)
+    os.remove(deleted_path)
+
+    reloaded = FileHashIndex(index_file)
+    assert reloaded.get_hash(path) == _sha256(b'content')
+    assert len(hash_calls) == 2
+    # entries of deleted files are dropped the next time the index is saved
+    new_path = tmp_path / 'new.bin'
+    _write(new_path, b'new')
+    reloaded.store(new_path, 'known')
+    with open(index_file) as f:
+        assert sorted(json.load(f)) == sorted([os.path.abspath(str(path)), os.path.abspath(str(new_path))])
+
+
+def test_hash_index_ignores_corrupted_file(tmp_path):
+    index_file = tmp_path / 'index.json'
+    index_file.write_text('{not json')
+    assert FileHashIndex(index_file).entries == {}
@@ -0,0 +1,179 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+
+import numpy as np
+import pytest
+
+import dafne_dl.flat_weights as flat_weights_module
+from dafne_dl.DynamicDLModel import DynamicDLModel, WeightsOnlyModel
+from dafne_dl.flat_weights import FlatWeights, FLAT_WEIGHT_FUNCTIONS, thresholded_delta, linear_combination
+from dafne_dl.sparse_weights import SparseLayer
+
+from .helpers import make_model
+
+SHAPES = [(31, 40), (7,), (3, 3, 5, 11)]  # 1742 elements
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # the buffers span several chunks, with a partial last one
+    monkeypatch.setattr(flat_weights_module, 'CHUNK_SIZE', 500)
+
+
+def _weights(seed):
+    rng = np.random.default_rng(seed)
+    return [rng.normal(size=shape).astype(np.float32) for shape in SHAPES]
+
+
+def _model_pair(seed):
+    weights = _weights(seed)
+    return make_model(weights), make_model(weights, **FLAT_WEIGHT_FUNCTIONS)
+
+
+def _assert_same_weights(flat_model, keras_model):
+    flat = flat_model.get_weights()
+    reference = keras_model.get_weights()
+    assert len(flat) == len(reference)
+    for flat_layer, reference_layer in zip(flat, reference):
+        assert flat_layer.shape == reference_layer.shape
+        np.testing.assert_allclose(flat_layer, reference_layer, rtol=1e-6, atol=1e-7)
+
+
+def test_buffer_spans_several_chunks():
+    flat = FlatWeights.from_list(_weights(0))
+    assert flat.buffer.size > flat_weights_module.CHUNK_SIZE
+    assert flat.buffer.size % flat_weights_module.CHUNK_SIZE != 0
+
+
+def test_from_list_views_share_the_buffer():
+    weights = _weights(0)
+    flat = FlatWeights.from_list(weights)
+    assert flat.shapes == SHAPES
+    for view, layer in zip(flat, weights):
+        np.testing.assert_array_equal(view, layer)
+        assert np.shares_memory(view, flat.buffer)
+    assert FlatWeights.from_list(flat) is flat
+    assert FlatWeights.copy_of(flat).buffer is not flat.buffer
+
+
+@pytest.mark.parametrize('threshold', [None, 0.5])
+def test_calc_delta_matches_default(threshold):
+    keras_a, flat_a = _model_pair(0)
+    keras_b, flat_b = _model_pair(1)
+    flat_delta = flat_a.calc_delta(flat_b, threshold)
+    keras_delta = keras_a.calc_delta(keras_b, threshold)
+    assert flat_delta.is_delta and flat_delta.timestamp_id == keras_delta.timestamp_id
+    _assert_same_weights(flat_delta, keras_delta)
+
+
+def test_apply_delta_matches_default():
+    keras_a, flat_a = _model_pair(0)
+    keras_b, flat_b = _model_pair(1)
+    _assert_same_weights(flat_a.apply_delta(flat_b), keras_a.apply_delta(keras_b))
+
+
+def test_factor_multiply_matches_default():
+    keras_model, flat_model = _model_pair(0)
+    _assert_same_weights(flat_model.factor_multiply(0.3), keras_model.factor_multiply(0.3))
+
+
+def test_copy_matches_default():
+    keras_model, flat_model = _model_pair(0)
+    copy = flat_model.copy()
+    _assert_same_weights(copy, keras_model)
+    copy.get_weights()[0][0, 0] = 100
+    assert flat_model.get_weights()[0][0, 0] != 100
+
+
+def test_operations_do_not_modify_the_operands():
+    _, flat_a = _model_pair(0)
+    _, flat_b = _model_pair(1)
+    flat_a.calc_delta(flat_b, 0.5)
+    flat_a.apply_delta(flat_b)
+    flat_a.factor_multiply(2)
+    for layer, expected in zip(flat_a.get_weights(), _weights(0)):
+        np.testing.assert_array_equal(layer, expected)
+
+
+def test_thresholded_delta_in_place():
+    a = FlatWeights.from_list(_weights(0))
+    b = FlatWeights.from_list(_weights(1))
+    expected = a.buffer - b.buffer
+    expected[np.abs(expected) < 0.5] = 0
+    out = thresholded_delta(a, b, 0.5, out=a)
+    assert out is a
+    np.testing.assert_allclose(a.buffer, expected)
+
+
+def test_axpy_with_flat_and_plain_weights():
+    a, b = _weights(0), _weights(1)
+    expected = [x + 0.5 * y for x, y in zip(a, b)]
+    for other in (FlatWeights.from_list(b), b):
+        result = FlatWeights.from_list(a).axpy(0.5, other)
+        for layer, expected_layer in zip(result, expected):
+            np.testing.assert_allclose(layer, expected_layer, rtol=1e-6)
+
+
+def test_axpy_with_sparse_layers():
+    a = _weights(0)
+    delta = np.zeros(SHAPES[0], np.float32)
+    delta[::5, ::3] = 1
+    other = [SparseLayer.from_dense(delta), np.ones(SHAPES[1], np.float32), np.zeros(SHAPES[2], np.float32)]
+    result = FlatWeights.from_list(a).axpy(2, other)
+    np.testing.assert_allclose(result[0], a[0] + 2 * delta)
+    np.testing.assert_allclose(result[1], a[1] + 2)
+
+
+def test_incompatible_shapes():
+    a = FlatWeights.from_list(_weights(0))
+    b = FlatWeights.from_list(_weights(0)[:2])
+    with pytest.raises(ValueError):
+        a.axpy(1, b)
+    with pytest.raises(ValueError):
+        thresholded_delta(a, b)
+    with pytest.raises(ValueError):
+        FlatWeights(np.zeros(10), [(3, 3)])
+
+
+def test_linear_combination():
+    a, b, c = _weights(0), _weights(1), _weights(2)
+    result = linear_combination([(1, a), (0.5, FlatWeights.from_list(b)), (-0.5, c)])
+    for layer, x, y, z in zip(result, a, b, c):
+        np.testing.assert_allclose(layer, x + (y - z) * 0.5, rtol=1e-5, atol=1e-6)
+    with pytest.raises(ValueError):
+        linear_combination([])
+
+
+def test_pickled_as_plain_list():
+    flat = FlatWeights.from_list(_weights(0))
+    restored = pickle.loads(pickle.dumps(flat))
+    assert type(restored) is list
+    assert all(type(layer) is np.ndarray for layer in restored)
+    for layer, expected in zip(restored, flat):
+        np.testing.assert_array_equal(layer, expected)
+
+
+def test_dumped_flat_model_has_plain_weights():
+    _, model = _model_pair(0)
+    flat_model = WeightsOnlyModel.from_model(model, with_weights=False)
+    flat_model.set_weights(FlatWeights.from_list(_weights(0)))
+    assert isinstance(flat_model.get_weights(), FlatWeights)
+    loaded = DynamicDLModel.Loads(flat_model.dumps())
+    assert type(loaded.get_weights()) is list
+    assert all(type(layer) is np.ndarray for layer in loaded.get_weights())
+    for layer, expected in zip(loaded.get_weights(), _weights(0)):
+        np.testing.assert_array_equal(layer, expected)
@@ -0,0 +1,115 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+
+import numpy as np
+import pytest
+
+from dafne_dl.DynamicDLModel import DynamicDLModel, clear_function_cache, fn_to_source, source_to_fn
+
+from .helpers import make_model
+
+# the package exports the class with the same name as the module
+dynamic_dl_model = sys.modules['dafne_dl.DynamicDLModel']
+
+SOURCE = """def scale(x):
+    return x * 2
+"""
+
+
+@pytest.fixture(autouse=True)
+def compile_calls(monkeypatch):
+    clear_function_cache()
+    calls = []
+    compile_source = dynamic_dl_model._compile_source
+
+    def counting_compile_source(source, patches):
+        calls.append((source, dict(patches)))
+        return compile_source(source, patches)
+
+    monkeypatch.setattr(dynamic_dl_model, '_compile_source', counting_compile_source)
+    yield calls
+    clear_function_cache()
+
+
+def test_cache_hit_returns_same_function(compile_calls):
+    fn = source_to_fn(SOURCE)
+    assert fn(3) == 6
+    assert source_to_fn(SOURCE) is fn
+    assert len(compile_calls) == 1
+
+
+def test_patches_are_part_of_the_key(compile_calls):
+    plain = source_to_fn(SOURCE)
+    patched = source_to_fn(SOURCE, {r'\* 2': '* 3'})
+    other_patch = source_to_fn(SOURCE, {r'\* 2': '* 4'})
+    assert len({id(plain), id(patched), id(other_patch)}) == 3
+    assert (plain(1), patched(1), other_patch(1)) == (2, 3, 4)
+    assert source_to_fn(SOURCE, {r'\* 2': '* 3'}) is patched
+    assert len(compile_calls) == 3
+
+
+def test_cache_keys_do_not_collide():
+    key = dynamic_dl_model._function_cache_key
+    assert key(SOURCE, {}) != key(SOURCE, {'a': 'b'})
+    assert key(SOURCE, {'ab': 'c'}) != key(SOURCE, {'a': 'bc'})
+    assert key(SOURCE, {'a': 'b', 'c': 'd'}) != key(SOURCE, {'c': 'd', 'a': 'b'})
+    assert key(SOURCE, {'a': 'b'}) == key(SOURCE, {'a': 'b'})
+
+
+def test_fn_to_source_round_trip():
+    fn = source_to_fn(SOURCE)
+    assert fn.source == SOURCE
+    assert fn_to_source(fn) == SOURCE
+    assert source_to_fn(fn_to_source(fn)) is fn
+
+    patched = source_to_fn(SOURCE, {r'\* 2': '* 3'})
+    assert fn_to_source(patched) == SOURCE.replace('* 2', '* 3')
+
+
+def test_non_function_sources(compile_calls):
+    assert source_to_fn('just a string') == 'just a string'
+    assert source_to_fn('just a string') == 'just a string'
+    assert len(compile_calls) == 1
+    assert source_to_fn('x = 1\n') == 'x = 1\n'
+    obj = object()
+    assert source_to_fn(obj) is obj
+    assert fn_to_source(None) is None
+
+
+def test_least_recently_used_entries_are_evicted(compile_calls, monkeypatch):
+    monkeypatch.setattr(dynamic_dl_model, 'FUNCTION_CACHE_SIZE', 2)
+    sources = [SOURCE.replace('2', str(factor)) for factor in range(3)]
+    first = source_to_fn(sources[0])
+    source_to_fn(sources[1])
+    assert source_to_fn(sources[0]) is first  # sources[0] becomes the most recently used
+    source_to_fn(sources[2])  # evicts sources[1]
+    assert len(dynamic_dl_model._function_cache) == 2
+    assert source_to_fn(sources[0]) is first
+    assert len(compile_calls) == 3
+    source_to_fn(sources[1])
+    assert len(compile_calls) == 4
+
+
+def test_loaded_models_share_functions(compile_calls):
+    data = make_model([np.ones(3)]).dumps()
+    first = DynamicDLModel.Loads(data)
+    compiled = len(compile_calls)
+    second = DynamicDLModel.Loads(data)
+    assert len(compile_calls) == compiled
+    for fn_name in first.function_mappings:
+        assert getattr(second, fn_name) is getattr(first, fn_name)
+    assert fn_to_source(first.apply_model_function) == fn_to_source(make_model([]).apply_model_function)
@@ -0,0 +1,101 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+import numpy as np
+import pytest
+
+from dafne_dl.inference_server import InferenceServer
+
+from .helpers import make_model
+
+
+def batch_apply_function(modelObj, data_list):
+    if not hasattr(modelObj, 'batch_sizes'):
+        modelObj.batch_sizes = []
+    modelObj.batch_sizes.append(len(data_list))
+    return [modelObj.apply(data) for data in data_list]
+
+
+def checked_apply_function(modelObj, data):
+    import numpy as np
+    if data.get('invalid'):
+        raise ValueError('invalid input')
+    return {'bright': (np.asarray(data['image']) > 0.5).astype(np.uint8)}
+
+
+def _images(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((8, 8)) for _ in range(n)]
+
+
+def test_requests_are_batched():
+    model = make_model([], apply_batch_function=batch_apply_function)
+    with InferenceServer(max_batch_size=4, max_latency=0.5) as server:
+        server.add_model('test', model)
+        images = _images(8)
+        futures = [server.submit('test', {'image': image}) for image in images]
+        for future, image in zip(futures, images):
+            np.testing.assert_array_equal(future.result(5)['bright'], image > 0.5)
+        metrics = server.get_metrics()['test']
+    assert model.batch_sizes == [4, 4]
+    assert metrics['requests'] == 8
+    assert metrics['batches'] == 2
+    assert metrics['mean_batch_size'] == 4
+    assert metrics['errors'] == 0
+    assert metrics['throughput'] > 0
+
+
+def test_single_request_waits_at_most_the_latency_window():
+    max_latency = 0.1
+    model = make_model([], apply_batch_function=batch_apply_function)
+    with InferenceServer(max_batch_size=4, max_latency=max_latency) as server:
+        server.add_model('test', model)
+        start = time.monotonic()
+        server.apply('test', {'image': _images(1)[0]}, timeout=5)
+        elapsed = time.monotonic() - start
+        metrics = server.get_metrics()['test']
+    assert max_latency * 0.9 <= elapsed < max_latency + 1.0
+    assert metrics['latency_p50'] >= max_latency * 0.9
+    assert model.batch_sizes == [1]
+
+
+def test_failed_request_does_not_fail_the_batch():
+    model = make_model([])
+    model.set_internal_fn('apply_model_function', checked_apply_function)
+    model.set_internal_fn('apply_batch_function', batch_apply_function)
+    with InferenceServer(max_batch_size=4, max_latency=0.5) as server:
+        server.add_model('test', model)
+        images = _images(3)
+        futures = [server.submit('test', {'image': images[0]}),
+                   server.submit('test', {'image': images[1], 'invalid': True}),
+                   server.submit('test', {'image': images[2]})]
+        np.testing.assert_array_equal(futures[0].result(5)['bright'], images[0] > 0.5)
+        with pytest.raises(ValueError):
+            futures[1].result(5)
+        np.testing.assert_array_equal(futures[2].result(5)['bright'], images[2] > 0.5)
+        assert server.get_metrics()['test']['errors'] == 1
+
+
+def test_unknown_model_and_stop():
+    server = InferenceServer(max_latency=10)
+    server.add_model('test', make_model([]))
+    with pytest.raises(KeyError):
+        server.submit('other', {})
+    future = server.submit('test', {'image': _images(1)[0]})
+    server.stop()
+    assert future.cancelled()
+    assert server.model_names() == []
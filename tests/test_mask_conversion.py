@@ -0,0 +1,92 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from dafne_dl.common.mask_conversion import count_labels, labels_to_onehot, onehot_to_labels
+
+N_CHANNELS = 4
+
+
+def _loop_onehot(labels, n_channels):
+    # reference: one binary mask per label
+    return np.stack([(labels == channel).astype(np.uint8) for channel in range(n_channels)], axis=-1)
+
+
+@pytest.mark.parametrize('shape', [(5, 7), (7, 5), (1, 9), (3, 5, 7), (2, 1, 6)])
+def test_labels_onehot_round_trip(shape):
+    labels = np.random.default_rng(0).integers(0, N_CHANNELS, size=shape)
+    onehot = labels_to_onehot(labels, N_CHANNELS)
+    assert onehot.shape == shape + (N_CHANNELS,)
+    assert onehot.dtype == np.uint8
+    np.testing.assert_array_equal(onehot, _loop_onehot(labels, N_CHANNELS))
+    np.testing.assert_array_equal(onehot_to_labels(onehot), labels)
+
+
+@pytest.mark.parametrize('shape', [(6, 4), (2, 6, 4)])
+def test_onehot_labels_round_trip(shape):
+    labels = np.random.default_rng(1).integers(0, N_CHANNELS, size=shape)
+    onehot = _loop_onehot(labels, N_CHANNELS).astype(np.float32)
+    np.testing.assert_array_equal(labels_to_onehot(onehot_to_labels(onehot), N_CHANNELS), onehot)
+
+
+def test_batched_conversion_matches_single_images():
+    labels = np.random.default_rng(2).integers(0, N_CHANNELS, size=(3, 5, 8))
+    onehot = labels_to_onehot(labels, N_CHANNELS)
+    for image_labels, image_onehot in zip(labels, onehot):
+        np.testing.assert_array_equal(labels_to_onehot(image_labels, N_CHANNELS), image_onehot)
+        np.testing.assert_array_equal(onehot_to_labels(image_onehot), image_labels)
+
+
+def test_channel_range():
+    labels = np.random.default_rng(3).integers(0, N_CHANNELS, size=(2, 5, 3))
+    image = np.random.default_rng(4).random((2, 5, 3, 1))
+    # the image is stored in channel 0, followed by the masks and an unrelated channel
+    stack = np.concatenate([image, labels_to_onehot(labels, N_CHANNELS), np.full((2, 5, 3, 1), 2.)], axis=-1)
+    np.testing.assert_array_equal(onehot_to_labels(stack, first_channel=1, n_channels=N_CHANNELS), labels)
+
+
+def test_output_dtypes():
+    labels = np.array([[0, 1], [2, 0]])
+    assert labels_to_onehot(labels, 3, dtype=np.float32).dtype == np.float32
+    assert onehot_to_labels(labels_to_onehot(labels, 3), dtype=np.uint8).dtype == np.uint8
+
+
+def test_float_labels_are_rounded():
+    labels = np.array([[0.1, 0.9], [1.6, 2.4]])
+    np.testing.assert_array_equal(onehot_to_labels(labels_to_onehot(labels, 3)), [[0, 1], [2, 2]])
+
+
+@pytest.mark.parametrize('labels', [np.array([[0, 3]]), np.array([[-1, 0]])])
+def test_labels_out_of_range(labels):
+    with pytest.raises(ValueError):
+        labels_to_onehot(labels, 3)
+
+
+def test_argmax_ties_pick_the_first_channel():
+    onehot = np.zeros((2, 3, N_CHANNELS))
+    onehot[0, 0, [1, 2]] = 1
+    labels = onehot_to_labels(onehot)
+    assert labels[0, 0] == 1
+    assert labels[1, 2] == 0
+
+
+def test_count_labels():
+    labels = np.random.default_rng(5).integers(-1, N_CHANNELS + 1, size=(3, 5, 7))
+    counts = count_labels(labels, N_CHANNELS)
+    expected = np.array([[np.sum(image == label) for label in range(N_CHANNELS)] for image in labels])
+    np.testing.assert_array_equal(counts, expected)
+    np.testing.assert_array_equal(count_labels(labels[1], N_CHANNELS), expected[1])
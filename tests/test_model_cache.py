@@ -0,0 +1,76 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from dafne_dl.model_cache import ModelCache, estimate_model_size
+
+from .helpers import make_model
+
+
+class _DType:
+    # dtype of a tensorflow variable
+    def __init__(self, numpy_dtype):
+        self.as_numpy_dtype = numpy_dtype
+
+
+class _Variable:
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+
+    def numpy(self):
+        raise AssertionError('the values of the variables must not be copied')
+
+
+class _KerasModel:
+    def __init__(self, variables):
+        self.weights = variables
+
+    def get_weights(self):
+        raise AssertionError('get_weights must not be called')
+
+
+class _Model:
+    def __init__(self, model):
+        self.model = model
+
+    def get_weights(self):
+        raise AssertionError('get_weights must not be called')
+
+
+def test_size_from_keras_variables():
+    model = _Model(_KerasModel([_Variable((3, 3, 16, 32), _DType(np.float32)), _Variable((32,), 'float16')]))
+    assert estimate_model_size(model) == 3 * 3 * 16 * 32 * 4 + 32 * 2
+
+
+def test_size_from_weights():
+    model = make_model([np.zeros((10, 10), np.float32), np.zeros(5, np.float64)])
+    assert estimate_model_size(model) == 400 + 40
+
+
+def test_size_of_model_without_weights():
+    assert estimate_model_size(object()) == 0
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ModelCache(250, size_function=lambda model: 100)
+    cache.put('a', 'model a')
+    cache.put('b', 'model b')
+    assert cache.get('a') == 'model a'
+    cache.put('c', 'model c')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'model a' and cache.get('c') == 'model c'
+    assert cache.evictions == 1
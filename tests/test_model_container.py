@@ -0,0 +1,99 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from dafne_dl.DynamicDLModel import DynamicDLModel, FORMAT_DILL, FORMAT_CONTAINER
+from dafne_dl.model_container import dump_container, load_container, is_container
+
+from .helpers import make_model
+
+
+def _weights():
+    rng = np.random.default_rng(0)
+    return [rng.normal(size=(17, 5)).astype(np.float32), np.arange(7, dtype=np.int64),
+            np.zeros((0, 3), dtype=np.float64), rng.normal(size=(3, 3, 2)).astype(np.float16)]
+
+
+def _assert_same_model(loaded, model):
+    assert loaded.model_id == model.model_id
+    assert loaded.timestamp_id == model.timestamp_id
+    assert loaded.is_delta == model.is_delta
+    for expected, result in zip(model.get_weights(), loaded.get_weights()):
+        assert np.asarray(result).dtype == expected.dtype
+        np.testing.assert_array_equal(np.asarray(result), expected)
+    image = np.random.default_rng(1).random((4, 4))
+    np.testing.assert_array_equal(loaded.apply({'image': image})['bright'], model.apply({'image': image})['bright'])
+
+
+def test_container_round_trip_of_arbitrary_objects():
+    obj = {'a': np.arange(10.), 'nested': [np.ones((2, 2), np.int8), 'text', {'b': np.float32(3)}], 'n': 5}
+    stream = io.BytesIO()
+    dump_container(obj, stream)
+    stream.seek(0)
+    assert is_container(stream)
+    assert stream.tell() == 0
+    result = load_container(stream)
+    np.testing.assert_array_equal(result['a'], obj['a'])
+    np.testing.assert_array_equal(result['nested'][0], obj['nested'][0])
+    assert result['nested'][1:] == obj['nested'][1:]
+    assert result['n'] == 5
+
+
+@pytest.mark.parametrize('file_format', [FORMAT_DILL, FORMAT_CONTAINER])
+def test_model_round_trip_in_memory(file_format):
+    model = make_model(_weights(), timestamp_id=123)
+    data = model.dumps(file_format=file_format)
+    assert is_container(io.BytesIO(data)) == (file_format == FORMAT_CONTAINER)
+    _assert_same_model(DynamicDLModel.Loads(data), model)
+
+
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_container_file_round_trip(tmp_path, use_mmap):
+    model = make_model(_weights())
+    path = tmp_path / 'model.model'
+    with open(path, 'wb') as f:
+        model.dump(f, file_format=FORMAT_CONTAINER)
+    with open(path, 'rb') as f:
+        loaded = DynamicDLModel.Load(f, use_mmap=use_mmap)
+    _assert_same_model(loaded, model)
+    # memory-mapped weights are copy-on-write: modifying them does not change the file
+    loaded.get_weights()[0][:] = 0
+    with open(path, 'rb') as f:
+        _assert_same_model(DynamicDLModel.Load(f), model)
+
+
+@pytest.mark.parametrize('file_format', [FORMAT_DILL, FORMAT_CONTAINER])
+@pytest.mark.parametrize('buffered', [True, False])
+def test_load_from_pipe(file_format, buffered):
+    model = make_model(_weights())
+    data = model.dumps(file_format=file_format)
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with open(write_fd, 'wb') as f:
+            f.write(data)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    with open(read_fd, 'rb', buffering=-1 if buffered else 0) as f:
+        loaded = DynamicDLModel.Load(f)
+    writer.join()
+    _assert_same_model(loaded, model)
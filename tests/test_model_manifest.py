@@ -0,0 +1,170 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import time
+
+import numpy as np
+import pytest
+
+import dafne_dl.model_manifest as model_manifest_module
+from dafne_dl.LocalModelProvider import LocalModelProvider
+from dafne_dl.model_manifest import ModelManifest, MODEL_FILE_PATTERN
+
+from .helpers import make_model
+
+
+def _touch(directory, name, content=b'model'):
+    with open(os.path.join(str(directory), name), 'wb') as f:
+        f.write(content)
+
+
+def _age_directory(directory):
+    # makes the directory mtime final, so that unchanged directories are not scanned again
+    past = time.time() - 60
+    os.utime(directory, (past, past))
+
+
+@pytest.mark.parametrize('file_name, expected', [
+    ('thigh_1600000000.model', ('thigh', '1600000000')),
+    ('leg_7.model', ('leg', '7')),
+    ('leg_v2_final.model', ('leg', 'v2_final')),
+    ('thigh.model', None),
+    ('thigh_1.model.part', None),
+    ('thigh_1.model.delta.part', None),
+    ('hash_index.json', None),
+    ('thigh_1.modelx', None),
+])
+def test_file_name_pattern(file_name, expected):
+    match = MODEL_FILE_PATTERN.match(file_name)
+    assert (match.groups() if match else None) == expected
+
+
+def test_timestamps_are_ordered_numerically(tmp_path):
+    for timestamp in ['9', '10', '100', '2', 'old']:
+        _touch(tmp_path, f'thigh_{timestamp}.model')
+    _touch(tmp_path, 'leg_5.model')
+    _touch(tmp_path, 'notes.txt')
+    manifest = ModelManifest(tmp_path)
+    assert sorted(manifest.model_names()) == ['leg', 'thigh']
+    assert manifest.timestamps('thigh') == ['2', '9', '10', '100', 'old']
+    # non-numeric timestamps sort after all numeric ones
+    assert manifest.latest_timestamp('thigh') == 'old'
+    os.remove(tmp_path / 'thigh_old.model')
+    assert manifest.latest_timestamp('thigh') == '100'
+    assert manifest.latest_timestamp('unknown') is None
+    assert manifest.timestamps('unknown') == []
+
+
+def test_get_entries_and_hashes(tmp_path):
+    _touch(tmp_path, 'thigh_1.model', b'first')
+    _touch(tmp_path, 'thigh_2.model', b'second version')
+    manifest = ModelManifest(tmp_path)
+    entry = manifest.get('thigh')
+    assert entry == {'timestamp': '2', 'path': tmp_path / 'thigh_2.model', 'size': len(b'second version')}
+    assert manifest.get('thigh', 1)['path'] == tmp_path / 'thigh_1.model'
+    assert manifest.get('thigh', 3) is None
+    assert manifest.get('leg') is None
+    assert manifest.get_hash('thigh', 1) == hashlib.sha256(b'first').hexdigest()
+    assert manifest.get_hash('thigh', 3) is None
+
+
+def test_added_and_removed_files(tmp_path):
+    _touch(tmp_path, 'thigh_1.model')
+    manifest = ModelManifest(tmp_path)
+    assert manifest.latest_timestamp('thigh') == '1'
+
+    _touch(tmp_path, 'thigh_20.model')
+    _touch(tmp_path, 'leg_3.model')
+    assert manifest.latest_timestamp('thigh') == '20'
+    assert sorted(manifest.model_names()) == ['leg', 'thigh']
+
+    os.remove(tmp_path / 'thigh_20.model')
+    assert manifest.latest_timestamp('thigh') == '1'
+    assert manifest.timestamps('thigh') == ['1']
+
+    os.remove(tmp_path / 'leg_3.model')
+    assert manifest.model_names() == ['thigh']
+    assert manifest.get('leg') is None
+
+
+def test_unchanged_directory_is_not_scanned(tmp_path, monkeypatch):
+    _touch(tmp_path, 'thigh_1.model')
+    _age_directory(tmp_path)
+    scans = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scans.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(model_manifest_module.os, 'scandir', counting_scandir)
+    manifest = ModelManifest(tmp_path)
+    for _ in range(3):
+        assert manifest.latest_timestamp('thigh') == '1'
+    assert len(scans) == 1
+
+    _touch(tmp_path, 'thigh_2.model')
+    assert manifest.latest_timestamp('thigh') == '2'
+    assert len(scans) == 2
+
+
+def test_recently_modified_directory_is_scanned_again(tmp_path):
+    _touch(tmp_path, 'thigh_1.model')
+    manifest = ModelManifest(tmp_path)
+    manifest.refresh()
+    # the directory was modified within the mtime granularity, so the scan is not final
+    assert manifest.dir_mtime is None
+
+
+def test_missing_directory(tmp_path):
+    manifest = ModelManifest(tmp_path / 'missing')
+    assert manifest.model_names() == []
+    assert manifest.get('thigh') is None
+
+
+def _save_model(directory, name, timestamp, value):
+    model = make_model([np.full(3, value, dtype=np.float32)], timestamp_id=timestamp)
+    with open(os.path.join(str(directory), f'{name}_{timestamp}.model'), 'wb') as f:
+        model.dump(f)
+
+
+def test_local_provider_lookups(tmp_path):
+    models_path = tmp_path / 'models'
+    models_path.mkdir()
+    _save_model(models_path, 'thigh', 9, 1.)
+    _save_model(models_path, 'thigh', 10, 2.)
+    provider = LocalModelProvider(models_path, str(tmp_path))
+
+    assert provider.available_models() == ['thigh']
+    np.testing.assert_array_equal(provider.load_model('thigh').get_weights()[0], [2., 2., 2.])
+    np.testing.assert_array_equal(provider.load_model('thigh', timestamp=9).get_weights()[0], [1., 1., 1.])
+    with pytest.raises(FileNotFoundError):
+        provider.load_model('thigh', timestamp=11)
+    with pytest.raises(FileNotFoundError):
+        provider.load_model('leg')
+
+    details = provider.model_details('thigh')
+    assert details['timestamps'] == ['9', '10']
+    assert details['latest_timestamp'] == '10'
+    with open(models_path / 'thigh_10.model', 'rb') as f:
+        assert provider.get_model_hash('thigh') == hashlib.sha256(f.read()).hexdigest()
+    with pytest.raises(FileNotFoundError):
+        provider.get_model_hash('leg')
+
+    provider.upload_model('thigh', make_model([np.full(3, 3., dtype=np.float32)], timestamp_id=11))
+    assert provider.model_details('thigh')['latest_timestamp'] == '11'
+    np.testing.assert_array_equal(provider.load_model('thigh').get_weights()[0], [3., 3., 3.])
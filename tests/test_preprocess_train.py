@@ -0,0 +1,127 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from skimage.filters import threshold_otsu
+
+from dafne_dl.common.preprocess_train import calc_weight, calc_weight_legacy, calc_weight_edt, \
+    input_creation_mem, DEFAULT_WEIGHT_ENGINE
+
+# tolerances of the edt engine with respect to the legacy one. The edt engine measures Euclidean distances, the legacy
+# one searches along the four axes, so the border term (peak value 10) differs near oblique borders
+MEAN_ABS_TOLERANCE = 0.05
+P99_ABS_TOLERANCE = 1.5
+TOTAL_REL_TOLERANCE = 0.02
+
+
+def _multi_roi_slice(size=64, seed=0):
+    # four ROIs touching each other (the quadrants of a disk) and a separate small one
+    yy, xx = np.mgrid[:size, :size]
+    center = size * 0.47
+    disk = (yy - center) ** 2 + (xx - center) ** 2 < (size * 0.34) ** 2
+    seg = np.zeros((size, size))
+    seg[disk & (yy < center) & (xx < center)] = 1
+    seg[disk & (yy < center) & (xx >= center)] = 2
+    seg[disk & (yy >= center) & (xx < center)] = 3
+    seg[disk & (yy >= center) & (xx >= center)] = 4
+    seg[(yy - size * 0.86) ** 2 + (xx - size * 0.86) ** 2 < 16] = 5
+    img = (seg > 0) * 100.0 + np.random.default_rng(seed).normal(0, 5, seg.shape)
+    ch = 6
+    counts = np.bincount(seg.astype(int).ravel(), minlength=ch)
+    freq = counts / counts.sum()
+    return img, seg, freq.mean(), freq, ch
+
+
+@pytest.mark.parametrize('band', [10., 50., 200.])
+def test_edt_matches_legacy_within_tolerance(band):
+    img, seg, av, freq, ch = _multi_roi_slice()
+    legacy = calc_weight_legacy(img, seg, av, freq, seg.shape[0], band, ch)
+    edt = calc_weight_edt(img, seg, av, freq, seg.shape[0], band, ch)
+    assert edt.shape == legacy.shape
+    assert edt.dtype == legacy.dtype
+    difference = np.abs(edt - legacy)
+    assert difference.mean() <= MEAN_ABS_TOLERANCE
+    assert np.percentile(difference, 99) <= P99_ABS_TOLERANCE
+    assert abs(edt.sum() - legacy.sum()) <= TOTAL_REL_TOLERANCE * legacy.sum()
+
+    # outside the foreground only the class frequency term is present, and it must be identical
+    background = img <= threshold_otsu(img)
+    np.testing.assert_allclose(edt[background], legacy[background], rtol=1e-6)
+
+
+def test_calc_weight_engines():
+    img, seg, av, freq, ch = _multi_roi_slice(size=32)
+    np.testing.assert_array_equal(calc_weight(img, seg, av, freq, 32, 50., ch),
+                                  calc_weight_edt(img, seg, av, freq, 32, 50., ch))
+    np.testing.assert_array_equal(calc_weight(img, seg, av, freq, 32, 50., ch, engine='legacy'),
+                                  calc_weight_legacy(img, seg, av, freq, 32, 50., ch))
+    with pytest.raises(ValueError):
+        calc_weight(img, seg, av, freq, 32, 50., ch, engine='unknown')
+
+
+def test_training_uses_the_edt_engine_by_default():
+    img, seg, av, freq, ch = _multi_roi_slice(size=32)
+    masks = np.stack([seg == label for label in range(ch)], axis=-1).astype(np.float64)
+    default = input_creation_mem([img.copy()], [masks.copy()], 50.)
+    edt = input_creation_mem([img.copy()], [masks.copy()], 50., weight_engine='edt')
+    assert DEFAULT_WEIGHT_ENGINE == 'edt'
+    np.testing.assert_array_equal(default[0], edt[0])
+
+
+def _training_slices(n_slices=5, size=32):
+    image_list = []
+    mask_list = []
+    for index in range(n_slices):
+        img, seg, _, _, ch = _multi_roi_slice(size=size, seed=index)
+        seg = np.roll(seg, 2 * index, axis=index % 2)  # every slice is different, so that the order matters
+        masks = np.stack([seg == label for label in range(ch)], axis=-1).astype(np.float64)
+        # overlapping ROI, removed by input_creation_mem
+        masks[:size // 4, :size // 4, ch - 1] = 1
+        if index == 2:
+            masks[..., 3] = 0  # a class missing from one slice changes the frequencies
+        image_list.append(np.roll(img, 2 * index, axis=index % 2))
+        mask_list.append(masks)
+    return image_list, mask_list
+
+
+def _copies(arrays):
+    # input_creation_mem modifies the masks in place when it runs in the current process
+    return [array.copy() for array in arrays]
+
+
+@pytest.mark.parametrize('max_workers, chunksize', [(2, 1), (2, 2), (3, 4), (None, 1)])
+def test_parallel_input_creation_matches_serial(max_workers, chunksize):
+    image_list, mask_list = _training_slices()
+    serial = input_creation_mem(_copies(image_list), _copies(mask_list), 50.)
+    parallel = input_creation_mem(_copies(image_list), _copies(mask_list), 50., max_workers=max_workers,
+                                  chunksize=chunksize)
+    assert len(parallel) == len(serial)
+    for serial_slice, parallel_slice in zip(serial, parallel):
+        np.testing.assert_array_equal(parallel_slice, serial_slice)
+
+
+@pytest.mark.parametrize('executor_class', [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_input_creation_with_external_executor(executor_class):
+    image_list, mask_list = _training_slices()
+    serial = input_creation_mem(_copies(image_list), _copies(mask_list), 50., weight_engine='legacy')
+    with executor_class(max_workers=2) as executor:
+        parallel = input_creation_mem(_copies(image_list), _copies(mask_list), 50., weight_engine='legacy',
+                                      chunksize=2, executor=executor)
+    assert len(parallel) == len(serial)
+    for serial_slice, parallel_slice in zip(serial, parallel):
+        np.testing.assert_array_equal(parallel_slice, serial_slice)
@@ -0,0 +1,120 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from dafne_dl.DynamicDLModel import DynamicDLModel, FORMAT_DILL, FORMAT_CONTAINER
+from dafne_dl.quantization import QuantizedLayer, QUANTIZATION_FLOAT16, QUANTIZATION_INT8, QUANTIZATION_MODES, \
+    quantize_layer, dequantize_layer, measure_quantization
+from dafne_dl.sparse_weights import SparseLayer, SPARSE_DENSITY_CUTOFF
+
+from .helpers import make_model
+
+
+def _weights(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(scale=0.1, size=(40, 50)).astype(np.float32)
+
+
+def _max_error(mode, arr):
+    if mode == QUANTIZATION_FLOAT16:
+        return np.abs(arr) * 2.0 ** -11 + 2.0 ** -24
+    quantized = QuantizedLayer.quantize(arr, mode)
+    return quantized.scale / 2 * (1 + 1e-6)
+
+
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_round_trip_error(mode):
+    arr = _weights()
+    quantized = quantize_layer(arr, mode)
+    assert isinstance(quantized, QuantizedLayer)
+    assert quantized.nbytes < arr.nbytes
+    restored = dequantize_layer(quantized)
+    assert restored.dtype == arr.dtype and restored.shape == arr.shape
+    assert np.all(np.abs(restored - arr) <= _max_error(mode, arr))
+
+
+@pytest.mark.parametrize('values', [[0.0, 0.5, 1.0, 2.0], [-3.0, -1.0, 0.0], [-1.0, 0.0, 0.25, 7.0]])
+def test_int8_represents_zero_exactly(values):
+    arr = np.array(values * 10, dtype=np.float32)
+    restored = dequantize_layer(quantize_layer(arr, QUANTIZATION_INT8))
+    np.testing.assert_array_equal(restored[arr == 0], 0)
+
+
+def test_constant_layer():
+    arr = np.full((5, 5), 0.3, dtype=np.float32)
+    restored = dequantize_layer(quantize_layer(arr, QUANTIZATION_INT8))
+    assert np.all(np.abs(restored - arr) <= _max_error(QUANTIZATION_INT8, arr))
+
+
+def test_non_float_layers_are_unchanged():
+    int_layer = np.arange(10, dtype=np.int32)
+    half_layer = np.ones(10, dtype=np.float16)
+    for mode in QUANTIZATION_MODES:
+        assert quantize_layer(int_layer, mode) is int_layer
+        assert quantize_layer(half_layer, mode) is half_layer
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        QuantizedLayer.quantize(_weights(), 'int4')
+
+
+def test_sparse_layer_values_are_quantized():
+    arr = _weights()
+    arr[np.abs(arr) < 0.1] = 0
+    sparse = SparseLayer.from_dense(arr)
+    quantized = quantize_layer(sparse, QUANTIZATION_INT8)
+    assert isinstance(quantized, SparseLayer) and isinstance(quantized.values, QuantizedLayer)
+    restored = dequantize_layer(quantized).to_dense()
+    np.testing.assert_array_equal(restored == 0, arr == 0)
+    assert np.all(np.abs(restored - arr) <= _max_error(QUANTIZATION_INT8, sparse.values))
+
+
+@pytest.mark.parametrize('file_format', [FORMAT_DILL, FORMAT_CONTAINER])
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_dump_and_load(file_format, mode):
+    weights = [_weights(0), _weights(1)[0], np.arange(4, dtype=np.int64)]
+    model = make_model(weights)
+    data = model.dumps(file_format=file_format, quantization=mode)
+    assert len(data) < len(model.dumps(file_format=file_format))
+    loaded = DynamicDLModel.Loads(data)
+    assert loaded.quantization == mode
+    for original, restored in zip(weights, loaded.get_weights()):
+        restored = np.asarray(restored)
+        assert restored.dtype == original.dtype
+        assert np.all(np.abs(restored - original) <= _max_error(mode, original))
+    np.testing.assert_array_equal(loaded.get_weights()[2], weights[2])
+
+
+def test_quantized_sparse_delta():
+    base = _weights(0)
+    new = base.copy()
+    new[:5] += 0.05
+    delta = make_model([new]).calc_delta(make_model([base]))
+    loaded_delta = DynamicDLModel.Loads(delta.dumps(sparse_density_cutoff=SPARSE_DENSITY_CUTOFF, quantization=QUANTIZATION_INT8))
+    restored = make_model([base]).apply_delta(loaded_delta).get_weights()[0]
+    np.testing.assert_array_equal(restored[5:], base[5:])
+    assert np.abs(restored[:5] - new[:5]).max() < 0.01
+
+
+def test_measure_quantization():
+    report = measure_quantization(make_model([_weights()]))
+    assert report[None]['size_ratio'] == 1.0
+    for mode in QUANTIZATION_MODES:
+        assert report[mode]['size_ratio'] < 1.0
+        assert len(report[mode]['layers']) == 1
+    assert report[QUANTIZATION_INT8]['payload_bytes'] < report[QUANTIZATION_FLOAT16]['payload_bytes']
@@ -0,0 +1,163 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+
+import numpy as np
+import pytest
+
+from dafne_dl.RemoteModelProvider import RemoteModelProvider, ConnectionPool, DownloadCancelledError, PART_SUFFIX, \
+    DELTA_PART_SUFFIX
+from dafne_dl.DynamicDLModel import DynamicDLModel
+
+from .helpers import dumped_model, make_model
+from .model_server import StandInModelServer
+
+remote_module = sys.modules['dafne_dl.RemoteModelProvider']
+RETRY_DELAY = 0.01
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # the data received before an interruption is only written in whole blocks
+    monkeypatch.setattr(remote_module, 'DOWNLOAD_BLOCK_SIZE', 16 * 1024)
+
+
+@pytest.fixture
+def retry_delays(monkeypatch, capsys):
+    monkeypatch.setattr(remote_module, 'DOWNLOAD_RETRY_DELAY', RETRY_DELAY)
+
+    def delays():
+        return [float(delay) for delay in re.findall(r'Retrying download in ([0-9.]+) s', capsys.readouterr().out)]
+    return delays
+
+
+def _provider(tmp_path, server, **kwargs):
+    return RemoteModelProvider(tmp_path / 'models', server.url, 'key', str(tmp_path / 'upload'),
+                               connection_pool=ConnectionPool(timeout=(5, 5)), **kwargs)
+
+
+def _check_model(model, data):
+    expected = DynamicDLModel.Loads(data)
+    assert isinstance(model, DynamicDLModel)
+    np.testing.assert_array_equal(model.get_weights()[0], expected.get_weights()[0])
+
+
+def _part_files(tmp_path):
+    return [name for name in os.listdir(tmp_path / 'models') if name.endswith(PART_SUFFIX)]
+
+
+def test_download(tmp_path, retry_delays):
+    data = dumped_model()
+    with StandInModelServer({'test': data}) as server:
+        provider = _provider(tmp_path, server)
+        _check_model(provider.load_model('test'), data)
+        provider.upload_queue.stop()
+    assert server.ranges == [None]
+    assert retry_delays() == []
+    assert _part_files(tmp_path) == []
+
+
+def test_interrupted_download_resumes_with_backoff(tmp_path, retry_delays):
+    data = dumped_model()
+    with StandInModelServer({'test': data}) as server:
+        server.interrupt_next = 2
+        provider = _provider(tmp_path, server)
+        _check_model(provider.load_model('test'), data)
+        provider.upload_queue.stop()
+    assert server.ranges[0] is None
+    assert all(r.startswith('bytes=') for r in server.ranges[1:])
+    assert len(server.ranges) == 3
+    assert retry_delays() == [RETRY_DELAY, RETRY_DELAY * 2]
+
+
+def test_server_without_range_support(tmp_path, retry_delays):
+    data = dumped_model()
+    with StandInModelServer({'test': data}, support_range=False) as server:
+        server.interrupt_next = 1
+        provider = _provider(tmp_path, server)
+        _check_model(provider.load_model('test'), data)
+        provider.upload_queue.stop()
+    # the range is ignored and the whole model is downloaded again
+    assert len(server.ranges) == 2 and server.ranges[1] is not None
+    assert _part_files(tmp_path) == []
+
+
+def test_gives_up_after_retries(tmp_path, retry_delays):
+    data = dumped_model()
+    with StandInModelServer({'test': data}) as server:
+        server.interrupt_next = remote_module.DOWNLOAD_RETRIES
+        provider = _provider(tmp_path, server)
+        assert provider.load_model('test') is None
+        provider.upload_queue.stop()
+    assert len(server.ranges) == remote_module.DOWNLOAD_RETRIES
+    # the partial download is kept for the next attempt
+    assert len(_part_files(tmp_path)) == 1
+
+
+def test_cancelled_delta_download_does_not_fall_back(tmp_path, retry_delays):
+    def cancel(current_size, total_size):
+        raise DownloadCancelledError('cancelled')
+
+    new_data = dumped_model(seed=1)
+    with StandInModelServer({'test': new_data}, deltas={'test': dumped_model(seed=2)}, timestamp=2) as server:
+        provider = _provider(tmp_path, server, delta_download=True)
+        with open(tmp_path / 'models' / 'test_1.model', 'wb') as f:
+            f.write(dumped_model())
+        with pytest.raises(DownloadCancelledError):
+            provider.load_model('test', progress_callback=cancel)
+        provider.upload_queue.stop()
+    assert server.requests['get_model_delta'] == 1
+    assert server.requests['get_model'] == 0
+    assert not any(name.endswith(DELTA_PART_SUFFIX) for name in os.listdir(tmp_path / 'models'))
+
+
+def test_delta_download(tmp_path, retry_delays):
+    rng = np.random.default_rng(3)
+    base_weights = rng.normal(size=50_000).astype(np.float32)
+    new_weights = base_weights + rng.normal(scale=0.01, size=base_weights.shape).astype(np.float32)
+    base = make_model([base_weights], timestamp_id=1)
+    new = make_model([new_weights], timestamp_id=2)
+    delta = new.calc_delta(base)
+    with StandInModelServer({'test': new.dumps()}, deltas={'test': delta.dumps()}, timestamp=2) as server:
+        provider = _provider(tmp_path, server)
+        with open(tmp_path / 'models' / 'test_1.model', 'wb') as f:
+            base.dump(f)
+        model = provider.load_model('test')
+        np.testing.assert_allclose(model.get_weights()[0], new_weights, atol=1e-6)
+        assert model.timestamp_id == 2
+        # the rebuilt file is recognized as the server version by the next load
+        model = provider.load_model('test')
+        np.testing.assert_allclose(model.get_weights()[0], new_weights, atol=1e-6)
+        provider.upload_queue.stop()
+    assert server.requests['get_model_delta'] == 1
+    assert server.requests['get_model'] == 0
+    assert sorted(os.listdir(tmp_path / 'models')) == ['hash_index.json', 'test.json', 'test_2.model']
+
+
+def test_incompatible_delta_falls_back_to_full_download(tmp_path, retry_delays):
+    base = make_model([np.zeros(10, np.float32)], timestamp_id=1)
+    new = make_model([np.ones(20, np.float32)], timestamp_id=2)
+    delta = make_model([np.ones(20, np.float32)], timestamp_id=1, is_delta=True)
+    with StandInModelServer({'test': new.dumps()}, deltas={'test': delta.dumps()}, timestamp=2) as server:
+        provider = _provider(tmp_path, server)
+        with open(tmp_path / 'models' / 'test_1.model', 'wb') as f:
+            base.dump(f)
+        model = provider.load_model('test')
+        provider.upload_queue.stop()
+    np.testing.assert_array_equal(model.get_weights()[0], np.ones(20))
+    assert server.requests['get_model'] == 1
@@ -0,0 +1,158 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from dafne_dl.common.DataGenerators import DataGeneratorDir, DataGeneratorMem, DataGeneratorShards
+from dafne_dl.common.sharded_store import INDEX_FILE_NAME, ShardedTrainingStore, convert_npy_dir, list_npy_ids
+
+N_SAMPLES = 11
+SAMPLES_PER_SHARD = 3
+DIM = (8, 6)
+N_LABELS = 3
+
+
+@pytest.fixture
+def training_data(tmp_path):
+    # samples as created by input_creation_mem and written as train_<ID>.npy files by the training code
+    rng = np.random.default_rng(0)
+    data = [rng.random((*DIM, N_LABELS + 2)).astype(np.float32) for _ in range(N_SAMPLES)]
+    npy_path = tmp_path / 'npy'
+    npy_path.mkdir()
+    for sample_id, arr in enumerate(data):
+        np.save(npy_path / f'train_{sample_id}.npy', arr)
+    (npy_path / 'train_notes.txt').write_text('not a sample')
+    return data, npy_path
+
+
+@pytest.fixture
+def store(training_data, tmp_path):
+    _, npy_path = training_data
+    return convert_npy_dir(str(npy_path), str(tmp_path / 'store'), samples_per_shard=SAMPLES_PER_SHARD)
+
+
+def test_list_npy_ids(training_data):
+    _, npy_path = training_data
+    # numeric order, not the lexical order of the file names
+    assert list_npy_ids(npy_path) == list(range(N_SAMPLES))
+
+
+def test_store_layout(store, tmp_path):
+    store_path = tmp_path / 'store'
+    with open(store_path / INDEX_FILE_NAME) as f:
+        index = json.load(f)
+    assert index['ids'] == list(range(N_SAMPLES))
+    assert [shard['n_samples'] for shard in index['shards']] == [3, 3, 3, 2]
+    assert index['sample_shape'] == [*DIM, N_LABELS + 2]
+    assert index['n_labels'] == N_LABELS
+    assert len(store) == N_SAMPLES
+    assert store.dtype == np.float32
+    for shard in index['shards']:
+        assert os.path.getsize(store_path / shard['file']) == shard['n_samples'] * np.prod(DIM) * (N_LABELS + 2) * 4
+
+
+def test_gather_matches_samples(store, training_data):
+    data, _ = training_data
+    # unsorted ids from several shards, with repetitions
+    ids = [10, 0, 4, 3, 9, 4, 1]
+    np.testing.assert_array_equal(store.gather(ids), np.stack([data[i] for i in ids]))
+    np.testing.assert_array_equal(store.gather(ids, channels=[0, -1]), np.stack([data[i][..., [0, -1]] for i in ids]))
+    np.testing.assert_array_equal(store.gather(ids, channels=slice(1, -1)),
+                                  np.stack([data[i][..., 1:-1] for i in ids]))
+    out = np.zeros((len(ids), *DIM, N_LABELS + 2), dtype=np.float32)
+    assert store.gather(ids, out=out) is out
+    np.testing.assert_array_equal(out, np.stack([data[i] for i in ids]))
+    with pytest.raises(KeyError):
+        store.gather([0, N_SAMPLES])
+
+
+def test_convert_subset_with_dtype(training_data, tmp_path):
+    data, npy_path = training_data
+    ids = [7, 2, 5]
+    subset = convert_npy_dir(npy_path, tmp_path / 'subset', samples_per_shard=2, dtype=np.float16, ids=ids)
+    assert subset.ids == ids
+    assert subset.dtype == np.float16
+    np.testing.assert_array_equal(subset.gather([5, 7]), np.stack([data[5], data[7]]).astype(np.float16))
+    reopened = ShardedTrainingStore(str(tmp_path / 'subset'))
+    np.testing.assert_array_equal(reopened.gather(ids), subset.gather(ids))
+
+
+def test_convert_errors(training_data, tmp_path):
+    _, npy_path = training_data
+    empty_path = tmp_path / 'empty'
+    empty_path.mkdir()
+    with pytest.raises(FileNotFoundError):
+        convert_npy_dir(empty_path, tmp_path / 'empty_store')
+
+    np.save(npy_path / f'train_{N_SAMPLES}.npy', np.zeros((4, 4, N_LABELS + 2), dtype=np.float32))
+    with pytest.raises(ValueError):
+        convert_npy_dir(npy_path, tmp_path / 'bad_store', samples_per_shard=SAMPLES_PER_SHARD)
+    # the index is written last, so the interrupted store cannot be opened
+    assert not os.path.exists(tmp_path / 'bad_store' / INDEX_FILE_NAME)
+
+
+def test_newer_store_version_is_rejected(store, tmp_path):
+    index_file = tmp_path / 'store' / INDEX_FILE_NAME
+    with open(index_file) as f:
+        index = json.load(f)
+    index['version'] += 1
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    with pytest.raises(ValueError):
+        ShardedTrainingStore(str(tmp_path / 'store'))
+
+
+def _assert_same_batches(generator, reference):
+    assert len(generator) == len(reference)
+    for index in range(len(reference)):
+        X, y = generator[index]
+        X_ref, y_ref = reference[index]
+        np.testing.assert_array_equal(X, X_ref)
+        np.testing.assert_array_equal(y, y_ref)
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_shard_generator_matches_memory_generator(store, training_data, shuffle):
+    data, npy_path = training_data
+    list_X = list(range(N_SAMPLES))
+    # the generators shuffle with the global random state: the same seed gives the same order
+    np.random.seed(1)
+    reference = DataGeneratorMem(data, list_X=list_X, batch_size=4, dim=DIM, shuffle=shuffle)
+    np.random.seed(1)
+    generator = DataGeneratorShards(store, batch_size=4, shuffle=shuffle)
+    np.random.seed(1)
+    from_dir = DataGeneratorDir(str(npy_path), batch_size=4, shuffle=shuffle)
+    assert generator.n_labels == reference.n_labels == N_LABELS
+    assert tuple(generator.dim) == tuple(reference.dim)
+    _assert_same_batches(generator, reference)
+    _assert_same_batches(from_dir, reference)
+
+    np.random.seed(2)
+    reference.on_epoch_end()
+    np.random.seed(2)
+    generator.on_epoch_end()
+    _assert_same_batches(generator, reference)
+
+
+def test_shard_generator_from_path_and_subset(store, training_data, tmp_path):
+    data, _ = training_data
+    list_X = [8, 1, 6, 3, 10, 0]
+    reference = DataGeneratorMem(data, list_X=list_X, batch_size=3, dim=DIM, shuffle=False)
+    generator = DataGeneratorShards(str(tmp_path / 'store'), list_X=list_X, batch_size=3, shuffle=False)
+    _assert_same_batches(generator, reference)
@@ -0,0 +1,110 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from dafne_dl.DynamicDLModel import DynamicDLModel, WeightsOnlyModel
+from dafne_dl.sparse_weights import SparseLayer, ENCODING_INDEX, ENCODING_BITMAP, SPARSE_DENSITY_CUTOFF, \
+    sparsify_weights, densify_weights
+
+from .helpers import make_model
+
+
+def _sparse_array(shape=(20, 30), density=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(size=shape).astype(np.float32)
+    arr[rng.random(shape) > density] = 0
+    return arr
+
+
+@pytest.mark.parametrize('encoding', [ENCODING_INDEX, ENCODING_BITMAP, None])
+def test_round_trip(encoding):
+    arr = _sparse_array()
+    layer = SparseLayer.from_dense(arr, encoding)
+    assert layer.nnz == np.count_nonzero(arr)
+    np.testing.assert_array_equal(layer.to_dense(), arr)
+    assert layer.to_dense().dtype == arr.dtype
+
+
+def test_arithmetic_with_dense():
+    arr = _sparse_array()
+    dense = np.random.default_rng(1).normal(size=arr.shape).astype(np.float32)
+    layer = SparseLayer.from_dense(arr)
+    np.testing.assert_allclose(dense + layer, dense + arr)
+    np.testing.assert_allclose(layer + dense, arr + dense)
+    np.testing.assert_allclose(dense - layer, dense - arr)
+    np.testing.assert_allclose(layer - dense, arr - dense)
+    np.testing.assert_allclose((layer * 0.5).to_dense(), arr * 0.5)
+    np.testing.assert_allclose((-layer).to_dense(), -arr)
+
+
+def test_arithmetic_between_sparse_layers():
+    a = _sparse_array(seed=2)
+    b = _sparse_array(seed=3)
+    np.testing.assert_allclose(SparseLayer.from_dense(a) - SparseLayer.from_dense(b), a - b)
+    np.testing.assert_allclose(SparseLayer.from_dense(a) + SparseLayer.from_dense(b), a + b)
+
+
+def test_sparsify_only_sparse_layers():
+    weights = [_sparse_array(), np.ones((4, 4), dtype=np.float32)]
+    sparse = sparsify_weights(weights)
+    assert isinstance(sparse[0], SparseLayer)
+    assert isinstance(sparse[1], np.ndarray)
+    for original, restored in zip(weights, densify_weights(sparse)):
+        np.testing.assert_array_equal(original, restored)
+
+
+def test_sparse_delta_dump_and_apply():
+    base_weights = [np.random.default_rng(4).normal(size=(20, 30)).astype(np.float32), np.zeros(5, np.float32)]
+    new_weights = [base_weights[0] + _sparse_array(seed=5), base_weights[1] + 1]
+    base = make_model(base_weights)
+    new = make_model(new_weights)
+    delta = new.calc_delta(base)
+
+    loaded_delta = DynamicDLModel.Loads(delta.dumps(sparse_density_cutoff=SPARSE_DENSITY_CUTOFF))
+    assert isinstance(loaded_delta, WeightsOnlyModel)
+    assert loaded_delta.is_delta
+    assert isinstance(loaded_delta.get_weights(sparse=True)[0], SparseLayer)
+    # the public weights are dense arrays
+    assert all(isinstance(layer, np.ndarray) for layer in loaded_delta.get_weights())
+    np.testing.assert_allclose(np.abs(loaded_delta.get_weights()[0]), np.abs(delta.get_weights()[0]))
+
+    updated = base.apply_delta(loaded_delta)
+    for expected, result in zip(new_weights, updated.get_weights()):
+        assert isinstance(result, np.ndarray)
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+
+def test_deltas_are_dense_by_default():
+    delta = make_model([_sparse_array()]).calc_delta(make_model([np.zeros((20, 30), np.float32)]))
+    loaded_delta = DynamicDLModel.Loads(delta.dumps())
+    assert not isinstance(loaded_delta, WeightsOnlyModel)
+    assert isinstance(loaded_delta.get_weights()[0], np.ndarray)
+
+
+def test_custom_apply_delta_receives_dense_weights():
+    def apply_delta_function(lhs, rhs):
+        import numpy as np
+        assert all(isinstance(layer, np.ndarray) for layer in rhs.get_weights())
+        output = lhs.get_empty_copy()
+        output.set_weights([a - b for a, b in zip(lhs.get_weights(), rhs.get_weights())])
+        return output
+
+    base = make_model([np.ones((20, 30), np.float32)], apply_delta_function=apply_delta_function)
+    delta = make_model([_sparse_array()]).calc_delta(make_model([np.zeros((20, 30), np.float32)]))
+    loaded_delta = DynamicDLModel.Loads(delta.dumps(sparse_density_cutoff=SPARSE_DENSITY_CUTOFF))
+    updated = base.apply_delta(loaded_delta)
+    np.testing.assert_allclose(updated.get_weights()[0], 1 - _sparse_array())
@@ -0,0 +1,113 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+
+import numpy as np
+
+from dafne_dl.DynamicDLModel import WeightsOnlyModel
+from dafne_dl.RemoteModelProvider import RemoteModelProvider, ConnectionPool
+from dafne_dl.streaming_upload import stream_model_upload
+
+from .helpers import make_model
+from .model_server import StandInModelServer
+
+
+def _model(seed=0):
+    return make_model([np.random.default_rng(seed).random(300_000).astype(np.float32), np.arange(5)])
+
+
+def _provider(tmp_path, server, **kwargs):
+    return RemoteModelProvider(tmp_path / 'models', server.url, 'key', str(tmp_path / 'upload'),
+                               connection_pool=ConnectionPool(timeout=(5, 5)), **kwargs)
+
+
+def test_streamed_body_and_hash():
+    model = _model()
+    expected = model.dumps()
+    with StandInModelServer({}) as server:
+        r, file_hash = stream_model_upload(ConnectionPool(timeout=(5, 5)), server.url + 'upload_model', model,
+                                           'model_binary', 'test.model', {'model_type': 'test', 'dice': 0.5},
+                                           chunk_size=64 * 1024, queue_size=2)
+    assert r.status_code == 200
+    assert file_hash == hashlib.sha256(expected).hexdigest()
+    assert len(server.uploads) == 1
+    upload = server.uploads[0]
+    assert upload['chunked']
+    assert upload['fields']['model_binary'] == expected
+    assert upload['fields']['hash'].decode() == file_hash
+    assert upload['fields']['model_type'] == b'test'
+    assert upload['fields']['dice'] == b'0.5'
+
+
+def test_provider_streams_a_snapshot(tmp_path):
+    model = _model()
+    expected = model.dumps()
+    with StandInModelServer({}) as server:
+        provider = _provider(tmp_path, server)
+        provider.upload_model('test', model, 0.9)
+        # the model can change while it is uploaded
+        model.model.weights[0][:] = 0
+        assert provider.flush_uploads(10)
+        provider.upload_queue.stop()
+    assert len(server.uploads) == 1
+    upload = server.uploads[0]
+    assert upload['chunked']
+    assert upload['fields']['model_binary'] == expected
+    assert upload['fields']['hash'].decode() == hashlib.sha256(expected).hexdigest()
+    assert upload['fields']['model_type'] == b'test'
+
+
+def test_failed_stream_falls_back_to_the_upload_queue(tmp_path):
+    model = _model()
+    expected = model.dumps()
+    with StandInModelServer({}, accept_chunked_uploads=False) as server:
+        provider = _provider(tmp_path, server)
+        provider.upload_model('test', model, 0.9)
+        assert provider.flush_uploads(10)
+        status = provider.get_upload_status()
+        provider.upload_queue.stop()
+    assert server.requests['upload_model'] == 2
+    assert len(server.uploads) == 1
+    upload = server.uploads[0]
+    assert not upload['chunked']
+    assert upload['fields']['model_binary'] == expected
+    assert upload['fields']['hash'].decode() == hashlib.sha256(expected).hexdigest()
+    assert status['completed'] == 1
+    assert os.listdir(tmp_path / 'upload' / 'upload_journal') == ['journal.lock']
+
+
+def _refuse_copy(weights):
+    raise AssertionError('the weights must not be copied again')
+
+
+def test_snapshot_of_keras_weights_is_not_copied_twice():
+    model = make_model([np.ones(10)])
+    model.weight_copy_function = _refuse_copy
+    snapshot = model.get_weights_snapshot()
+    model.model.weights[0][:] = 2
+    np.testing.assert_array_equal(snapshot[0], np.ones(10))
+
+
+def test_snapshot_of_referenced_weights_is_copied():
+    def model_to_weights_function(model_obj):
+        return model_obj.model.weights
+
+    for model in (make_model([np.ones(10)], model_to_weights_function=model_to_weights_function),
+                  WeightsOnlyModel.from_model(make_model([np.ones(10)]))):
+        snapshot = model.get_weights_snapshot()
+        model.get_weights()[0][:] = 2
+        np.testing.assert_array_equal(snapshot[0], np.ones(10))
@@ -0,0 +1,123 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from dafne_dl.common.tiling import tile_size_from_fov, tile_starts, tile_grid, blending_window, apply_tiled, \
+    WINDOW_MIN_WEIGHT
+
+from .helpers import make_model
+
+
+def _threshold_batch(batch_data):
+    return [{'bright': (data['image'] > 0.5).astype(np.uint8)} for data in batch_data]
+
+
+def _image(shape=(150, 110), seed=0):
+    return np.random.default_rng(seed).random(shape).astype(np.float32)
+
+
+def test_tile_size_from_fov():
+    assert tile_size_from_fov(200, [1.0, 2.0, 5.0]) == (200, 100)
+    assert tile_size_from_fov((200, 100), [0.5, 0.5]) == (400, 200)
+
+
+@pytest.mark.parametrize('length, tile_size', [(100, 32), (64, 64), (65, 64), (300, 17), (20, 64)])
+def test_tiles_cover_the_axis(length, tile_size):
+    starts = tile_starts(length, tile_size, 0.25)
+    assert starts[0] == 0
+    assert starts == sorted(starts)
+    if length <= tile_size:
+        assert starts == [0]
+        return
+    assert starts[-1] == length - tile_size
+    # neighboring tiles overlap by at least the requested fraction
+    assert all(tile_size - (b - a) >= int(tile_size * 0.25) for a, b in zip(starts, starts[1:]))
+
+
+def test_tile_grid_covers_the_image():
+    shape = (150, 110)
+    covered = np.zeros(shape, dtype=int)
+    tiles = tile_grid(shape, (64, 48))
+    for tile in tiles:
+        assert covered[tile].shape == (64, 48)
+        covered[tile] += 1
+    assert covered.min() >= 1
+
+
+def test_tile_grid_of_a_small_image():
+    assert tile_grid((20, 30), 64) == [(slice(0, 20), slice(0, 30))]
+
+
+def test_blending_window():
+    window = blending_window((32, 24))
+    assert window.shape == (32, 24)
+    assert window.min() >= WINDOW_MIN_WEIGHT
+    assert window.max() <= 1
+    # highest at the center, symmetric
+    assert np.unravel_index(window.argmax(), window.shape) in [(15, 11), (16, 12), (15, 12), (16, 11)]
+    np.testing.assert_allclose(window, window[::-1, ::-1])
+
+
+@pytest.mark.parametrize('tile_size, batch_size', [(64, 4), ((40, 70), 1), (32, 100)])
+def test_pixelwise_model_is_reproduced(tile_size, batch_size):
+    image = _image()
+    output = apply_tiled(_threshold_batch, {'image': image, 'resolution': [1, 1]}, tile_size, batch_size=batch_size)
+    np.testing.assert_array_equal(output['bright'], image > 0.5)
+
+
+def test_batches_are_limited():
+    batch_sizes = []
+
+    def apply_batch(batch_data):
+        batch_sizes.append(len(batch_data))
+        return _threshold_batch(batch_data)
+
+    apply_tiled(apply_batch, {'image': _image()}, 32, batch_size=3)
+    assert max(batch_sizes) == 3
+    assert sum(batch_sizes) == len(tile_grid((150, 110), 32))
+
+
+def test_image_smaller_than_the_tile():
+    image = _image((20, 30))
+    output = apply_tiled(_threshold_batch, {'image': image}, 64)
+    np.testing.assert_array_equal(output['bright'], image > 0.5)
+
+
+def test_votes_are_weighted_by_the_window():
+    # a model that segments only the border of its tiles loses against the centers of the neighboring tiles
+    def border_batch(batch_data):
+        outputs = []
+        for data in batch_data:
+            mask = np.ones(data['image'].shape, dtype=np.uint8)
+            mask[2:-2, 2:-2] = 0
+            outputs.append({'border': mask})
+        return outputs
+
+    output = apply_tiled(border_batch, {'image': _image((64, 64))}, 32, overlap=0.5)
+    assert output['border'][32, 32] == 0
+    assert output['border'][0, 0] == 1
+
+
+def test_classifier_output_is_rejected():
+    with pytest.raises(ValueError):
+        apply_tiled(lambda batch_data: [0.5] * len(batch_data), {'image': _image()}, 64)
+
+
+def test_model_apply_tiled():
+    image = _image()
+    output = make_model([np.zeros(1)]).apply_tiled({'image': image, 'resolution': [1, 1]}, 48, batch_size=2)
+    np.testing.assert_array_equal(output['bright'], image > 0.5)
@@ -0,0 +1,120 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+from dafne_dl.upload_queue import UploadQueue, UploadError, STATUS_FAILED, JOURNAL_SUFFIX
+
+
+def _make_file(directory, name='model.bin'):
+    path = os.path.join(str(directory), name)
+    with open(path, 'wb') as f:
+        f.write(b'data')
+    return path
+
+
+def _journal_entries(journal_dir):
+    return [name for name in os.listdir(journal_dir) if name.endswith(JOURNAL_SUFFIX)]
+
+
+def test_successful_upload_removes_file_and_journal(tmp_path):
+    sent = []
+    queue = UploadQueue(tmp_path / 'journal', lambda job: sent.append(job['filename']))
+    path = _make_file(tmp_path)
+    queue.submit('model', path)
+    assert queue.flush(5)
+    queue.stop()
+    assert sent == [os.path.abspath(path)]
+    assert not os.path.exists(path)
+    assert _journal_entries(tmp_path / 'journal') == []
+
+
+def test_retries_then_succeeds(tmp_path):
+    attempts = []
+
+    def send(job):
+        attempts.append(job['attempts'])
+        if len(attempts) < 3:
+            raise UploadError('temporary')
+
+    queue = UploadQueue(tmp_path / 'journal', send, base_delay=0.01, max_delay=0.02)
+    queue.submit('model', _make_file(tmp_path))
+    assert queue.flush(5)
+    queue.stop()
+    assert attempts == [1, 2, 3]
+    assert queue.get_status()['completed'] == 1
+
+
+def test_failed_jobs_are_kept_until_removed(tmp_path):
+    def send(job):
+        raise UploadError('rejected', retryable=False)
+
+    queue = UploadQueue(tmp_path / 'journal', send, failed_job_expiry=None)
+    path = _make_file(tmp_path)
+    queue.submit('model', path)
+    assert queue.flush(5)
+    assert queue.get_status()[STATUS_FAILED] == 1
+    assert os.path.exists(path)
+    queue.remove_failed()
+    queue.stop()
+    assert queue.get_status()[STATUS_FAILED] == 0
+    assert not os.path.exists(path)
+    assert _journal_entries(tmp_path / 'journal') == []
+
+
+def test_expired_failed_jobs_are_deleted(tmp_path):
+    def send(job):
+        raise UploadError('rejected', retryable=False)
+
+    queue = UploadQueue(tmp_path / 'journal', send, failed_job_expiry=0)
+    path = _make_file(tmp_path)
+    queue.submit('model', path)
+    assert queue.flush(5)
+    queue.stop()
+    assert not os.path.exists(path)
+    assert _journal_entries(tmp_path / 'journal') == []
+
+
+def test_pending_jobs_are_resumed_once(tmp_path):
+    journal_dir = tmp_path / 'journal'
+    started = threading.Event()
+    blocked = threading.Event()
+
+    def blocked_send(job):
+        started.set()
+        blocked.wait(5)
+
+    first = UploadQueue(journal_dir, blocked_send, max_workers=1)
+    first.submit('model', _make_file(tmp_path, 'a.bin'))
+    first.submit('model', _make_file(tmp_path, 'b.bin'))
+    assert started.wait(5)
+
+    # the journal is locked by the first queue: a second queue on the same directory does not replay it
+    sent = []
+    second = UploadQueue(journal_dir, lambda job: sent.append(job['filename']))
+    assert second.get_status()['jobs'] == []
+    second.stop()
+
+    # stop with a.bin in progress (it completes) and b.bin pending (it stays in the journal)
+    first.stop()
+    blocked.set()
+    first.workers[0].join(5)
+    assert not os.path.exists(tmp_path / 'a.bin')
+
+    third = UploadQueue(journal_dir, lambda job: sent.append(job['filename']))
+    assert third.flush(5)
+    third.stop()
+    assert [os.path.basename(f) for f in sent] == ['b.bin']
@@ -0,0 +1,92 @@
+#  Copyright (c) 2021 Dafne-Imaging Team
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from dafne_dl.DynamicDLModel import DynamicDLModel, WeightsOnlyModel
+
+from .helpers import make_model
+
+
+@pytest.fixture
+def init_calls(monkeypatch):
+    calls = []
+    init_model = WeightsOnlyModel.init_model
+
+    def recording_init_model(self):
+        calls.append(self)
+        init_model(self)
+
+    monkeypatch.setattr(WeightsOnlyModel, 'init_model', recording_init_model)
+    return calls
+
+
+def _weights_only(values, **kwargs):
+    return WeightsOnlyModel.from_model(make_model([np.asarray(values, dtype=np.float32)], **kwargs))
+
+
+def test_weight_arithmetic_does_not_init_model(init_calls):
+    base = _weights_only([1., 2., 3.], timestamp_id=1)
+    new = _weights_only([2., 2., 5.], timestamp_id=2)
+
+    delta = new.calc_delta(base)
+    applied = base.apply_delta(delta)
+    scaled = applied.factor_multiply(0.5)
+    copied = scaled.copy()
+    empty = copied.get_empty_copy()
+    data = copied.dumps()
+    loaded = DynamicDLModel.Loads(data, weights_only=True)
+    loaded_delta = DynamicDLModel.Loads(delta.dumps(sparse_density_cutoff=0.5), weights_only=True)
+    rebuilt = base.apply_delta(loaded_delta)
+
+    assert init_calls == []
+    for model in [delta, applied, scaled, copied, empty, loaded, loaded_delta, rebuilt]:
+        assert isinstance(model, WeightsOnlyModel)
+        assert not model.is_initialized()
+    np.testing.assert_array_equal(applied.get_weights()[0], [2., 2., 5.])
+    np.testing.assert_array_equal(rebuilt.get_weights()[0], [2., 2., 5.])
+    np.testing.assert_array_equal(loaded.get_weights()[0], [1., 1., 2.5])
+
+
+def test_first_apply_inits_model_once(init_calls):
+    model = _weights_only([1., 2., 3.])
+    image = np.array([[0.2, 0.8]])
+    np.testing.assert_array_equal(model.apply({'image': image})['bright'], [[0, 1]])
+    assert init_calls == [model]
+    assert model.is_initialized()
+    # the stored weights are moved into the model
+    assert model.weights is None
+    np.testing.assert_array_equal(model.model.get_weights()[0], [1., 2., 3.])
+
+    model.apply({'image': image})
+    model.apply_batch([{'image': image}])
+    assert init_calls == [model]
+
+
+def test_first_apply_batch_inits_model(init_calls):
+    model = _weights_only([1., 2., 3.])
+    model.apply_batch([{'image': np.zeros((2, 2))}])
+    assert init_calls == [model]
+
+
+def test_initialized_model_behaves_like_dynamic_model(init_calls):
+    model = _weights_only([1., 2., 3.])
+    model.apply({'image': np.zeros((1, 1))})
+    model.set_weights([np.array([4., 5., 6.], dtype=np.float32)])
+    np.testing.assert_array_equal(model.get_weights()[0], [4., 5., 6.])
+    delta = model.calc_delta(_weights_only([1., 1., 1.]))
+    np.testing.assert_array_equal(delta.get_weights()[0], [3., 4., 5.])
+    assert init_calls == [model]